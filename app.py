@@ -1,22 +1,62 @@
 # Importaciones necesarias para la aplicación Flask
-from flask import Flask, render_template, request, redirect, url_for, flash, Response, send_from_directory, g
+from flask import Flask, render_template, request, redirect, url_for, flash, Response, send_from_directory, g, jsonify, session, make_response, stream_with_context
 import os
 import psycopg2
 import psycopg2.extras
+import psycopg2.extensions
+import click
+import threading
+import time
+import collections
+import concurrent.futures
+import io
+import csv
+import queue
+import gzip
+import zlib
+import types
+import shutil
+import mimetypes
+import posixpath
+import hashlib
+import hmac
+import re
+import tempfile
+from urllib.parse import urlencode, quote
+from xml.sax.saxutils import escape as xml_escape
 from werkzeug.utils import secure_filename
+from werkzeug.wrappers import Request as WerkzeugRequest, Response as WerkzeugResponse
+from werkzeug.wsgi import wrap_file
 from email.message import EmailMessage
 import socket
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json # Importa el módulo json para cargar las actividades y sectores
 import locale # Importa el módulo locale para formato numérico
+import unicodedata # Para comparar nombres sin tildes en la búsqueda
+import base64 # Para codificar los cursores de paginación
+import binascii
 import uuid # Para generar nombres de archivo únicos en GCS y tokens
-from datetime import timedelta, datetime # Necesario para generar URLs firmadas temporales y manejar fechas
+from datetime import timedelta, datetime, timezone # Necesario para generar URLs firmadas temporales y manejar fechas
 from decimal import Decimal, InvalidOperation
-from functools import wraps # Necesario para el decorador admin_required
+from functools import wraps, lru_cache # wraps: necesario para el decorador admin_required
 from slugify import slugify # Necesario para generar slugs amigables
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired # Tokens de subida directa
+from jinja2 import FileSystemBytecodeCache
 
-# IMPORTACIONES PARA GOOGLE CLOUD STORAGE
-from google.cloud import storage # Importa la librería cliente de GCS
+# Pillow es opcional: sin él no se generan variantes y se sirve siempre la imagen original
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# Brotli es opcional: sin él los recursos precomprimidos se sirven solo con gzip
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 # Inicialización de la aplicación Flask
 app = Flask(__name__)
@@ -42,51 +82,157 @@ CLOUD_STORAGE_BUCKET = os.environ.get('CLOUD_STORAGE_BUCKET')
 # y que el bucket es público para esta imagen también.
 app.config['DEFAULT_IMAGE_GCS_FILENAME'] = 'Pymemarket_logo.png'
 
-# Inicializar el cliente de Cloud Storage
-storage_client = None # Inicializar a None por defecto
-try:
-    if CLOUD_STORAGE_BUCKET and os.environ.get('GCP_SERVICE_ACCOUNT_KEY_JSON'):
-        credentials_json = os.environ.get('GCP_SERVICE_ACCOUNT_KEY_JSON')
-        try:
-            credentials_dict = json.loads(credentials_json)
-            storage_client = storage.Client.from_service_account_info(credentials_dict)
-        except json.JSONDecodeError as jde:
-            print(f"ERROR GCS Init: No se pudo parsear GCP_SERVICE_ACCOUNT_KEY_JSON. Error: {jde}")
-            storage_client = None
-        except Exception as e:
-            print(f"ERROR GCS Init: Error inesperado al inicializar con from_service_account_info: {e}")
-            storage_client = None
-    elif CLOUD_STORAGE_BUCKET:
-        # Si no hay credenciales de cuenta de servicio, intenta inicializar de forma predeterminada
-        # (útil en entornos GCS si las credenciales se gestionan de otra forma, como Default Application Credentials)
-        storage_client = storage.Client()
-    else:
-        # Si CLOUD_STORAGE_BUCKET no está definido, las funciones de GCS se omitirán.
-        pass
+# Emulador local de GCS (p. ej. fake-gcs-server) para desarrollo y pruebas, con esquema incluido:
+# STORAGE_EMULATOR_HOST=http://localhost:4443. La librería cliente lo detecta por sí sola.
+GCS_EMULATOR_HOST = os.environ.get('STORAGE_EMULATOR_HOST')
+GCS_PUBLIC_BASE_URL = GCS_EMULATOR_HOST.rstrip('/') if GCS_EMULATOR_HOST else 'https://storage.googleapis.com'
+
+# Conexiones HTTP que cada worker mantiene abiertas con la API de GCS
+GCS_HTTP_POOL_SIZE = int(os.environ.get('GCS_HTTP_POOL_SIZE', 8))
+GCS_SCOPES = ('https://www.googleapis.com/auth/devstorage.full_control',)
+# Si crear el cliente falla (credenciales, red...), segundos hasta el siguiente intento
+GCS_INIT_RETRY_SECONDS = float(os.environ.get('GCS_INIT_RETRY_SECONDS', 30))
 
-except Exception as e:
-    storage_client = None
-    print(f"ERROR GCS Init: Error general al inicializar Google Cloud Storage client: {e}")
-    print("GCS functions will be skipped.")
+class GCSStorage:
+    """
+    Cliente de Cloud Storage creado de forma perezosa, uno por proceso. La librería
+    google.cloud (lenta de importar) no se carga hasta la primera subida o borrado, así
+    el arranque y las rutas que no tocan GCS no pagan ese coste. Igual que la sesión de
+    Mailgun, el cliente y su pool de conexiones no se comparten entre workers tras el
+    fork. Las credenciales se leen una sola vez y se reutilizan.
+    """
+
+    def __init__(self, bucket_name, credentials_json):
+        self.bucket_name = bucket_name
+        self.credentials_json = credentials_json
+        self._credentials = None
+        self._client = None
+        self._bucket = None
+        self._pid = None
+        self._failed = None # (pid, instante del siguiente intento) tras un fallo al crear el cliente
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            bucket_name=CLOUD_STORAGE_BUCKET,
+            credentials_json=os.environ.get('GCP_SERVICE_ACCOUNT_KEY_JSON'),
+        )
+
+    @property
+    def configured(self):
+        # Si CLOUD_STORAGE_BUCKET no está definido, las funciones de GCS se omiten
+        return bool(self.bucket_name)
+
+    def _load_credentials(self):
+        """Devuelve (credenciales, proyecto). Se calcula una vez por proceso."""
+        if self._credentials is None:
+            if GCS_EMULATOR_HOST:
+                from google.auth.credentials import AnonymousCredentials
+                self._credentials = (AnonymousCredentials(), os.environ.get('GOOGLE_CLOUD_PROJECT', 'test'))
+            elif self.credentials_json:
+                from google.oauth2 import service_account
+                info = json.loads(self.credentials_json)
+                self._credentials = (service_account.Credentials.from_service_account_info(info, scopes=GCS_SCOPES),
+                                     info.get('project_id'))
+            else:
+                # Sin cuenta de servicio: credenciales por defecto del entorno (Application Default Credentials)
+                import google.auth
+                self._credentials = google.auth.default(scopes=GCS_SCOPES)
+        return self._credentials
+
+    def _create_client(self):
+        from google.cloud import storage
+        from google.auth.transport.requests import AuthorizedSession
+        credentials, project = self._load_credentials()
+        http = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=GCS_HTTP_POOL_SIZE)
+        http.mount('https://', adapter)
+        http.mount('http://', adapter)
+        return storage.Client(project=project, credentials=credentials, _http=http)
+
+    def _retry_pending(self):
+        return self._failed is not None and self._failed[0] == os.getpid() and time.monotonic() < self._failed[1]
+
+    def _ensure(self):
+        # _pid solo se fija si el cliente se creó (o no hay nada que crear): un fallo
+        # pasajero no deja GCS desactivado el resto de la vida del worker
+        if self._pid == os.getpid() or self._retry_pending():
+            return
+        with self._lock:
+            if self._pid == os.getpid() or self._retry_pending():
+                return
+            self._client = None
+            self._bucket = None
+            if self.configured:
+                try:
+                    client = self._create_client()
+                    self._bucket = client.bucket(self.bucket_name)
+                    self._client = client
+                except Exception as e:
+                    if isinstance(e, json.JSONDecodeError):
+                        print(f"ERROR GCS Init: No se pudo parsear GCP_SERVICE_ACCOUNT_KEY_JSON. Error: {e}")
+                    else:
+                        print(f"ERROR GCS Init: Error al inicializar el cliente de Google Cloud Storage: {e}")
+                    self._failed = (os.getpid(), time.monotonic() + GCS_INIT_RETRY_SECONDS)
+                    return
+            self._failed = None
+            self._pid = os.getpid()
+
+    @property
+    def client(self):
+        """Cliente del proceso actual, o None si GCS no está configurado o no pudo inicializarse."""
+        self._ensure()
+        return self._client
+
+    @property
+    def bucket(self):
+        """Bucket del proceso actual, o None (mismas condiciones que client)."""
+        self._ensure()
+        return self._bucket
+
+gcs_storage = GCSStorage.from_env()
 
 # Funciones de utilidad para Google Cloud Storage
 
-def upload_to_gcs(file_stream, filename):
+class ImageUploadError(Exception):
+    """La imagen subida no es válida (tipo real no permitido o tamaño excesivo)."""
+
+
+# Tamaño de cada trozo de la subida reanudable (GCS exige múltiplos de 256 KB)
+GCS_UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+def upload_to_gcs(file_stream, filename, content_type=None, max_bytes=None):
     """
-    Sube un archivo a Google Cloud Storage.
+    Sube un archivo a Google Cloud Storage en streaming, trozo a trozo, mediante una
+    subida reanudable: nunca se carga el archivo entero en memoria.
+    Si se indica max_bytes y el archivo lo supera, se deja de leer, se cancela la
+    subida (no queda ningún objeto en el bucket) y se lanza ImageUploadError.
     Asume que el bucket ya está configurado para acceso público.
     """
-    if not storage_client or not CLOUD_STORAGE_BUCKET:
+    bucket = gcs_storage.bucket
+    if bucket is None:
         print("ADVERTENCIA GCS Upload: Cliente de almacenamiento o nombre de bucket no configurado.")
         return None
     try:
-        bucket = storage_client.bucket(CLOUD_STORAGE_BUCKET)
         blob = bucket.blob(filename)
         file_stream.seek(0) # Rebobinar el stream al principio
-        blob.upload_from_file(file_stream)
+        total = 0
+        # Al salir del 'with' con una excepción, BlobWriter cancela la subida reanudable
+        with blob.open('wb', content_type=content_type, chunk_size=GCS_UPLOAD_CHUNK_SIZE) as writer:
+            while True:
+                chunk = file_stream.read(GCS_UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                total += len(chunk)
+                if max_bytes is not None and total > max_bytes:
+                    raise ImageUploadError(f'La imagen excede el tamaño máximo permitido de {max_bytes / (1024 * 1024):.1f} MB.')
+                writer.write(chunk)
         # No es necesario llamar a blob.make_public() aquí si el bucket ya es público por defecto.
-        print(f"INFO GCS Upload: Archivo {filename} subido con éxito a GCS.")
+        print(f"INFO GCS Upload: Archivo {filename} ({total} bytes) subido con éxito a GCS.")
         return filename
+    except ImageUploadError:
+        raise
     except Exception as e:
         print(f"ERROR GCS Upload: Error al subir {filename} a GCS: {e}")
         return None
@@ -104,36 +250,448 @@ def get_public_image_url(filename):
         return url_for('static', filename=app.config['DEFAULT_IMAGE_GCS_FILENAME'])
     try:
         # Construye la URL pública estándar de GCS
-        url = f"https://storage.googleapis.com/{CLOUD_STORAGE_BUCKET}/{filename}"
+        url = f"{GCS_PUBLIC_BASE_URL}/{CLOUD_STORAGE_BUCKET}/{filename}"
         return url
     except Exception as e:
         print(f"ERROR GCS URL: Error al generar URL pública para {filename}: {e}")
         # Fallback a la URL pública de la imagen por defecto si falla la generación.
         # Asegúrate de que DEFAULT_IMAGE_GCS_FILENAME también sea público en GCS.
-        return f"https://storage.googleapis.com/{CLOUD_STORAGE_BUCKET}/{app.config['DEFAULT_IMAGE_GCS_FILENAME']}"
+        return f"{GCS_PUBLIC_BASE_URL}/{CLOUD_STORAGE_BUCKET}/{app.config['DEFAULT_IMAGE_GCS_FILENAME']}"
 
 
-def delete_from_gcs(filename):
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE CONFIGURACIÓN DE GOOGLE CLOUD STORAGE
+# -------------------------------------------------------------
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DEL PIPELINE DE IMÁGENES
+# ---------------------------------------------------------------
+# Tras subir el original a GCS, un hilo en segundo plano genera versiones
+# redimensionadas (WebP + JPEG, sin metadatos EXIF) y guarda sus URLs en
+# empresas.imagen_variantes para que las plantillas usen srcset.
+
+# Variantes: tamaño máximo, si se recorta para llenar exactamente ese tamaño y formatos
+IMAGE_VARIANTS = {
+    'card': {'size': (480, 240), 'crop': True, 'formats': ('webp', 'jpeg')},
+    'card_2x': {'size': (960, 480), 'crop': True, 'formats': ('webp', 'jpeg')},
+    'detail': {'size': (1200, 1200), 'crop': False, 'formats': ('webp', 'jpeg')},
+    'og': {'size': (1200, 630), 'crop': True, 'formats': ('jpeg',)}, # Las redes sociales no siempre aceptan WebP
+}
+IMAGE_VARIANT_QUALITY = {'webp': 80, 'jpeg': 82}
+IMAGE_VARIANT_EXTENSIONS = {'webp': 'webp', 'jpeg': 'jpg'}
+IMAGE_VARIANT_CONTENT_TYPES = {'webp': 'image/webp', 'jpeg': 'image/jpeg'}
+# Los nombres de las variantes son únicos (derivan del uuid del original), así que se pueden cachear para siempre
+IMAGE_VARIANT_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+IMAGE_PIPELINE_WORKERS = int(os.environ.get('IMAGE_PIPELINE_WORKERS', 1))
+
+def variant_filename(original_filename, variant, fmt):
+    """Nombre en GCS de una variante, derivado del nombre del original."""
+    stem = os.path.splitext(original_filename)[0]
+    return f"variantes/{stem}_{variant}.{IMAGE_VARIANT_EXTENSIONS[fmt]}"
+
+def all_variant_filenames(original_filename):
+    return [variant_filename(original_filename, variant, fmt)
+            for variant, spec in IMAGE_VARIANTS.items() for fmt in spec['formats']]
+
+def render_image_variants(data):
     """
-    Elimina un archivo de Google Cloud Storage.
+    Genera las variantes de una imagen. Devuelve [(variante, formato, (ancho, alto), bytes)].
+    Al volver a codificar sin pasar 'exif' se eliminan todos los metadatos.
     """
-    if not storage_client or not CLOUD_STORAGE_BUCKET:
-        print("ADVERTENCIA GCS Delete: Cliente de almacenamiento o nombre de bucket no configurado.")
-        return
+    with Image.open(io.BytesIO(data)) as original:
+        original.seek(0) # En GIF animados solo se usa el primer fotograma
+        img = ImageOps.exif_transpose(original) # Aplicar la orientación antes de descartar el EXIF
+        if img.mode in ('RGBA', 'LA', 'P'):
+            img = img.convert('RGBA')
+            background = Image.new('RGBA', img.size, (255, 255, 255, 255))
+            img = Image.alpha_composite(background, img)
+        img = img.convert('RGB')
+
+        rendered = []
+        for variant, spec in IMAGE_VARIANTS.items():
+            if spec['crop']:
+                resized = ImageOps.fit(img, spec['size'], Image.LANCZOS)
+            else:
+                resized = img.copy()
+                resized.thumbnail(spec['size'], Image.LANCZOS)
+            for fmt in spec['formats']:
+                buf = io.BytesIO()
+                if fmt == 'jpeg':
+                    resized.save(buf, 'JPEG', quality=IMAGE_VARIANT_QUALITY[fmt], optimize=True, progressive=True)
+                else:
+                    resized.save(buf, 'WEBP', quality=IMAGE_VARIANT_QUALITY[fmt], method=4)
+                rendered.append((variant, fmt, resized.size, buf.getvalue()))
+        return rendered
+
+def process_empresa_image(empresa_id, original_filename):
+    """
+    Descarga el original de GCS, sube sus variantes y las registra en la fila del anuncio.
+    El UPDATE comprueba imagen_filename_gcs para no pisar una imagen que se haya
+    reemplazado mientras tanto. Devuelve el diccionario de variantes o None.
+    """
+    if Image is None:
+        print("ADVERTENCIA Imágenes: Pillow no está instalado. No se generan variantes.")
+        return None
+    bucket = gcs_storage.bucket
+    if bucket is None:
+        print("ADVERTENCIA Imágenes: Cliente de almacenamiento o nombre de bucket no configurado.")
+        return None
     try:
-        bucket = storage_client.bucket(CLOUD_STORAGE_BUCKET)
-        blob = bucket.blob(filename)
-        if blob.exists():
-            blob.delete()
-            print(f"INFO GCS Delete: Archivo {filename} eliminado con éxito de GCS.")
-        else:
-            print(f"INFO GCS Delete: Archivo {filename} no encontrado en GCS. No se necesita eliminar.")
+        data = bucket.blob(original_filename).download_as_bytes()
+        variantes = {}
+        for variant, fmt, (width, height), content in render_image_variants(data):
+            name = variant_filename(original_filename, variant, fmt)
+            blob = bucket.blob(name)
+            blob.cache_control = IMAGE_VARIANT_CACHE_CONTROL
+            blob.upload_from_string(content, content_type=IMAGE_VARIANT_CONTENT_TYPES[fmt])
+            entry = variantes.setdefault(variant, {'width': width, 'height': height})
+            entry[fmt] = get_public_image_url(name)
     except Exception as e:
-        print(f"ERROR GCS Delete: Error al eliminar {filename} de GCS: {e}")
+        print(f"ERROR Imágenes: No se pudieron generar las variantes de {original_filename}: {e}")
+        return None
+
+    pool = get_db_pool()
+    conn = pool.getconn()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE empresas SET imagen_variantes = %s WHERE id = %s AND imagen_filename_gcs = %s",
+            (psycopg2.extras.Json(variantes), empresa_id, original_filename)
+        )
+        updated = cur.rowcount
+        if not updated:
+            # La imagen ya no pertenece al anuncio: las variantes recién subidas sobran
+            enqueue_gcs_deletion(cur, all_variant_filenames(original_filename))
+        conn.commit()
+        cur.close()
+    finally:
+        pool.putconn(conn)
+    if not updated:
+        notify_gcs_cleanup()
+        return None
+    invalidate_pages('empresas', f'empresa:{empresa_id}')
+    print(f"INFO Imágenes: Variantes generadas para el anuncio {empresa_id} ({original_filename}).")
+    return variantes
+
+_image_executor = None
+_image_executor_pid = None
+_image_executor_lock = threading.Lock()
+
+def schedule_image_processing(empresa_id, original_filename):
+    """Encola el procesado de la imagen en el pool de hilos del worker actual."""
+    global _image_executor, _image_executor_pid
+    if not original_filename or original_filename == app.config['DEFAULT_IMAGE_GCS_FILENAME']:
+        return
+    if _image_executor_pid != os.getpid():
+        with _image_executor_lock:
+            if _image_executor_pid != os.getpid():
+                _image_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=IMAGE_PIPELINE_WORKERS, thread_name_prefix='image-pipeline')
+                _image_executor_pid = os.getpid()
+    _image_executor.submit(process_empresa_image, empresa_id, original_filename)
+
+@app.cli.command('images-process')
+@click.option('--all', 'process_all', is_flag=True, help='Regenera también las variantes existentes.')
+def images_process_command(process_all):
+    """Genera las variantes de las imágenes de anuncios que aún no las tienen."""
+    conn = get_db_connection()
+    cur = conn.cursor()
+    query = "SELECT id, imagen_filename_gcs FROM empresas WHERE imagen_filename_gcs IS NOT NULL AND imagen_filename_gcs <> %s"
+    if not process_all:
+        query += " AND imagen_variantes IS NULL"
+    cur.execute(query + " ORDER BY id", (app.config['DEFAULT_IMAGE_GCS_FILENAME'],))
+    rows = cur.fetchall()
+    cur.close()
+    conn.rollback()
+    done = 0
+    for empresa_id, filename in rows:
+        if process_empresa_image(empresa_id, filename):
+            done += 1
+    click.echo(f"INFO Imágenes: {done} de {len(rows)} anuncios procesados.")
 
 # -------------------------------------------------------------
-# FIN DE LA SECCIÓN DE CONFIGURACIÓN DE GOOGLE CLOUD STORAGE
+# FIN DE LA SECCIÓN DEL PIPELINE DE IMÁGENES
+# -------------------------------------------------------------
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE LA COLA DE BORRADOS EN GCS
+# ---------------------------------------------------------------
+# Las rutas no borran objetos de GCS: insertan sus nombres en gcs_deletions dentro
+# de la transacción que elimina el anuncio (o reemplaza su imagen) y un hilo en
+# segundo plano (o 'flask gcs-cleanup') los borra en lotes. Si la transacción hace
+# rollback no se borra nada; si el borrado falla, se reintenta más tarde.
+
+# GCS admite como máximo 100 operaciones por petición batch
+GCS_CLEANUP_BATCH_SIZE = min(int(os.environ.get('GCS_CLEANUP_BATCH_SIZE', 100)), 100)
+GCS_CLEANUP_MAX_ATTEMPTS = int(os.environ.get('GCS_CLEANUP_MAX_ATTEMPTS', 8))
+GCS_CLEANUP_BACKOFF_BASE = float(os.environ.get('GCS_CLEANUP_BACKOFF_BASE', 60))
+GCS_CLEANUP_BACKOFF_MAX = 6 * 3600
+GCS_CLEANUP_LEASE_SECONDS = 300
+GCS_CLEANUP_POLL_INTERVAL = float(os.environ.get('GCS_CLEANUP_POLL_INTERVAL', 60))
+# Desactivar (=0) si los borrados los hace un proceso aparte con 'flask gcs-cleanup'
+GCS_CLEANUP_THREAD_ENABLED = os.environ.get('GCS_CLEANUP_THREAD', '1') != '0'
+
+def enqueue_gcs_deletion(cur, filenames):
+    """
+    Encola objetos de GCS para borrar usando el cursor de la transacción en curso.
+    Encolar dos veces el mismo nombre no tiene efecto.
+    """
+    filenames = sorted({f for f in filenames if f})
+    if filenames:
+        cur.execute("""
+            INSERT INTO gcs_deletions (filename) SELECT unnest(%s::text[])
+            ON CONFLICT (filename) DO UPDATE SET status = 'pending', next_attempt_at = LEAST(gcs_deletions.next_attempt_at, NOW())
+        """, (filenames,))
+
+def enqueue_image_deletion(cur, images):
+    """
+    Encola imágenes de anuncio, dadas como pares (imagen_filename_gcs, imagen_variantes),
+    nunca la imagen por defecto. Solo se encolan las variantes registradas en la fila:
+    un objeto que no existe hace fallar el batch entero de delete_gcs_batch(). Las que
+    el pipeline suba después de borrar la fila las encola el propio pipeline.
+    """
+    names = []
+    for original_filename, variantes in images:
+        if original_filename and original_filename != app.config['DEFAULT_IMAGE_GCS_FILENAME']:
+            names.append(original_filename)
+            for variant, entry in (variantes or {}).items():
+                names.extend(variant_filename(original_filename, variant, fmt)
+                             for fmt in entry if fmt in IMAGE_VARIANT_EXTENSIONS)
+    enqueue_gcs_deletion(cur, names)
+
+def gcs_cleanup_backoff_seconds(attempts):
+    return min(GCS_CLEANUP_BACKOFF_BASE * (2 ** max(attempts - 1, 0)), GCS_CLEANUP_BACKOFF_MAX)
+
+def delete_gcs_batch(filenames):
+    """
+    Borra los objetos en una sola petición batch de GCS. Un objeto que ya no existe
+    cuenta como borrado, así repetir un lote es inocuo. Si el batch falla, se
+    reintenta objeto a objeto para saber cuáles fallaron. Devuelve {nombre: error}.
+    """
+    client, bucket = gcs_storage.client, gcs_storage.bucket
+    if client is None:
+        return {name: 'Cliente de almacenamiento no disponible' for name in filenames}
+    from google.api_core.exceptions import NotFound
+    try:
+        with client.batch():
+            for name in filenames:
+                bucket.delete_blob(name)
+        return {}
+    except Exception:
+        pass
+    errors = {}
+    for name in filenames:
+        try:
+            bucket.delete_blob(name)
+        except NotFound:
+            pass
+        except Exception as e:
+            errors[name] = str(e)
+    return errors
+
+def drain_gcs_deletions(conn, batch_size=GCS_CLEANUP_BATCH_SIZE):
+    """
+    Borra un lote de objetos pendientes. Igual que la bandeja de correos, reclama las
+    filas con FOR UPDATE SKIP LOCKED y un 'lease' para que varios workers puedan vaciar
+    la cola a la vez sin mantener la transacción abierta durante la llamada a GCS.
+    Devuelve el número de objetos procesados.
+    """
+    if not gcs_storage.configured:
+        return 0
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            UPDATE gcs_deletions
+            SET attempts = attempts + 1,
+                next_attempt_at = NOW() + make_interval(secs => %s)
+            WHERE filename IN (
+                SELECT filename FROM gcs_deletions
+                WHERE status = 'pending' AND next_attempt_at <= NOW()
+                ORDER BY next_attempt_at
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING filename, attempts
+        """, (GCS_CLEANUP_LEASE_SECONDS, batch_size))
+        batch = cur.fetchall()
+        conn.commit()
+        if not batch:
+            return 0
+
+        errors = delete_gcs_batch([filename for filename, _ in batch])
+        deleted = [filename for filename, _ in batch if filename not in errors]
+        cur.execute("DELETE FROM gcs_deletions WHERE filename = ANY(%s)", (deleted,))
+        for filename, attempts in batch:
+            if filename not in errors:
+                continue
+            if attempts >= GCS_CLEANUP_MAX_ATTEMPTS:
+                cur.execute("UPDATE gcs_deletions SET status = 'dead', last_error = %s WHERE filename = %s",
+                            (errors[filename], filename))
+                print(f"ERROR GCS Cleanup: {filename} descartado tras {attempts} intentos: {errors[filename]}")
+            else:
+                cur.execute("""
+                    UPDATE gcs_deletions SET last_error = %s, next_attempt_at = NOW() + make_interval(secs => %s)
+                    WHERE filename = %s
+                """, (errors[filename], gcs_cleanup_backoff_seconds(attempts), filename))
+        conn.commit()
+        return len(batch)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+_gcs_cleanup_wakeup = threading.Event()
+_gcs_cleanup_pid = None
+_gcs_cleanup_lock = threading.Lock()
+
+def _gcs_cleanup_loop():
+    while True:
+        _gcs_cleanup_wakeup.wait(GCS_CLEANUP_POLL_INTERVAL)
+        _gcs_cleanup_wakeup.clear()
+        try:
+            pool = get_db_pool()
+            conn = pool.getconn()
+            try:
+                while drain_gcs_deletions(conn) == GCS_CLEANUP_BATCH_SIZE:
+                    pass # Lote completo: puede quedar más trabajo
+            finally:
+                pool.putconn(conn)
+        except Exception as e:
+            print(f"ERROR GCS Cleanup: Error al vaciar la cola de borrados: {e}")
+
+def start_gcs_cleanup():
+    """Arranca el hilo de borrados en el worker actual si aún no existe (ver start_email_sender)."""
+    global _gcs_cleanup_pid
+    if not GCS_CLEANUP_THREAD_ENABLED or _gcs_cleanup_pid == os.getpid():
+        return
+    with _gcs_cleanup_lock:
+        if _gcs_cleanup_pid != os.getpid():
+            _gcs_cleanup_wakeup.set()
+            threading.Thread(target=_gcs_cleanup_loop, name='gcs-cleanup', daemon=True).start()
+            _gcs_cleanup_pid = os.getpid()
+
+def notify_gcs_cleanup():
+    """Despierta al hilo de borrados del worker actual, arrancándolo si hace falta."""
+    if not GCS_CLEANUP_THREAD_ENABLED:
+        return
+    start_gcs_cleanup()
+    _gcs_cleanup_wakeup.set()
+
+@app.cli.command('gcs-cleanup')
+@click.option('--once', is_flag=True, help='Vacía la cola una vez y termina.')
+@click.option('--retry-dead', is_flag=True, help='Vuelve a poner en cola los borrados descartados.')
+def gcs_cleanup_command(once, retry_dead):
+    """Borra de GCS los objetos de gcs_deletions (proceso dedicado)."""
+    if gcs_storage.client is None:
+        raise click.ClickException("Cliente de almacenamiento o nombre de bucket no configurado.")
+    conn = get_db_connection()
+    if retry_dead:
+        cur = conn.cursor()
+        cur.execute("UPDATE gcs_deletions SET status = 'pending', attempts = 0, next_attempt_at = NOW() WHERE status = 'dead'")
+        click.echo(f"INFO GCS Cleanup: {cur.rowcount} borrados descartados vuelven a la cola.")
+        conn.commit()
+        cur.close()
+    while True:
+        done = drain_gcs_deletions(conn)
+        if done:
+            click.echo(f"INFO GCS Cleanup: {done} objetos procesados.")
+        if done == GCS_CLEANUP_BATCH_SIZE:
+            continue
+        if once:
+            break
+        time.sleep(GCS_CLEANUP_POLL_INTERVAL)
+
+
+# Recolección de huérfanos: objetos del bucket que ninguna fila referencia (p. ej. una
+# imagen subida cuyo formulario nunca llegó a guardarse, o un commit que falló).
+# Solo se consideran los nombres que genera la aplicación (uuid y sus variantes), y
+# nunca los subidos hace menos de GCS_GC_MIN_AGE_HOURS: una subida directa existe en
+# GCS antes de que su anuncio llegue a la base de datos.
+GCS_GC_MIN_AGE_HOURS = float(os.environ.get('GCS_GC_MIN_AGE_HOURS', 24))
+GCS_MANAGED_OBJECT_RE = re.compile(r'^(variantes/)?[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}[._]')
+
+def referenced_gcs_objects(conn):
+    """Nombres en uso: imágenes de anuncios con sus variantes, imágenes del blog y la imagen por defecto."""
+    referenced = {app.config['DEFAULT_IMAGE_GCS_FILENAME']}
+    cur = conn.cursor('gcs_gc_referenced', cursor_factory=psycopg2.extensions.cursor)
+    cur.itersize = 5000
+    try:
+        cur.execute("""
+            SELECT imagen_filename_gcs, TRUE FROM empresas WHERE imagen_filename_gcs IS NOT NULL
+            UNION ALL
+            SELECT featured_image_filename_gcs, FALSE FROM blog_posts WHERE featured_image_filename_gcs IS NOT NULL
+        """)
+        for filename, has_variants in cur:
+            referenced.add(filename)
+            if has_variants:
+                referenced.update(all_variant_filenames(filename))
+    finally:
+        cur.close()
+    return referenced
+
+def find_gcs_orphans(conn, min_age_hours=GCS_GC_MIN_AGE_HOURS):
+    """
+    Lista el bucket y devuelve (objetos revisados, {nombre: bytes} de los huérfanos).
+    Las referencias se leen después de listar, así un anuncio guardado mientras tanto
+    también cuenta.
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(hours=min_age_hours)
+    listed = 0
+    candidates = {}
+    for blob in gcs_storage.client.list_blobs(gcs_storage.bucket_name, fields='items(name,size,timeCreated),nextPageToken'):
+        listed += 1
+        if GCS_MANAGED_OBJECT_RE.match(blob.name) and blob.time_created and blob.time_created < cutoff:
+            candidates[blob.name] = blob.size or 0
+    referenced = referenced_gcs_objects(conn)
+    return listed, {name: size for name, size in candidates.items() if name not in referenced}
+
+def collect_gcs_orphans(conn, dry_run=False, min_age_hours=GCS_GC_MIN_AGE_HOURS):
+    """
+    Borra los huérfanos en peticiones batch. Los que fallan se encolan en gcs_deletions
+    para reintentarlos con el resto de la cola. Devuelve un informe.
+    """
+    listed, orphans = find_gcs_orphans(conn, min_age_hours)
+    conn.rollback()
+    report = {'revisados': listed, 'huerfanos': len(orphans), 'borrados': 0, 'fallidos': 0,
+              'bytes_recuperados': 0, 'dry_run': dry_run}
+    if dry_run:
+        report['bytes_recuperados'] = sum(orphans.values())
+        return report
+
+    names = sorted(orphans)
+    for start in range(0, len(names), GCS_CLEANUP_BATCH_SIZE):
+        chunk = names[start:start + GCS_CLEANUP_BATCH_SIZE]
+        errors = delete_gcs_batch(chunk)
+        if errors:
+            cur = conn.cursor()
+            enqueue_gcs_deletion(cur, errors)
+            conn.commit()
+            cur.close()
+        report['borrados'] += len(chunk) - len(errors)
+        report['fallidos'] += len(errors)
+        report['bytes_recuperados'] += sum(orphans[name] for name in chunk if name not in errors)
+    return report
+
+@app.cli.command('gcs-gc')
+@click.option('--dry-run', is_flag=True, help='Informa de los huérfanos sin borrar nada.')
+@click.option('--min-age-hours', type=float, default=GCS_GC_MIN_AGE_HOURS, show_default=True,
+              help='Ignora los objetos creados hace menos horas.')
+def gcs_gc_command(dry_run, min_age_hours):
+    """Borra del bucket las imágenes que ningún anuncio ni post del blog referencia."""
+    if gcs_storage.client is None:
+        raise click.ClickException("Cliente de almacenamiento o nombre de bucket no configurado.")
+    report = collect_gcs_orphans(get_db_connection(), dry_run=dry_run, min_age_hours=min_age_hours)
+    accion = 'se recuperarían' if dry_run else 'recuperados'
+    click.echo(f"INFO GCS GC: {report['revisados']} objetos revisados, {report['huerfanos']} huérfanos, "
+               f"{report['borrados']} borrados, {report['fallidos']} fallidos (encolados para reintentar); "
+               f"{accion} {report['bytes_recuperados'] / (1024 * 1024):.1f} MB ({report['bytes_recuperados']} bytes).")
+
 # -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE LA COLA DE BORRADOS EN GCS
+# -------------------------------------------------------------
+
 
 @app.route('/robots.txt')
 def robots_txt():
@@ -143,67 +701,481 @@ def robots_txt():
 # Configuración de la base de datos PostgreSQL
 DATABASE_URL = os.environ.get('DATABASE_URL')
 
-def get_db_connection():
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DEL POOL DE CONEXIONES A POSTGRESQL
+# ---------------------------------------------------------------
+
+# Tamaño del pool por proceso (cada worker de gunicorn tiene el suyo propio)
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 5))
+# Segundos que una petición espera por una conexión libre antes de fallar
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# Las conexiones ociosas más tiempo que este intervalo se comprueban con un SELECT 1 al sacarlas del pool
+DB_POOL_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTHCHECK_INTERVAL', 30))
+
+
+class PoolTimeout(Exception):
+    """No se ha liberado ninguna conexión del pool dentro de DB_POOL_TIMEOUT."""
+
+
+class ConnectionPool:
+    """
+    Pool de conexiones a PostgreSQL para un único proceso.
+    Evita el handshake TCP + TLS + autenticación con Neon en cada petición.
+    Las conexiones se comprueban al sacarlas del pool y se descartan si están rotas.
+    """
+
+    def __init__(self, dsn, min_size, max_size, timeout, healthcheck_interval):
+        self.dsn = dsn
+        self.min_size = max(0, min_size)
+        self.max_size = max(1, max_size, self.min_size)
+        self.timeout = timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.pid = os.getpid()
+        self._cond = threading.Condition()
+        self._idle = collections.deque() # Pares (conexión, instante de la última devolución)
+        self._in_use = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._timeouts = 0
+        self._created = 0
+        self._discarded = 0
+        for _ in range(self.min_size):
+            self._idle.append((self._connect(), time.monotonic()))
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn, cursor_factory=psycopg2.extras.DictCursor)
+        with self._cond:
+            self._created += 1
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.close()
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._discarded += 1
+
+    def getconn(self):
+        start = time.monotonic()
+        waited = False
+        conn = None
+        last_used = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._in_use + len(self._idle) < self.max_size:
+                    break # Hay hueco: abriremos una conexión nueva fuera del lock
+                waited = True
+                remaining = self.timeout - (time.monotonic() - start)
+                if remaining <= 0:
+                    self._waits += 1
+                    self._timeouts += 1
+                    self._wait_time += time.monotonic() - start
+                    raise PoolTimeout(f"No hay conexiones libres tras esperar {self.timeout} s.")
+                self._cond.wait(remaining)
+            self._in_use += 1
+            if waited:
+                self._waits += 1
+                self._wait_time += time.monotonic() - start
+
+        # El health-check y la conexión se hacen fuera del lock para no bloquear a otros hilos
+        try:
+            if conn is not None and not self._is_healthy(conn, last_used):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except Exception:
+            with self._cond:
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+        return conn
+
+    def putconn(self, conn):
+        keep = not conn.closed
+        if keep and conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            # Nunca devolver al pool una conexión con una transacción abierta o abortada
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                keep = False
+        if not keep:
+            self._discard(conn)
+        with self._cond:
+            self._in_use -= 1
+            if keep:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+        for conn, _ in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'pid': self.pid,
+                'min_size': self.min_size,
+                'max_size': self.max_size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                'waits': self._waits,
+                'wait_time_total_s': round(self._wait_time, 4),
+                'timeouts': self._timeouts,
+                'created': self._created,
+                'discarded': self._discarded,
+            }
+
+
+_db_pool = None
+_db_pool_lock = threading.Lock()
+
+def get_db_pool():
+    """
+    Devuelve el pool del proceso actual, creándolo la primera vez que se usa.
+    Se crea de forma perezosa y se comprueba el PID para que cada worker de gunicorn
+    (modelo pre-fork) abra sus propias conexiones y nunca comparta sockets con el master.
+    """
+    global _db_pool
     if not DATABASE_URL:
         # Asegúrate de que este error se propague y sea visible en los logs de Render
         raise ValueError("DATABASE_URL environment variable is not set.")
-    try:
-        conn = psycopg2.connect(
-            DATABASE_URL,
-            cursor_factory=psycopg2.extras.DictCursor
+    pool = _db_pool
+    if pool is None or pool.pid != os.getpid():
+        with _db_pool_lock:
+            if _db_pool is None or _db_pool.pid != os.getpid():
+                # Las conexiones heredadas del proceso padre no se cierran: pertenecen a él
+                _db_pool = ConnectionPool(DATABASE_URL, DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE,
+                                          DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_INTERVAL)
+            pool = _db_pool
+    return pool
+
+def get_db_connection():
+    """
+    Devuelve la conexión de la petición actual (guardada en flask.g).
+    Se devuelve al pool en release_db_connection al terminar la petición.
+    """
+    if 'db_conn' not in g:
+        try:
+            g.db_conn = get_db_pool().getconn()
+        except Exception as e:
+            print(f"ERROR DB: Error al conectar a la base de datos: {e}")
+            raise # Re-lanzar la excepción para que el Flask la maneje
+    return g.db_conn
+
+@app.teardown_appcontext
+def release_db_connection(exception):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        get_db_pool().putconn(conn)
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DEL POOL DE CONEXIONES A POSTGRESQL
+# -------------------------------------------------------------
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DEL CLIENTE DE MAILGUN
+# ---------------------------------------------------------------
+
+# Mailgun admite como máximo 1000 destinatarios por llamada en modo batch
+MAILGUN_BATCH_LIMIT = 1000
+
+class MailgunClient:
+    """
+    Cliente de la API de Mailgun con una requests.Session persistente por proceso:
+    reutiliza la conexión TLS con api.eu.mailgun.net (keep-alive) en lugar de abrir
+    una nueva en cada correo. La configuración se lee una sola vez al arrancar.
+    """
+
+    def __init__(self, api_key, domain, sender_email, base_url, timeout):
+        self.api_key = api_key
+        self.domain = domain
+        self.sender = f"Pyme Market <{sender_email}>"
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self._session = None
+        self._session_pid = None
+        self._session_lock = threading.Lock()
+
+    @classmethod
+    def from_env(cls):
+        return cls(
+            api_key=os.environ.get('MAILGUN_API_KEY'),
+            domain=os.environ.get('MAILGUN_DOMAIN'),
+            # Usa tu email de remitente autorizado en Mailgun (puedes usar el EMAIL_DESTINO si está autorizado)
+            sender_email=os.environ.get('SENDER_EMAIL', 'info@pymemarket.es'),
+            # Permite apuntar a un servidor falso local (ver fake_mailgun.py)
+            base_url=os.environ.get('MAILGUN_API_BASE', 'https://api.eu.mailgun.net/v3'),
+            timeout=(float(os.environ.get('MAILGUN_CONNECT_TIMEOUT', 5)), float(os.environ.get('MAILGUN_READ_TIMEOUT', 15))),
         )
-        return conn
-    except Exception as e:
-        print(f"ERROR DB: Error al conectar a la base de datos: {e}")
-        raise # Re-lanzar la excepción para que el Flask la maneje
 
-# Función de utilidad para enviar correos (CORREGIDA PARA USAR LA API DE MAILGUN)
-def send_email(to_email, subject, body):
+    @property
+    def configured(self):
+        return bool(self.api_key and self.domain)
+
+    @property
+    def session(self):
+        # Una sesión por proceso: los sockets no deben compartirse entre workers tras el fork
+        if self._session is None or self._session_pid != os.getpid():
+            with self._session_lock:
+                if self._session is None or self._session_pid != os.getpid():
+                    session = requests.Session()
+                    session.auth = ("api", self.api_key)
+                    # Solo se reintenta lo que seguro no se ha enviado: fallos de conexión y 429
+                    # (Mailgun rechazó la petición). Un 5xx o un timeout de lectura pueden llegar
+                    # con el mensaje ya aceptado; esos los reintenta la bandeja de salida más tarde.
+                    retry = Retry(connect=3, read=0, status=2, other=0, backoff_factor=0.5,
+                                  status_forcelist=(429,), allowed_methods=frozenset({'POST'}),
+                                  raise_on_status=False)
+                    adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=4)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._session_pid = os.getpid()
+        return self._session
+
+    def _post(self, data):
+        if not self.configured:
+            print("ERROR: La configuración de Mailgun no está completa.")
+            return False, "Configuración de Mailgun incompleta"
+        try:
+            # Realizar la llamada a la API (utiliza HTTPS, puerto 443, que Render permite)
+            response = self.session.post(f"{self.base_url}/{self.domain}/messages", data=data, timeout=self.timeout)
+            # Comprobar la respuesta (200 OK es éxito)
+            if response.status_code == 200:
+                return True, None
+            print(f"Error al enviar correo vía Mailgun. Código: {response.status_code}. Respuesta: {response.text}")
+            return False, f"HTTP {response.status_code}: {response.text[:500]}"
+        except requests.exceptions.RequestException as e:
+            print(f"ERROR Email: Error de conexión al API de Mailgun: {e}")
+            return False, str(e)
+
+    def send(self, to_email, subject, html):
+        """Envía un correo a un destinatario. Devuelve (éxito, mensaje_de_error)."""
+        ok, error = self._post({"from": self.sender, "to": to_email, "subject": subject, "html": html})
+        if ok:
+            print(f"Correo enviado exitosamente a {to_email} vía Mailgun.")
+        return ok, error
+
+    def send_batch(self, recipients, subject, html):
+        """
+        Envía el mismo correo a varios destinatarios en modo batch de Mailgun.
+        recipients es un dict {email: {variables}}; las variables se usan en el cuerpo
+        como %recipient.nombre% y cada destinatario solo ve su propia dirección.
+        Devuelve (éxito, mensaje_de_error) del conjunto de llamadas.
+        """
+        emails = list(recipients)
+        errors = []
+        for start in range(0, len(emails), MAILGUN_BATCH_LIMIT):
+            chunk = emails[start:start + MAILGUN_BATCH_LIMIT]
+            ok, error = self._post({
+                "from": self.sender,
+                "to": chunk,
+                "subject": subject,
+                "html": html,
+                "recipient-variables": json.dumps({email: recipients[email] or {} for email in chunk}),
+            })
+            if not ok:
+                errors.append(error)
+        if errors:
+            return False, "; ".join(errors)
+        print(f"Correo enviado exitosamente a {len(emails)} destinatarios vía Mailgun (batch).")
+        return True, None
+
+
+# Cliente único del módulo, configurado al arrancar
+mail_client = MailgunClient.from_env()
+
+def send_email_result(to_email, subject, body):
     """
     Envía un correo electrónico utilizando la API de Mailgun.
-    Requiere las variables de entorno MAILGUN_API_KEY y MAILGUN_DOMAIN.
+    Si to_email contiene varias direcciones separadas por comas se usa el modo batch.
+    Devuelve (éxito, mensaje_de_error) para que la bandeja de salida pueda registrar el fallo.
     """
-    # 1. Configuración de Mailgun
-    MAILGUN_API_KEY = os.environ.get('MAILGUN_API_KEY')
-    MAILGUN_DOMAIN = os.environ.get('MAILGUN_DOMAIN')
-    # Usa tu email de remitente autorizado en Mailgun (puedes usar el EMAIL_DESTINO si está autorizado)
-    SENDER_EMAIL = os.environ.get('SENDER_EMAIL', 'info@pymemarket.es') 
-    
-    # 2. Validación de credenciales
-    if not MAILGUN_API_KEY or not MAILGUN_DOMAIN:
-        print("ERROR: La configuración de Mailgun no está completa.")
-        return False
-
-    # 3. Datos para la solicitud POST
-    request_url = f'https://api.eu.mailgun.net/v3/{MAILGUN_DOMAIN}/messages'
-    sender = f"Pyme Market <{SENDER_EMAIL}>"
-    
-    data = {
-        "from": sender,
-        "to": to_email,
-        "subject": subject,
-        "html": body 
-    }
+    emails = [e.strip() for e in to_email.split(',') if e.strip()]
+    if len(emails) > 1:
+        return mail_client.send_batch({email: {} for email in emails}, subject, body)
+    return mail_client.send(to_email, subject, body)
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DEL CLIENTE DE MAILGUN
+# -------------------------------------------------------------
+
+def send_email(to_email, subject, body):
+    """Envío síncrono. Las rutas deben usar enqueue_email() en su lugar."""
+    return send_email_result(to_email, subject, body)[0]
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE LA BANDEJA DE SALIDA DE CORREOS (OUTBOX)
+# ---------------------------------------------------------------
+# Las rutas no llaman a Mailgun: insertan el correo en email_outbox dentro de su
+# propia transacción y un hilo en segundo plano (o 'flask email-worker') lo envía.
+
+EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE', 20))
+EMAIL_OUTBOX_MAX_ATTEMPTS = int(os.environ.get('EMAIL_OUTBOX_MAX_ATTEMPTS', 6))
+# Espera entre reintentos: base * 2^(intentos-1) segundos, con un máximo de 1 hora
+EMAIL_OUTBOX_BACKOFF_BASE = float(os.environ.get('EMAIL_OUTBOX_BACKOFF_BASE', 30))
+EMAIL_OUTBOX_BACKOFF_MAX = 3600
+# Tiempo que un envío reclamado queda reservado para este worker antes de poder reintentarse en otro
+EMAIL_OUTBOX_LEASE_SECONDS = 120
+EMAIL_OUTBOX_POLL_INTERVAL = float(os.environ.get('EMAIL_OUTBOX_POLL_INTERVAL', 30))
+# Desactivar (=0) si los correos los envía un proceso aparte con 'flask email-worker'
+EMAIL_OUTBOX_THREAD_ENABLED = os.environ.get('EMAIL_OUTBOX_THREAD', '1') != '0'
+def enqueue_email(cur, to_email, subject, body):
+    """
+    Encola un correo usando el cursor de la transacción en curso.
+    Solo se enviará si esa transacción hace commit.
+    """
+    cur.execute(
+        "INSERT INTO email_outbox (to_email, subject, body) VALUES (%s, %s, %s)",
+        (to_email, subject, body)
+    )
+
+def email_backoff_seconds(attempts):
+    return min(EMAIL_OUTBOX_BACKOFF_BASE * (2 ** max(attempts - 1, 0)), EMAIL_OUTBOX_BACKOFF_MAX)
 
+def drain_email_outbox(conn, batch_size=EMAIL_OUTBOX_BATCH_SIZE):
+    """
+    Envía un lote de correos pendientes. Los mensajes se reclaman con
+    FOR UPDATE SKIP LOCKED y un 'lease', así varios workers pueden vaciar la cola
+    a la vez sin duplicar envíos, y ninguno mantiene la transacción abierta
+    mientras espera a Mailgun. Devuelve el número de mensajes procesados.
+    """
+    cur = conn.cursor()
     try:
-        # 4. Realizar la llamada a la API (utiliza HTTPS, puerto 443, que Render permite)
-        response = requests.post(
-            request_url,
-            auth=("api", MAILGUN_API_KEY),
-            data=data
-        )
+        cur.execute("""
+            UPDATE email_outbox
+            SET attempts = attempts + 1,
+                next_attempt_at = NOW() + make_interval(secs => %s)
+            WHERE id IN (
+                SELECT id FROM email_outbox
+                WHERE status = 'pending' AND next_attempt_at <= NOW()
+                ORDER BY next_attempt_at, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, to_email, subject, body, attempts
+        """, (EMAIL_OUTBOX_LEASE_SECONDS, batch_size))
+        batch = cur.fetchall()
+        conn.commit()
 
-        # 5. Comprobar la respuesta (200 OK es éxito)
-        if response.status_code == 200:
-            print(f"Correo enviado exitosamente a {to_email} vía Mailgun.")
-            return True
-        else:
-            print(f"Error al enviar correo vía Mailgun. Código: {response.status_code}. Respuesta: {response.text}")
-            return False
+        for outbox_id, to_email, subject, body, attempts in batch:
+            ok, error = send_email_result(to_email, subject, body)
+            if ok:
+                cur.execute("UPDATE email_outbox SET status = 'sent', sent_at = NOW(), last_error = NULL WHERE id = %s", (outbox_id,))
+            elif attempts >= EMAIL_OUTBOX_MAX_ATTEMPTS:
+                # Dead letter: queda en la tabla para revisarlo o reenviarlo con 'flask email-worker --retry-dead'
+                cur.execute("UPDATE email_outbox SET status = 'dead', last_error = %s WHERE id = %s", (error, outbox_id))
+                print(f"ERROR Outbox: Correo {outbox_id} a {to_email} descartado tras {attempts} intentos: {error}")
+            else:
+                cur.execute("""
+                    UPDATE email_outbox SET last_error = %s, next_attempt_at = NOW() + make_interval(secs => %s)
+                    WHERE id = %s
+                """, (error, email_backoff_seconds(attempts), outbox_id))
+            conn.commit()
+        return len(batch)
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
 
-    except requests.exceptions.RequestException as e:
-        print(f"ERROR Email: Error de conexión al API de Mailgun: {e}")
-        return False
+
+_email_sender_wakeup = threading.Event()
+_email_sender_pid = None
+_email_sender_lock = threading.Lock()
+
+def _email_sender_loop():
+    while True:
+        _email_sender_wakeup.wait(EMAIL_OUTBOX_POLL_INTERVAL)
+        _email_sender_wakeup.clear()
+        try:
+            pool = get_db_pool()
+            conn = pool.getconn()
+            try:
+                while drain_email_outbox(conn) == EMAIL_OUTBOX_BATCH_SIZE:
+                    pass # Lote completo: puede quedar más trabajo
+            finally:
+                pool.putconn(conn)
+        except Exception as e:
+            print(f"ERROR Outbox: Error al vaciar la bandeja de salida: {e}")
+
+def start_email_sender():
+    """
+    Arranca el hilo de envío en el worker actual si aún no existe. Es por PID para que
+    exista en cada worker de gunicorn y no en el proceso master; al arrancar vacía
+    enseguida lo que haya quedado pendiente (p. ej. tras un reinicio o un deploy).
+    """
+    global _email_sender_pid
+    if not EMAIL_OUTBOX_THREAD_ENABLED or _email_sender_pid == os.getpid():
+        return
+    with _email_sender_lock:
+        if _email_sender_pid != os.getpid():
+            _email_sender_wakeup.set()
+            threading.Thread(target=_email_sender_loop, name='email-outbox', daemon=True).start()
+            _email_sender_pid = os.getpid()
+
+def notify_email_sender():
+    """Despierta al hilo de envío del worker actual, arrancándolo si hace falta."""
+    if not EMAIL_OUTBOX_THREAD_ENABLED:
+        return
+    start_email_sender()
+    _email_sender_wakeup.set()
+
+@app.before_request
+def start_background_senders():
+    # Los hilos de las colas arrancan con la primera petición de cada worker, no con el
+    # primer notify_*(): así no quedan correos ni borrados pendientes tras un reinicio.
+    start_email_sender()
+    start_gcs_cleanup()
+
+@app.cli.command('email-worker')
+@click.option('--once', is_flag=True, help='Vacía la cola una vez y termina.')
+@click.option('--retry-dead', is_flag=True, help='Vuelve a poner en cola los correos descartados.')
+def email_worker_command(once, retry_dead):
+    """Envía los correos de email_outbox (proceso dedicado)."""
+    conn = get_db_connection()
+    if retry_dead:
+        cur = conn.cursor()
+        cur.execute("UPDATE email_outbox SET status = 'pending', attempts = 0, next_attempt_at = NOW() WHERE status = 'dead'")
+        click.echo(f"INFO Outbox: {cur.rowcount} correos descartados vuelven a la cola.")
+        conn.commit()
+        cur.close()
+    while True:
+        sent = drain_email_outbox(conn)
+        if sent:
+            click.echo(f"INFO Outbox: {sent} correos procesados.")
+        if sent == EMAIL_OUTBOX_BATCH_SIZE:
+            continue
+        if once:
+            break
+        time.sleep(EMAIL_OUTBOX_POLL_INTERVAL)
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE LA BANDEJA DE SALIDA DE CORREOS (OUTBOX)
+# -------------------------------------------------------------
 
 # Constantes para la aplicación
 PROVINCIAS_ESPANA = [
@@ -238,71 +1210,472 @@ ACTIVIDADES_Y_SECTORES = {
     "Otros": ["Otros sectores no especificados arriba"]
 }
 
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE LA TAXONOMÍA (ACTIVIDADES, SECTORES Y PROVINCIAS)
+# ---------------------------------------------------------------
+# Estructuras precalculadas e inmutables a partir de las constantes anteriores: las
+# validaciones son búsquedas O(1) y nadie reconstruye listas en cada petición. Las
+# páginas no incrustan el mapa actividad -> sectores: lo descargan de un JSON estático
+# con la huella del contenido en el nombre, precomprimido y cacheable para siempre.
+
+ACTIVIDADES = tuple(ACTIVIDADES_Y_SECTORES)
+ACTIVIDADES_VALIDAS = frozenset(ACTIVIDADES)
+PROVINCIAS_VALIDAS = frozenset(PROVINCIAS_ESPANA)
+SECTORES_POR_ACTIVIDAD = types.MappingProxyType(
+    {actividad: frozenset(sectores) for actividad, sectores in ACTIVIDADES_Y_SECTORES.items()})
+# Índice inverso: actividades a las que pertenece cada sector
+ACTIVIDADES_POR_SECTOR = types.MappingProxyType({
+    sector: frozenset(a for a, sectores in ACTIVIDADES_Y_SECTORES.items() if sector in sectores)
+    for sectores in ACTIVIDADES_Y_SECTORES.values() for sector in sectores
+})
+
+def validar_taxonomia(actividad, sector, ubicacion):
+    """Errores de actividad, sector y provincia de un formulario (lista vacía si son válidos)."""
+    errores = []
+    if not actividad or actividad not in ACTIVIDADES_VALIDAS:
+        errores.append('Por favor, selecciona una actividad válida.')
+    if not sector or (actividad and sector not in SECTORES_POR_ACTIVIDAD.get(actividad, ())):
+        otras = sorted(ACTIVIDADES_POR_SECTOR.get(sector, ()))
+        if otras:
+            errores.append(f'El sector "{sector}" pertenece a {", ".join(otras)}. Selecciona un sector válido para la actividad elegida.')
+        else:
+            errores.append('Por favor, selecciona un sector válido para la actividad elegida.')
+    if not ubicacion or ubicacion not in PROVINCIAS_VALIDAS:
+        errores.append('Por favor, selecciona una provincia válida.')
+    return errores
+
+TAXONOMIA_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+def build_taxonomia_asset():
+    """Genera una sola vez el JSON de la taxonomía y sus versiones gzip y brotli."""
+    data = json.dumps({'actividades': ACTIVIDADES_Y_SECTORES, 'provincias': PROVINCIAS_ESPANA},
+                      ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    bodies = {'identity': data, 'gzip': gzip.compress(data, 9, mtime=0)}
+    if brotli is not None:
+        bodies['br'] = brotli.compress(data, quality=11)
+    return hashlib.sha256(data).hexdigest()[:12], bodies
+
+TAXONOMIA_VERSION, TAXONOMIA_BODIES = build_taxonomia_asset()
+app.jinja_env.globals['taxonomia_version'] = TAXONOMIA_VERSION
+# Respaldo de _taxonomia.html si el navegador no puede descargar el JSON
+app.jinja_env.globals['sectores_por_actividad'] = SECTORES_POR_ACTIVIDAD
+
+def negotiate_encoding(available):
+    """Mejor codificación de 'available' aceptada por el cliente (br > gzip > identity)."""
+    for encoding in ('br', 'gzip'):
+        if encoding in available and request.accept_encodings[encoding]:
+            return encoding
+    return 'identity'
+
+@app.route('/taxonomia.<version>.json')
+def taxonomia_json(version):
+    if version != TAXONOMIA_VERSION:
+        # Una página antigua pide una versión anterior: la actual tiene otra URL
+        return redirect(url_for('taxonomia_json', version=TAXONOMIA_VERSION))
+    encoding = negotiate_encoding(TAXONOMIA_BODIES)
+    response = Response(TAXONOMIA_BODIES[encoding], mimetype='application/json')
+    if encoding != 'identity':
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.headers['Cache-Control'] = TAXONOMIA_CACHE_CONTROL
+    response.set_etag(f'{TAXONOMIA_VERSION}-{encoding}')
+    return response
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE LA TAXONOMÍA (ACTIVIDADES, SECTORES Y PROVINCIAS)
+# -------------------------------------------------------------
+
 # Configuración para subida de imágenes
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 MAX_IMAGE_SIZE = 5 * 1024 * 1024  # 5 MB
 
+# Werkzeug corta la lectura del cuerpo de la petición al pasar de este límite (error 413).
+# Por defecto solo se admiten formularios sin archivos; las rutas con subidas amplían el
+# límite con @upload_limit (imagen + 1 MB de margen para el resto de campos).
+FORM_MAX_SIZE = 1024 * 1024
+app.config['MAX_CONTENT_LENGTH'] = FORM_MAX_SIZE
+IMAGE_TOO_LARGE_MESSAGE = f'La imagen excede el tamaño máximo permitido de {MAX_IMAGE_SIZE / (1024 * 1024):.1f} MB.'
+
+def upload_limit(max_bytes, message):
+    """Decorador: límite del cuerpo de la petición para esta ruta y mensaje que muestra el error 413."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            request.max_content_length = max_bytes
+            g.upload_limit_message = message
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+image_upload_limit = upload_limit(MAX_IMAGE_SIZE + FORM_MAX_SIZE, IMAGE_TOO_LARGE_MESSAGE)
+
+# Firmas (magic bytes) de los formatos aceptados: el tipo real se decide por el contenido,
+# no por la extensión ni por el Content-Type que envía el navegador.
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'png', 'image/png'),
+    (b'\xff\xd8\xff', 'jpg', 'image/jpeg'),
+    (b'GIF87a', 'gif', 'image/gif'),
+    (b'GIF89a', 'gif', 'image/gif'),
+)
+
 def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-# Filtro personalizado para formato de moneda (euros)
+def sniff_image_type(file_stream):
+    """Lee la cabecera del archivo y devuelve (extensión, content_type) o None si no es una imagen aceptada."""
+    header = file_stream.read(16)
+    file_stream.seek(0)
+    for signature, extension, content_type in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return extension, content_type
+    return None
+
+def upload_image(file_storage):
+    """
+    Valida una imagen subida por formulario y la envía a GCS en streaming con un nombre único.
+    Werkzeug ya guarda en disco (no en memoria) los archivos grandes del formulario.
+    Devuelve el nombre en GCS, None si falla GCS, o lanza ImageUploadError si la imagen no es válida.
+    """
+    if not allowed_file(file_storage.filename):
+        raise ImageUploadError('Tipo de archivo de imagen no permitido. Solo se aceptan JPG, JPEG, PNG, GIF.')
+    detected = sniff_image_type(file_storage.stream)
+    if not detected:
+        raise ImageUploadError('El archivo no es una imagen JPG, PNG o GIF válida.')
+    extension, content_type = detected
+    # La extensión del nombre en GCS se toma del tipo real, no del nombre original
+    unique_filename = f"{uuid.uuid4()}.{extension}"
+    return upload_to_gcs(file_storage.stream, unique_filename, content_type=content_type, max_bytes=MAX_IMAGE_SIZE)
+
+@app.errorhandler(413)
+def request_entity_too_large(error):
+    mensaje = g.get('upload_limit_message') or \
+        f'La petición excede el tamaño máximo permitido de {FORM_MAX_SIZE / (1024 * 1024):.1f} MB.'
+    flash(mensaje, 'danger')
+    return redirect(request.referrer or url_for('index'))
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE SUBIDAS DIRECTAS A GCS (URLS FIRMADAS)
+# ---------------------------------------------------------------
+# El navegador pide una URL firmada V4, sube la imagen directamente a GCS con un PUT
+# y envía el formulario solo con un token. Así la imagen no pasa por los workers.
+# Si GCS no está configurado, el formulario sigue enviando la imagen como antes.
+# Solo firma quien ha abierto el formulario (token de la sesión en X-Upload-Token), con
+# un límite de firmas por cliente, y cada token de subida se acepta una sola vez.
+
+SIGNED_UPLOAD_EXPIRATION = timedelta(minutes=10)
+# Tiempo máximo entre la firma y el envío del formulario
+SIGNED_UPLOAD_TOKEN_MAX_AGE = 3600
+SIGNED_UPLOAD_CONTENT_TYPES = {content_type: extension for _, extension, content_type in IMAGE_SIGNATURES}
+# Orígenes desde los que el navegador puede hacer el PUT (configuración CORS del bucket)
+SIGNED_UPLOAD_CORS_ORIGINS = [o.strip() for o in os.environ.get('SIGNED_UPLOAD_CORS_ORIGINS', 'https://www.pymemarket.es').split(',') if o.strip()]
+
+# Firmas permitidas por cliente en la ventana (segundos), en cada worker
+SIGNED_UPLOAD_RATE_LIMIT = int(os.environ.get('SIGNED_UPLOAD_RATE_LIMIT', 10))
+SIGNED_UPLOAD_RATE_WINDOW = 600
+
+_upload_token_serializer = URLSafeTimedSerializer(app.secret_key, salt='subida-directa-gcs')
+
+
+class RateLimiter:
+    """Límite de peticiones por clave en una ventana deslizante, en memoria del proceso."""
+
+    def __init__(self, limit, window):
+        self.limit = limit
+        self.window = window
+        self._hits = {}
+        self._lock = threading.Lock()
+
+    def allow(self, key):
+        now = time.monotonic()
+        with self._lock:
+            hits = self._hits.setdefault(key, collections.deque())
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+            if len(hits) >= self.limit:
+                return False
+            hits.append(now)
+            if len(self._hits) > 10000:
+                # Purga de las claves sin actividad reciente
+                self._hits = {k: v for k, v in self._hits.items() if v and v[-1] > now - self.window}
+            return True
+
+signed_upload_limiter = RateLimiter(SIGNED_UPLOAD_RATE_LIMIT, SIGNED_UPLOAD_RATE_WINDOW)
+
+def upload_form_token():
+    """Token de la sesión que autoriza a pedir firmas. Se genera al pintar un formulario con imagen."""
+    if 'upload_csrf' not in session:
+        session['upload_csrf'] = uuid.uuid4().hex
+    return session['upload_csrf']
+
+app.jinja_env.globals['upload_form_token'] = upload_form_token
+
+def client_address():
+    # Render añade la IP del cliente al final de X-Forwarded-For; lo anterior lo controla el cliente
+    forwarded = request.headers.get('X-Forwarded-For', '')
+    return forwarded.rsplit(',', 1)[-1].strip() or request.remote_addr
+
+def create_signed_upload(content_type, size):
+    """
+    Reserva un nombre único y genera la URL firmada para subirlo.
+    La firma fija el Content-Type y obliga a enviar x-goog-content-length-range,
+    de modo que GCS rechaza cuerpos mayores que MAX_IMAGE_SIZE.
+    """
+    extension = SIGNED_UPLOAD_CONTENT_TYPES.get(content_type)
+    if not extension:
+        raise ImageUploadError('Tipo de archivo de imagen no permitido. Solo se aceptan JPG, JPEG, PNG, GIF.')
+    if size is None or size <= 0 or size > MAX_IMAGE_SIZE:
+        raise ImageUploadError(IMAGE_TOO_LARGE_MESSAGE)
+
+    object_name = f"{uuid.uuid4()}.{extension}"
+    headers = {'Content-Type': content_type, 'x-goog-content-length-range': f'0,{MAX_IMAGE_SIZE}'}
+    if GCS_EMULATOR_HOST:
+        # El emulador no comprueba firmas: basta con la URL del objeto
+        upload_url = f"{GCS_PUBLIC_BASE_URL}/{CLOUD_STORAGE_BUCKET}/{object_name}"
+    else:
+        blob = gcs_storage.bucket.blob(object_name)
+        upload_url = blob.generate_signed_url(
+            version='v4',
+            expiration=SIGNED_UPLOAD_EXPIRATION,
+            method='PUT',
+            content_type=content_type,
+            headers={'x-goog-content-length-range': headers['x-goog-content-length-range']},
+        )
+    return {
+        'upload_url': upload_url,
+        'headers': headers,
+        # El token solo vale en la sesión que pidió la firma
+        'upload_token': _upload_token_serializer.dumps({'objeto': object_name, 'sesion': session['upload_csrf']}),
+    }
+
+def consume_signed_upload(object_name):
+    """
+    Marca la subida como usada. Devuelve False si ya se había usado. Hace commit en la
+    conexión de la petición, así que debe llamarse antes de empezar a escribir.
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        cur.execute("DELETE FROM signed_uploads_used WHERE used_at < NOW() - make_interval(secs => %s)",
+                    (SIGNED_UPLOAD_TOKEN_MAX_AGE,))
+        cur.execute("INSERT INTO signed_uploads_used (object_name) VALUES (%s) ON CONFLICT DO NOTHING", (object_name,))
+        used = cur.rowcount == 1
+        conn.commit()
+        return used
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+def finalize_signed_upload(upload_token):
+    """
+    Comprueba que la subida directa existe en GCS y es una imagen válida.
+    Devuelve el nombre del objeto para guardarlo en la fila, None si GCS falla,
+    o lanza ImageUploadError (y borra el objeto) si no es aceptable.
+    """
+    try:
+        payload = _upload_token_serializer.loads(upload_token, max_age=SIGNED_UPLOAD_TOKEN_MAX_AGE)
+    except (BadSignature, SignatureExpired):
+        raise ImageUploadError('La subida de la imagen ha caducado. Por favor, vuelve a seleccionarla.')
+    if not isinstance(payload, dict) or payload.get('sesion') != session.get('upload_csrf'):
+        raise ImageUploadError('La subida de la imagen no pertenece a este formulario. Por favor, vuelve a seleccionarla.')
+    object_name = payload['objeto']
+    bucket = gcs_storage.bucket
+    if bucket is None:
+        print("ADVERTENCIA GCS Upload: Cliente de almacenamiento o nombre de bucket no configurado.")
+        return None
+    if not consume_signed_upload(object_name):
+        raise ImageUploadError('Esta imagen ya se ha usado en otro envío. Por favor, vuelve a seleccionarla.')
+    try:
+        blob = bucket.get_blob(object_name) # Una sola petición: metadatos o None si no existe
+        if blob is None:
+            raise ImageUploadError('No se ha encontrado la imagen subida. Por favor, vuelve a seleccionarla.')
+        header = blob.download_as_bytes(start=0, end=15)
+        detected = sniff_image_type(io.BytesIO(header))
+        if (blob.size or 0) > MAX_IMAGE_SIZE or not detected or not object_name.endswith('.' + detected[0]):
+            blob.delete()
+            raise ImageUploadError('El archivo no es una imagen JPG, PNG o GIF válida de como máximo '
+                                   f'{MAX_IMAGE_SIZE / (1024 * 1024):.1f} MB.')
+        return object_name
+    except ImageUploadError:
+        raise
+    except Exception as e:
+        print(f"ERROR GCS Upload: Error al verificar la subida directa {object_name}: {e}")
+        return None
+
+def receive_image(file_storage, upload_token):
+    """
+    Obtiene la imagen de un formulario, ya sea subida directamente a GCS (token)
+    o enviada en el propio formulario. Devuelve el nombre en GCS o None.
+    """
+    if upload_token:
+        return finalize_signed_upload(upload_token)
+    return upload_image(file_storage)
+
+@app.route('/subidas/firmar', methods=['POST'])
+def firmar_subida():
+    """Devuelve una URL firmada de corta duración para subir una imagen directamente a GCS."""
+    if gcs_storage.bucket is None:
+        # El formulario enviará la imagen por la vía tradicional
+        return jsonify({'error': 'Subida directa no disponible.'}), 503
+    token = request.headers.get('X-Upload-Token', '')
+    if not session.get('upload_csrf') or not hmac.compare_digest(token, session['upload_csrf']):
+        return jsonify({'error': 'Formulario no válido. Recarga la página.'}), 403
+    if not signed_upload_limiter.allow(client_address()):
+        return jsonify({'error': 'Demasiadas subidas. Espera unos minutos.'}), 429
+    data = request.get_json(silent=True) or {}
+    try:
+        size = int(data.get('size', 0))
+    except (TypeError, ValueError):
+        size = None
+    try:
+        return jsonify(create_signed_upload(data.get('content_type'), size))
+    except ImageUploadError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        print(f"ERROR GCS Firma: No se pudo generar la URL firmada: {e}")
+        return jsonify({'error': 'Subida directa no disponible.'}), 503
+
+@app.cli.command('gcs-configure-cors')
+def gcs_configure_cors_command():
+    """Permite en el bucket los PUT del navegador con URLs firmadas (CORS)."""
+    bucket = gcs_storage.bucket
+    if bucket is None:
+        raise click.ClickException("Cliente de almacenamiento o nombre de bucket no configurado.")
+    bucket.cors = [{
+        'origin': SIGNED_UPLOAD_CORS_ORIGINS,
+        'method': ['PUT'],
+        'responseHeader': ['Content-Type', 'x-goog-content-length-range'],
+        'maxAgeSeconds': 3600,
+    }]
+    bucket.patch()
+    click.echo(f"INFO GCS: CORS configurado para {', '.join(SIGNED_UPLOAD_CORS_ORIGINS)}.")
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE SUBIDAS DIRECTAS A GCS (URLS FIRMADAS)
+# -------------------------------------------------------------
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DEL FORMATO DE IMPORTES (EUROS)
+# ---------------------------------------------------------------
+# Formato europeo: puntos de miles, coma decimal y dos decimales solo si el importe
+# no es entero ("1.250.000 €", "99,50 €"). Los precios se repiten mucho entre anuncios
+# (150.000, 200.000...), así que el resultado se memoriza en una caché acotada.
+
+EURO_FORMAT_CACHE_SIZE = int(os.environ.get('EURO_FORMAT_CACHE_SIZE', 4096))
+_EURO_SEPARATORS = str.maketrans(',.', '.,')
+_EURO_CENTS = Decimal('0.01')
+
+def _euro_format_uncached(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        # Camino rápido: el formato de Python ya agrupa los miles, solo cambia el separador
+        return f"{value:,} €".replace(',', '.')
+    if not isinstance(value, Decimal):
+        # Usamos str(value) para la conversión a Decimal para evitar problemas de precisión con floats
+        value = Decimal(str(value))
+    if value == value.to_integral_value():
+        return f"{int(value):,} €".replace(',', '.')
+    return f"{value.quantize(_EURO_CENTS):,.2f} €".translate(_EURO_SEPARATORS)
+
+_euro_format_cached = lru_cache(maxsize=EURO_FORMAT_CACHE_SIZE, typed=True)(_euro_format_uncached)
 
 @app.template_filter('euro_format')
 def euro_format(value):
     if value is None:
         return "N/A"
-
     try:
-        # Convertir a Decimal si aún no lo es, para manejar flotantes y enteros de forma consistente
-        if not isinstance(value, Decimal):
-            # Usamos str(value) para la conversión a Decimal para evitar problemas de precisión con floats
-            value = Decimal(str(value))
-
-        # Determinar si el número es un entero para formatearlo sin decimales
-        is_integer_value = (value == value.to_integral_value())
-
-        # Formatear el número manualmente para asegurar el formato europeo
-        # Primero, obtenemos la parte entera y la parte decimal
-        if is_integer_value:
-            integer_part_str = str(int(value.to_integral_value()))
-            decimal_part_str = ""
-        else:
-            # Redondear a dos decimales de forma explícita para evitar muchos decimales
-            value = value.quantize(Decimal('0.01'))
-            s = str(value)
-            if '.' in s:
-                parts = s.split('.')
-                integer_part_str = parts[0]
-                decimal_part_str = parts[1]
-            else: # Debería ser ya Decimal con .00 si no había parte decimal explícita
-                integer_part_str = s
-                decimal_part_str = "00"
-
-        # Añadir separadores de miles (puntos) a la parte entera
-        formatted_integer_part = []
-        n_digits = len(integer_part_str)
-        for i, digit in enumerate(integer_part_str):
-            formatted_integer_part.append(digit)
-            # Añadir punto cada 3 dígitos desde la derecha, sin añadirlo al principio
-            if (n_digits - (i + 1)) % 3 == 0 and (n_digits - (i + 1)) != 0:
-                formatted_integer_part.append('.')
-        
-        formatted_integer_part_str = "".join(formatted_integer_part)
-
-        # Unir las partes con coma decimal si hay decimales, y añadir el símbolo de euro
-        if is_integer_value:
-            return f"{formatted_integer_part_str} €"
-        else:
-            return f"{formatted_integer_part_str},{decimal_part_str} €"
-
-    except (ValueError, TypeError, AttributeError, InvalidOperation) as e:
+        return _euro_format_cached(value)
+    except (ValueError, TypeError, AttributeError, InvalidOperation, OverflowError) as e:
         # Esto capturará errores de conversión o de operación con Decimal
-        print(f"ERROR EuroFormat: Error en euro_format para valor '{value}' (Tipo: {type(value)}): {e}") # Mantener temporalmente para depuración
+        print(f"ERROR EuroFormat: Error en euro_format para valor '{value}' (Tipo: {type(value)}): {e}")
         return "N/A"
-    except Exception as e:
-        print(f"ERROR EuroFormat: Error inesperado en euro_format para valor '{value}' (Tipo: {type(value)}): {e}") # Otro tipo de error
+
+def euro_format_many(values):
+    """Formatea una columna entera de importes (cada valor distinto una sola vez)."""
+    values = list(values)
+    formatted = {}
+    for value in values:
+        if value not in formatted:
+            formatted[value] = euro_format(value)
+    return [formatted[value] for value in values]
+
+def format_listing_amounts(cards, columns=('facturacion', 'precio_venta')):
+    """
+    Formatea de una vez los importes de una página del listado, columna a columna,
+    antes de renderizar. Devuelve {id: {columna: texto}}; los nulos quedan como None.
+    """
+    amounts = {card.id: {} for card in cards}
+    for column in columns:
+        values = [getattr(card, column) for card in cards]
+        present = [v for v in values if v is not None]
+        texts = iter(euro_format_many(present))
+        for card, value in zip(cards, values):
+            amounts[card.id][column] = next(texts) if value is not None else None
+    return amounts
+
+def _euro_format_legacy(value):
+    """Implementación anterior del filtro; solo se usa como referencia en 'flask euro-format-bench'."""
+    if value is None:
         return "N/A"
+    if not isinstance(value, Decimal):
+        value = Decimal(str(value))
+    is_integer_value = (value == value.to_integral_value())
+    if is_integer_value:
+        integer_part_str = str(int(value.to_integral_value()))
+        decimal_part_str = ""
+    else:
+        integer_part_str, decimal_part_str = str(value.quantize(Decimal('0.01'))).split('.')
+    formatted_integer_part = []
+    n_digits = len(integer_part_str)
+    for i, digit in enumerate(integer_part_str):
+        formatted_integer_part.append(digit)
+        if (n_digits - (i + 1)) % 3 == 0 and (n_digits - (i + 1)) != 0:
+            formatted_integer_part.append('.')
+    formatted_integer_part_str = "".join(formatted_integer_part)
+    if is_integer_value:
+        return f"{formatted_integer_part_str} €"
+    return f"{formatted_integer_part_str},{decimal_part_str} €"
+
+@app.cli.command('euro-format-bench')
+@click.option('--n', 'count', type=int, default=100000, show_default=True, help='Número de importes.')
+@click.option('--distintos', type=int, default=2000, show_default=True, help='Importes distintos entre los que se reparten.')
+def euro_format_bench_command(count, distintos):
+    """Compara el filtro euro_format actual con la implementación anterior."""
+    import random
+    rng = random.Random(42)
+    # Mezcla parecida a la de los anuncios: precios redondos (Decimal de NUMERIC), con céntimos y enteros
+    pool = []
+    for i in range(distintos):
+        kind = i % 10
+        if kind < 6:
+            pool.append(Decimal(rng.randrange(10, 5000) * 1000))
+        elif kind < 9:
+            pool.append(Decimal(rng.randrange(100, 100000000)) / 100)
+        else:
+            pool.append(rng.randrange(0, 10000000))
+    values = [rng.choice(pool) for _ in range(count)]
+
+    mismatches = sum(1 for v in pool if euro_format(v) != _euro_format_legacy(v))
+    results = []
+    for name, run in (
+        ('anterior', lambda: [_euro_format_legacy(v) for v in values]),
+        ('sin caché', lambda: [_euro_format_uncached(v) for v in values]),
+        ('euro_format', lambda: [euro_format(v) for v in values]),
+        ('euro_format_many', lambda: euro_format_many(values)),
+    ):
+        _euro_format_cached.cache_clear()
+        start = time.perf_counter()
+        run()
+        results.append((name, time.perf_counter() - start))
+    base = results[0][1]
+    for name, elapsed in results:
+        click.echo(f"{name:>18}: {elapsed * 1000:9.1f} ms  ({elapsed / count * 1e9:7.0f} ns/valor, x{base / elapsed:.1f})")
+    click.echo(f"{count} importes, {distintos} distintos, {mismatches} diferencias con la implementación anterior.")
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DEL FORMATO DE IMPORTES (EUROS)
+# -------------------------------------------------------------
 
 
 # TOKEN DE ADMINISTRADOR
@@ -319,80 +1692,1193 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Rutas de la aplicación
-@app.route('/')
-def index():
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE RECURSOS ESTÁTICOS (HUELLAS Y PRECOMPRESIÓN)
+# ---------------------------------------------------------------
+# 'flask assets-build' (paso de build) copia cada archivo de static/ a static/dist/ con
+# la huella de su contenido en el nombre (css/style.3f2a9c1b0d.css), escribe al lado
+# las versiones .gz y .br de los archivos de texto y un manifest.json con la
+# correspondencia. Con el manifiesto cargado, url_for('static', ...) apunta a la copia
+# con huella, que se sirve con Cache-Control immutable: un cambio en el archivo es
+# otra URL. Los url(...) relativos de las hojas CSS se reescriben para apuntar a las
+# copias con huella. Sin manifiesto, o en modo debug, todo funciona como antes.
+
+STATIC_DIST_DIR = 'dist'
+STATIC_DIST_PATH = os.path.join(app.static_folder, STATIC_DIST_DIR)
+STATIC_MANIFEST_PATH = os.path.join(STATIC_DIST_PATH, 'manifest.json')
+STATIC_IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+# Archivos que se publican con su nombre fijo (los piden los buscadores por esa ruta)
+STATIC_UNHASHED_FILES = {'robots.txt'}
+STATIC_COMPRESSIBLE_EXTENSIONS = {'.css', '.js', '.svg', '.ico', '.json', '.txt', '.xml', '.webmanifest', '.map'}
+# Desactivar (=0) para que Flask sirva también static/dist/ (sin versiones precomprimidas)
+STATIC_MIDDLEWARE_ENABLED = os.environ.get('STATIC_MIDDLEWARE', '1') != '0'
+
+CSS_URL_RE = re.compile(rb"""url\(\s*(['"]?)([^'")]+?)\1\s*\)""")
+
+def hashed_static_name(filename, content):
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.{hashlib.sha256(content).hexdigest()[:10]}{ext}"
+
+def rewrite_css_urls(filename, content, manifest):
+    """
+    Reescribe los url(...) relativos de una hoja CSS (filename, relativo a static/) para
+    que funcionen desde su copia en static/dist/: los archivos del manifiesto pasan a su
+    nombre con huella y el resto apunta al original fuera de dist/.
+    """
+    css_dir = posixpath.dirname(filename)
+
+    def replace(match):
+        quote_char, url = match.group(1), match.group(2).decode('utf-8')
+        if url.startswith(('data:', '/', '#')) or '://' in url:
+            return match.group(0)
+        path, suffix = re.match(r'([^?#]*)(.*)', url).groups() # suffix: ?consulta o #fragmento
+        target = posixpath.normpath(posixpath.join(css_dir, path))
+        if target in manifest:
+            new_path = posixpath.relpath(manifest[target], css_dir or '.')
+        else:
+            new_path = posixpath.relpath(target, posixpath.join(STATIC_DIST_DIR, css_dir))
+        return b'url(' + quote_char + (new_path + suffix).encode('utf-8') + quote_char + b')'
+
+    return CSS_URL_RE.sub(replace, content)
+
+def build_static_assets(source_dir=app.static_folder, dist_dir=STATIC_DIST_PATH):
+    """
+    Genera static/dist/ desde cero. Devuelve el manifiesto {original: con huella}.
+    Las hojas CSS se procesan al final, con sus url(...) ya reescritos, para que su
+    huella cambie también cuando cambia una imagen que referencian.
+    Solo se escriben las versiones comprimidas que ahorran al menos un 10 %.
+    """
+    if os.path.isdir(dist_dir):
+        shutil.rmtree(dist_dir)
+    sources = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != dist_dir)
+        for name in sorted(files):
+            filename = os.path.relpath(os.path.join(root, name), source_dir).replace(os.sep, '/')
+            if filename in STATIC_UNHASHED_FILES or name.startswith('.'):
+                continue
+            sources.append(filename)
+    sources.sort(key=lambda filename: filename.endswith('.css'))
+
+    manifest = {}
+    for filename in sources:
+        with open(os.path.join(source_dir, filename), 'rb') as f:
+            content = f.read()
+        if filename.endswith('.css'):
+            content = rewrite_css_urls(filename, content, manifest)
+        hashed = hashed_static_name(filename, content)
+        target = os.path.join(dist_dir, hashed)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, 'wb') as f:
+            f.write(content)
+        if os.path.splitext(filename)[1].lower() in STATIC_COMPRESSIBLE_EXTENSIONS:
+            compressed = {'.gz': gzip.compress(content, 9, mtime=0)}
+            if brotli is not None:
+                compressed['.br'] = brotli.compress(content, quality=11)
+            for suffix, data in compressed.items():
+                if len(data) <= len(content) * 0.9:
+                    with open(target + suffix, 'wb') as f:
+                        f.write(data)
+        manifest[filename] = hashed
+    with open(os.path.join(dist_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    return manifest
+
+def load_static_manifest():
+    try:
+        with open(STATIC_MANIFEST_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        print(f"ERROR Estáticos: No se pudo leer {STATIC_MANIFEST_PATH}: {e}")
+        return {}
+
+# En modo debug se ignora el manifiesto: los cambios en static/ se ven sin volver a
+# ejecutar 'flask assets-build' (la copia de dist/ se quedaría desactualizada)
+STATIC_MANIFEST = {} if app.debug else load_static_manifest()
+
+@app.url_defaults
+def hashed_static_url(endpoint, values):
+    """url_for('static', filename='css/style.css') -> /static/dist/css/style.<huella>.css"""
+    # app.debug se comprueba también aquí: app.run(debug=True) lo activa después de importar
+    if endpoint == 'static' and STATIC_MANIFEST and not app.debug:
+        hashed = STATIC_MANIFEST.get(values.get('filename'))
+        if hashed:
+            values['filename'] = f"{STATIC_DIST_DIR}/{hashed}"
+
+@app.after_request
+def immutable_static_headers(response):
+    # Solo entra aquí si el middleware está desactivado: Flask sirve static/dist/ directamente
+    if request.endpoint == 'static' and request.view_args.get('filename', '').startswith(STATIC_DIST_DIR + '/'):
+        response.headers['Cache-Control'] = STATIC_IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+class StaticAssetsMiddleware:
+    """
+    Middleware WSGI que sirve static/dist/ sin pasar por Flask (ni su enrutado, ni
+    before_request, ni la sesión). Elige la versión .br o .gz según Accept-Encoding y
+    responde 304 a los If-None-Match. Solo conoce los archivos del manifiesto; el
+    resto de peticiones siguen hacia la aplicación.
+    """
+
+    def __init__(self, wsgi_app, manifest, directory, url_prefix):
+        self.wsgi_app = wsgi_app
+        self.url_prefix = url_prefix
+        self.files = {}
+        for hashed in manifest.values():
+            path = os.path.join(directory, hashed)
+            variants = {'identity': path}
+            for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+                if os.path.exists(path + suffix):
+                    variants[encoding] = path + suffix
+            self.files[hashed] = (mimetypes.guess_type(hashed)[0] or 'application/octet-stream', variants)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        entry = self.files.get(path[len(self.url_prefix):]) if path.startswith(self.url_prefix) else None
+        if entry is None or environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            return self.wsgi_app(environ, start_response)
+
+        mimetype, variants = entry
+        req = WerkzeugRequest(environ)
+        encoding = next((e for e in ('br', 'gzip') if e in variants and req.accept_encodings[e]), 'identity')
+        # La huella ya está en el nombre: basta con añadir la codificación
+        etag = f"{os.path.basename(path)}-{encoding}"
+        if req.if_none_match.contains(etag):
+            response = WerkzeugResponse(status=304)
+        else:
+            if req.method == 'HEAD':
+                response = WerkzeugResponse(mimetype=mimetype)
+            else:
+                response = WerkzeugResponse(wrap_file(environ, open(variants[encoding], 'rb')),
+                                            mimetype=mimetype, direct_passthrough=True)
+            response.content_length = os.path.getsize(variants[encoding])
+            if encoding != 'identity':
+                response.headers['Content-Encoding'] = encoding
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = STATIC_IMMUTABLE_CACHE_CONTROL
+        if len(variants) > 1:
+            response.headers['Vary'] = 'Accept-Encoding'
+        return response(environ, start_response)
+
+if STATIC_MIDDLEWARE_ENABLED and STATIC_MANIFEST:
+    app.wsgi_app = StaticAssetsMiddleware(app.wsgi_app, STATIC_MANIFEST, STATIC_DIST_PATH,
+                                          f"{app.static_url_path}/{STATIC_DIST_DIR}/")
+
+@app.cli.command('assets-build')
+def assets_build_command():
+    """Genera static/dist/: copias con huella, versiones gzip/brotli y manifest.json."""
+    manifest = build_static_assets()
+    click.echo(f"INFO Estáticos: {len(manifest)} archivos con huella en {STATIC_DIST_PATH}"
+               f"{'' if brotli is not None else ' (sin brotli: falta el paquete Brotli)'}.")
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE RECURSOS ESTÁTICOS (HUELLAS Y PRECOMPRESIÓN)
+# -------------------------------------------------------------
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE COMPRESIÓN DE RESPUESTAS
+# ---------------------------------------------------------------
+# Las respuestas de texto (HTML, JSON, CSV, XML...) se comprimen con brotli o gzip
+# según Accept-Encoding. Las respuestas en streaming se comprimen trozo a trozo, con un
+# flush por trozo para no retrasar lo que ya se ha generado. Las páginas de la caché
+# guardan cada codificación junto al original, así una página solo se comprime una vez.
+
+# Desactivar (=0) si un proxy o CDN delante de gunicorn ya comprime
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION', '1') != '0'
+# Por debajo de este tamaño la compresión no compensa
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 500))
+COMPRESSION_MIMETYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/xml', 'text/javascript',
+    'application/json', 'application/x-ndjson', 'application/xml', 'application/javascript',
+}
+COMPRESSION_ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+# Niveles al vuelo (rápidos) y para las entradas de la caché (se comprimen una sola vez)
+COMPRESSION_LEVELS = {
+    'dynamic': {'gzip': 6, 'br': 4},
+    'cached': {'gzip': 9, 'br': 9},
+}
+
+def is_compressible(mimetype):
+    return COMPRESSION_ENABLED and mimetype in COMPRESSION_MIMETYPES
+
+def compress_body(data, encoding, levels='dynamic'):
+    level = COMPRESSION_LEVELS[levels][encoding]
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    return gzip.compress(data, level, mtime=0)
+
+class StreamCompressor:
+    """Compresor incremental: compress() devuelve lo que ya se puede enviar."""
+
+    def __init__(self, encoding, levels='dynamic'):
+        level = COMPRESSION_LEVELS[levels][encoding]
+        self.encoding = encoding
+        if encoding == 'br':
+            self._compressor = brotli.Compressor(quality=level)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # wbits=31: formato gzip
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self._compressor.process(data) + self._compressor.flush()
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self._compressor.finish()
+        return self._compressor.flush()
+
+def compress_stream(chunks, encoding, charset='utf-8'):
+    compressor = StreamCompressor(encoding)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        # Propaga el cierre (p. ej. cliente desconectado) al generador original
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+def add_vary_accept_encoding(response):
+    response.vary.add('Accept-Encoding')
+
+def set_encoded_body(response, body, encoding):
+    """Sustituye el cuerpo por su versión codificada y ajusta cabeceras y ETag."""
+    response.set_data(body)
+    add_vary_accept_encoding(response)
+    if encoding == 'identity':
+        return
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        # Un ETag fuerte identifica los bytes exactos: cada codificación necesita el suyo
+        response.set_etag(f"{etag}-{encoding}")
+
+@app.after_request
+def compress_response(response):
+    if (not is_compressible(response.mimetype)
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or response.status_code < 200 or response.status_code in (204, 206, 304)):
+        return response
+    if response.is_streamed:
+        encoding = negotiate_encoding(COMPRESSION_ENCODINGS)
+        add_vary_accept_encoding(response)
+        if encoding != 'identity':
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop('Content-Length', None)
+            response.headers['Content-Encoding'] = encoding
+        return response
+    data = response.get_data()
+    if len(data) < COMPRESSION_MIN_SIZE:
+        return response
+    encoding = negotiate_encoding(COMPRESSION_ENCODINGS)
+    if encoding == 'identity':
+        add_vary_accept_encoding(response)
+        return response
+    set_encoded_body(response, compress_body(data, encoding), encoding)
+    return response
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE COMPRESIÓN DE RESPUESTAS
+# -------------------------------------------------------------
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE CACHÉ DE PÁGINAS RENDERIZADAS
+# ---------------------------------------------------------------
+# Las páginas públicas (listado, detalle y blog) se guardan ya renderizadas, con clave
+# ruta + argumentos normalizados. Cada entrada lleva 'etiquetas' (p. ej. 'empresas',
+# 'empresa:42', 'blog'); las rutas de escritura llaman a invalidate_pages() con las
+# etiquetas afectadas, lo que sube su versión y deja obsoletas las entradas que la usaban.
+
+# Backend: 'lru' (memoria del proceso), 'redis' (compartido entre workers e instancias) o 'none'
+PAGE_CACHE_BACKEND = os.environ.get('PAGE_CACHE_BACKEND', 'lru')
+PAGE_CACHE_TTL = float(os.environ.get('PAGE_CACHE_TTL', 300))
+PAGE_CACHE_MAX_ENTRIES = int(os.environ.get('PAGE_CACHE_MAX_ENTRIES', 500))
+PAGE_CACHE_REDIS_URL = os.environ.get('PAGE_CACHE_REDIS_URL')
+# Carpeta donde el backend 'lru' guarda las versiones de las etiquetas. Es compartida por
+# todos los workers de la máquina, así una invalidación en un worker llega a los demás.
+PAGE_CACHE_DIR = os.environ.get('PAGE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'pymemarket-page-cache'))
+
+
+class PageCacheStats:
+    """Contadores por proceso de la caché de páginas."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def incr(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def snapshot(self):
+        with self._lock:
+            data = dict(self.counters)
+        lookups = data.get('hits', 0) + data.get('misses', 0)
+        data['hit_ratio'] = round(data.get('hits', 0) / lookups, 4) if lookups else None
+        return data
+
+
+class FileTagVersions:
+    """Versiones de las etiquetas guardadas como ficheros (una marca de tiempo por etiqueta)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, tag):
+        return os.path.join(self.directory, hashlib.sha1(tag.encode('utf-8')).hexdigest())
+
+    def get(self, tags):
+        versions = {}
+        for tag in tags:
+            try:
+                versions[tag] = os.stat(self._path(tag)).st_mtime_ns
+            except FileNotFoundError:
+                versions[tag] = 0
+        return versions
+
+    def bump(self, tags):
+        now = time.time_ns()
+        for tag in tags:
+            path = self._path(tag)
+            with open(path, 'a'):
+                pass
+            os.utime(path, ns=(now, now))
+
+
+class LRUPageCache:
+    """Caché en memoria del proceso, limitada en número de entradas y con TTL."""
+
+    def __init__(self, max_entries, ttl, tag_versions):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.tag_versions = tag_versions
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            expires_at, entry = item
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def add_body(self, key, entry, encoding, body):
+        """Añade una codificación a una entrada ya guardada sin renovar su TTL."""
+        with self._lock:
+            item = self._entries.get(key)
+            if item is not None and item[1] is entry:
+                entry['bodies'][encoding] = body
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisTagVersions:
+    """Versiones de las etiquetas como contadores de Redis (INCR)."""
+
+    def __init__(self, client, prefix):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, tags):
+        tags = list(tags)
+        values = self.client.mget([self.prefix + tag for tag in tags]) if tags else []
+        return {tag: int(value or 0) for tag, value in zip(tags, values)}
+
+    def bump(self, tags):
+        pipe = self.client.pipeline()
+        for tag in tags:
+            pipe.incr(self.prefix + tag)
+        pipe.execute()
+
+
+class RedisPageCache:
+    """Caché compartida en Redis entre workers e instancias."""
+
+    def __init__(self, url, ttl):
+        import redis # Dependencia opcional: solo necesaria con PAGE_CACHE_BACKEND=redis
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = 'pymemarket:page:'
+        self.tag_versions = RedisTagVersions(self.client, 'pymemarket:tag:')
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        if raw is None:
+            return None
+        entry = json.loads(raw)
+        entry['bodies'] = {enc: base64.b64decode(body) for enc, body in entry['bodies'].items()}
+        return entry
+
+    def set(self, key, entry, ttl=None):
+        data = dict(entry, bodies={enc: base64.b64encode(body).decode('ascii') for enc, body in entry['bodies'].items()})
+        self.client.set(self.prefix + key, json.dumps(data), ex=int(ttl or self.ttl))
+
+    def add_body(self, key, entry, encoding, body):
+        """Añade una codificación a una entrada ya guardada sin renovar su TTL."""
+        ttl = self.client.ttl(self.prefix + key)
+        if ttl and ttl > 0:
+            self.set(key, dict(entry, bodies=dict(entry['bodies'], **{encoding: body})), ttl=ttl)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+def create_page_cache():
+    try:
+        if PAGE_CACHE_BACKEND == 'redis' and PAGE_CACHE_REDIS_URL:
+            return RedisPageCache(PAGE_CACHE_REDIS_URL, PAGE_CACHE_TTL)
+        if PAGE_CACHE_BACKEND == 'lru':
+            return LRUPageCache(PAGE_CACHE_MAX_ENTRIES, PAGE_CACHE_TTL, FileTagVersions(PAGE_CACHE_DIR))
+    except Exception as e:
+        print(f"ERROR Caché: No se pudo inicializar la caché de páginas ({PAGE_CACHE_BACKEND}): {e}")
+    return None
+
+page_cache = create_page_cache()
+page_cache_stats = PageCacheStats()
+
+# Cabeceras de la vista que no se guardan con la página: las calcula de nuevo cada respuesta
+# (longitud, codificación, tipo) o son de un visitante concreto (cookies)
+PAGE_CACHE_SKIPPED_HEADERS = {'content-length', 'content-encoding', 'content-type', 'set-cookie'}
+
+# Argumentos de la URL que nunca forman parte de la clave (no cambian el contenido)
+PAGE_CACHE_IGNORED_ARGS = {'utm_source', 'utm_medium', 'utm_campaign', 'utm_term', 'utm_content', 'gclid', 'fbclid'}
+
+def page_cache_key():
+    """Clave normalizada: ruta + argumentos ordenados, sin valores vacíos ni de seguimiento."""
+    args = sorted((k, v) for k, values in request.args.lists() for v in values
+                  if v != '' and k not in PAGE_CACHE_IGNORED_ARGS)
+    # La versión de las plantillas y estáticos también forma parte de la clave: tras un despliegue
+    # no se sirve HTML cacheado (p. ej. en Redis) que apunte a recursos con huellas antiguas.
+    raw = request.path + '?' + urlencode(args) + '#' + TEMPLATES_VERSION
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+def invalidate_pages(*tags):
+    """Deja obsoletas todas las páginas cacheadas con alguna de estas etiquetas."""
+    if page_cache is None or not tags:
+        return
+    try:
+        page_cache.tag_versions.bump(tags)
+        page_cache_stats.incr('invalidations', len(tags))
+    except Exception as e:
+        print(f"ERROR Caché: No se pudieron invalidar {tags}: {e}")
+
+def page_cache_encoding(mimetype, identity):
+    """Codificación con la que servir una página cacheada a este cliente."""
+    if not is_compressible(mimetype) or len(identity) < COMPRESSION_MIN_SIZE:
+        return 'identity'
+    return negotiate_encoding(COMPRESSION_ENCODINGS)
+
+def cached_page(*tags):
+    """
+    Decorador para vistas GET públicas. Cada etiqueta es un texto o una función que
+    recibe los argumentos de la ruta (p. ej. lambda empresa_id: f'empresa:{empresa_id}').
+    Solo se guardan respuestas 200 sin mensajes flash ni cambios de sesión, para no
+    servir a un visitante contenido pensado para otro.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if page_cache is None or request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+
+            entry_tags = [tag(**kwargs) if callable(tag) else tag for tag in tags]
+            key = page_cache_key()
+            try:
+                # Las versiones se leen antes de renderizar: si hay una invalidación durante
+                # el renderizado, la entrada guardada ya nacerá obsoleta.
+                versions = page_cache.tag_versions.get(entry_tags)
+                entry = page_cache.get(key)
+            except Exception as e:
+                print(f"ERROR Caché: Error al leer la caché de páginas: {e}")
+                return view(*args, **kwargs)
+
+            if entry is not None and entry['versions'] == versions:
+                page_cache_stats.incr('hits')
+                encoding = page_cache_encoding(entry['mimetype'], entry['bodies']['identity'])
+                body = entry['bodies'].get(encoding)
+                if body is None:
+                    # Primera vez que un cliente pide esta codificación: se comprime y se guarda
+                    body = compress_body(entry['bodies']['identity'], encoding, 'cached')
+                    page_cache_stats.incr('compressions')
+                    try:
+                        page_cache.add_body(key, entry, encoding, body)
+                    except Exception as e:
+                        print(f"ERROR Caché: Error al guardar la versión {encoding} en la caché de páginas: {e}")
+                response = Response(status=entry['status'], mimetype=entry['mimetype'],
+                                    headers=entry.get('headers', ()))
+                set_encoded_body(response, body, encoding)
+                response.headers['X-Page-Cache'] = 'HIT'
+                return response
+
+            page_cache_stats.incr('misses')
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not response.direct_passthrough and not session.modified:
+                identity = response.get_data()
+                bodies = {'identity': identity}
+                encoding = page_cache_encoding(response.mimetype, identity)
+                if encoding != 'identity':
+                    bodies[encoding] = compress_body(identity, encoding, 'cached')
+                    page_cache_stats.incr('compressions')
+                try:
+                    page_cache.set(key, {
+                        'status': response.status_code,
+                        'mimetype': response.mimetype,
+                        'headers': [(name, value) for name, value in response.headers.items()
+                                    if name.lower() not in PAGE_CACHE_SKIPPED_HEADERS],
+                        'versions': versions,
+                        'bodies': bodies,
+                    })
+                    page_cache_stats.incr('stores')
+                except Exception as e:
+                    print(f"ERROR Caché: Error al guardar en la caché de páginas: {e}")
+                # Ya comprimida: compress_response la deja pasar por su Content-Encoding
+                set_encoded_body(response, bodies[encoding], encoding)
+            response.headers['X-Page-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE CACHÉ DE PÁGINAS RENDERIZADAS
+# -------------------------------------------------------------
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE PETICIONES CONDICIONALES (ETAG / 304)
+# ---------------------------------------------------------------
+# Antes de renderizar, una consulta barata obtiene la fecha de modificación del
+# contenido. Si el navegador o la CDN ya tienen esa versión (If-None-Match /
+# If-Modified-Since) se responde 304 sin tocar la plantilla.
+
+# Cache-Control de las páginas públicas: poco tiempo en el navegador, más en la CDN
+PUBLIC_PAGE_BROWSER_MAX_AGE = int(os.environ.get('PUBLIC_PAGE_BROWSER_MAX_AGE', 60))
+PUBLIC_PAGE_CDN_MAX_AGE = int(os.environ.get('PUBLIC_PAGE_CDN_MAX_AGE', 300))
+PUBLIC_PAGE_CACHE_CONTROL = (f"public, max-age={PUBLIC_PAGE_BROWSER_MAX_AGE}, s-maxage={PUBLIC_PAGE_CDN_MAX_AGE}, "
+                             f"stale-while-revalidate={PUBLIC_PAGE_BROWSER_MAX_AGE}")
+
+def compute_templates_version():
+    """
+    Huella de las plantillas y del manifiesto de estáticos: cambia el ETag de todas
+    las páginas al desplegar cambios de diseño o nuevas huellas de CSS/JS.
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps(STATIC_MANIFEST, sort_keys=True).encode('utf-8'))
+    templates_dir = os.path.join(app.root_path, app.template_folder)
+    for root, _, files in sorted(os.walk(templates_dir)):
+        for name in sorted(files):
+            with open(os.path.join(root, name), 'rb') as f:
+                digest.update(name.encode('utf-8'))
+                digest.update(f.read())
+    return digest.hexdigest()[:12]
+
+TEMPLATES_VERSION = compute_templates_version()
+
+def as_utc(value):
+    """Las columnas TIMESTAMP se guardan sin zona horaria (UTC en el servidor)."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.replace(microsecond=0) # Last-Modified solo tiene precisión de segundos
+
+def build_etag(*parts):
+    raw = "|".join(str(p) for p in parts) + "|" + TEMPLATES_VERSION
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()[:24]
+
+def is_not_modified(etag, last_modified):
+    if request.if_none_match:
+        # If-None-Match tiene prioridad sobre If-Modified-Since (RFC 9110)
+        return request.if_none_match.contains_weak(etag)
+    if last_modified and request.if_modified_since:
+        return last_modified <= request.if_modified_since
+    return False
+
+def apply_validators(response, etag, last_modified):
+    response.set_etag(etag, weak=True)
+    if last_modified:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = PUBLIC_PAGE_CACHE_CONTROL
+    return response
+
+def conditional_page(validator):
+    """
+    Decorador para vistas GET públicas. validator(**argumentos_de_la_ruta) devuelve
+    (last_modified, partes_del_etag) o None si no se puede calcular (la vista se ejecuta sin más).
+    Con mensajes flash pendientes la página es personal y no se aplica nada.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method != 'GET' or session.get('_flashes'):
+                return view(*args, **kwargs)
+            try:
+                validators = validator(**kwargs)
+            except Exception as e:
+                print(f"ERROR Condicional: No se pudieron calcular los validadores de {request.path}: {e}")
+                validators = None
+            if validators is None:
+                return view(*args, **kwargs)
+
+            last_modified, etag_parts = validators
+            last_modified = as_utc(last_modified)
+            # La clave de caché normalizada distingue las variantes de la misma ruta por sus argumentos
+            etag = build_etag(request.path, page_cache_key(), *etag_parts)
+            if is_not_modified(etag, last_modified):
+                return apply_validators(Response(status=304), etag, last_modified)
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code == 200 and not session.modified:
+                apply_validators(response, etag, last_modified)
+            return response
+        return wrapper
+    return decorator
+
+def fetch_validator_row(query, params=()):
     conn = get_db_connection()
-    cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
+    cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+    try:
+        cur.execute(query, params)
+        return cur.fetchone()
+    finally:
+        cur.close()
+
+def empresa_validators(empresa_id):
+    # Las variantes de imagen se generan después de guardar y cambian el HTML sin tocar fecha_modificacion
+    row = fetch_validator_row(
+        "SELECT fecha_modificacion, imagen_variantes IS NOT NULL FROM empresas WHERE id = %s AND active = TRUE",
+        (empresa_id,))
+    if row is None:
+        return None # La vista redirige con un mensaje
+    return row[0], ('empresa', empresa_id, row[0].isoformat() if row[0] else '', row[1])
+
+def blog_post_validators(slug):
+    row = fetch_validator_row(
+        "SELECT id, COALESCE(updated_at, created_at) FROM blog_posts WHERE slug = %s AND is_published = TRUE", (slug,))
+    if row is None:
+        return None
+    return row[1], ('blog_post', row[0], row[1].isoformat() if row[1] else '')
+
+def blog_list_validators():
+    # count(*) detecta también borrados y despublicaciones, que no cambian el máximo
+    row = fetch_validator_row(
+        "SELECT max(COALESCE(updated_at, created_at)), count(*) FROM blog_posts WHERE is_published = TRUE")
+    return row[0], ('blog_list', row[0].isoformat() if row[0] else '', row[1])
+
+def sitemap_validators(**_):
+    empresas_lastmod, empresas_count, blog_lastmod, blog_count = get_sitemap_state()
+    last_modified = max((d for d in (empresas_lastmod, blog_lastmod) if d), default=None)
+    # Las URLs estáticas del sitemap llevan la fecha del día como lastmod
+    return last_modified, ('sitemap', empresas_lastmod, empresas_count, blog_lastmod, blog_count,
+                           datetime.now().date().isoformat())
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE PETICIONES CONDICIONALES (ETAG / 304)
+# -------------------------------------------------------------
+
+# ---------------------------------------------------------------
+# LISTADO PÚBLICO: FILTROS Y PAGINACIÓN POR CURSOR (KEYSET)
+# ---------------------------------------------------------------
+
+# Número de tarjetas por página del listado (se puede ajustar con ?per_page= hasta el máximo)
+LISTING_PAGE_SIZE = int(os.environ.get('LISTING_PAGE_SIZE', 24))
+LISTING_MAX_PAGE_SIZE = int(os.environ.get('LISTING_MAX_PAGE_SIZE', 60))
+# El total se cuenta como mucho hasta este valor ("más de N") y se cachea unos segundos por filtro
+LISTING_COUNT_CAP = int(os.environ.get('LISTING_COUNT_CAP', 1000))
+LISTING_COUNT_TTL = float(os.environ.get('LISTING_COUNT_TTL', 300))
+
+# Parámetros de la URL que son cursores y no filtros
+LISTING_CURSOR_ARGS = ('after', 'before')
+
+# Fila compacta para las tarjetas del listado: solo las columnas que muestra index.html
+# (más fecha_publicacion para el cursor). Evita traer descripcion, token_edicion, email_contacto...
+ListingCard = collections.namedtuple('ListingCard', [
+    'id', 'imagen_url', 'tipo_negocio', 'ubicacion', 'actividad', 'sector',
+    'facturacion', 'precio_venta', 'fecha_publicacion', 'imagen_variantes',
+])
+LISTING_CARD_COLUMNS = ", ".join(ListingCard._fields)
+
+# En modo búsqueda (?q=) las filas llevan además su relevancia, que también forma parte del cursor
+SearchCard = collections.namedtuple('SearchCard', ListingCard._fields + ('rango',))
+
+# Búsqueda por texto: longitud máxima de la consulta y similitud mínima (pg_trgm) para
+# reconocer una provincia escrita con erratas dentro de la consulta
+SEARCH_MAX_LENGTH = 200
+SEARCH_PROVINCE_SIMILARITY = float(os.environ.get('SEARCH_PROVINCE_SIMILARITY', 0.5))
+SEARCH_PROVINCE_MAX_WORDS = 4 # "Santa Cruz de Tenerife"
+
+# Consulta de búsqueda ya interpretada: texto libre y provincia reconocida en ella (o None)
+ListingSearch = collections.namedtuple('ListingSearch', ['texto', 'provincia'])
+
+_listing_count_cache = {} # clave de filtros -> (instante, total)
+_listing_count_lock = threading.Lock()
+
+def strip_accents(text):
+    return ''.join(c for c in unicodedata.normalize('NFD', text) if unicodedata.category(c) != 'Mn')
+
+def detect_search_province(cur, words):
+    """
+    Busca entre los grupos de palabras consecutivas de la consulta el que más se parece
+    (similitud de trigramas, sin tildes ni mayúsculas) a una provincia.
+    Devuelve (provincia, inicio, fin) sobre la lista de palabras, o None.
+    """
+    candidates = []
+    for size in range(1, SEARCH_PROVINCE_MAX_WORDS + 1):
+        for start in range(0, len(words) - size + 1):
+            fragment = strip_accents(" ".join(words[start:start + size])).lower()
+            if len(fragment) >= 4: # Palabras cortas ("de", "bar") dan falsos positivos
+                candidates.append((fragment, start, start + size))
+    if not candidates:
+        return None
+
+    provincias_normalizadas = [strip_accents(p).lower() for p in PROVINCIAS_ESPANA]
+    cur.execute("""
+        SELECT c.pos, p.nombre, similarity(c.fragmento, p.normalizada) AS sim
+        FROM unnest(%s::text[]) WITH ORDINALITY AS c(fragmento, pos)
+        CROSS JOIN unnest(%s::text[], %s::text[]) AS p(nombre, normalizada)
+        WHERE similarity(c.fragmento, p.normalizada) >= %s
+        ORDER BY sim DESC, length(c.fragmento) DESC
+        LIMIT 1
+    """, ([c[0] for c in candidates], PROVINCIAS_ESPANA, provincias_normalizadas, SEARCH_PROVINCE_SIMILARITY))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    _, start, end = candidates[row[0] - 1]
+    return row[1], start, end
+
+def parse_listing_search(cur, args):
+    """
+    Interpreta el parámetro 'q' del listado. Si la consulta nombra una provincia (aunque sea
+    con erratas) y no hay filtro de provincia, esa parte pasa a ser un filtro por ubicación
+    y el resto se busca como texto. Devuelve ListingSearch o None si no hay búsqueda.
+    """
+    q = (args.get('q') or '').strip()[:SEARCH_MAX_LENGTH]
+    if not q:
+        return None
+    words = q.split()
+    provincia = None
+    provincia_filter = args.get('provincia')
+    if not provincia_filter or provincia_filter == 'Todas':
+        detected = detect_search_province(cur, words)
+        if detected:
+            provincia, start, end = detected
+            words = words[:start] + words[end:]
+    return ListingSearch(" ".join(words), provincia)
+
+def listing_search_rank(search):
+    """
+    Expresión SQL de relevancia para el modo búsqueda: ts_rank_cd sobre la columna 'busqueda'
+    más la similitud del tipo de negocio. Devuelve (sql, params) o None si no hay texto.
+    """
+    if not search or not search.texto:
+        return None
+    return ("ts_rank_cd(busqueda, websearch_to_tsquery('spanish', %s)) + similarity(lower(tipo_negocio), lower(%s))",
+            [search.texto, search.texto])
+
+def build_empresas_conditions(args, search=None):
+    """
+    Condiciones del listado público a partir de los parámetros de la URL, cada una con la
+    dimensión a la que pertenece: [(dimensión, sql, params), ...]. Las facetas las necesitan
+    por separado para contar cada dimensión sin su propio filtro.
+    Con 'search' (ver parse_listing_search) añade la búsqueda por texto y la provincia reconocida.
+    """
+    actividad_filter = args.get('actividad')
+    sector_filter = args.get('sector')
+    provincia_filter = args.get('provincia')
+    
+    # MODIFICACIÓN: Leer los nuevos valores del deslizador de facturación
+    min_facturacion_filter = args.get('min_facturacion_slider')
+    max_facturacion_filter = args.get('max_facturacion_slider')
+
+    min_precio_filter = args.get('min_precio')
+    max_precio_filter = args.get('max_precio')
+
+    conditions = []
+
+    # FILTROS DE TEXTO
+    if actividad_filter and actividad_filter != 'Todas las actividades':
+        conditions.append(('actividad', "actividad = %s", [actividad_filter]))
+    if sector_filter and sector_filter != 'Todos los sectores':
+        conditions.append(('sector', "sector = %s", [sector_filter]))
+    if provincia_filter and provincia_filter != 'Todas':
+        conditions.append(('provincia', "ubicacion = %s", [provincia_filter]))
+
+    # FILTROS NUMÉRICOS (MODIFICADOS PARA EL DESLIZADOR DE FACTURACIÓN)
+    if min_facturacion_filter and min_facturacion_filter != '0': # Considerar 0 como el valor mínimo por defecto sin filtro
+        try:
+            conditions.append(('facturacion', "facturacion >= %s", [float(min_facturacion_filter)]))
+        except ValueError:
+            pass # Ignora si no es un número válido
+            
+    # Asume que el valor de `max_facturacion_filter` puede ser un valor grande (e.g., 1000000)
+    # y que un valor como 'infinito' o 'max' se manejaría en el front-end
+    if max_facturacion_filter and max_facturacion_filter != '10000000': # Ejemplo de valor máximo por defecto sin filtro
+        try:
+            conditions.append(('facturacion', "facturacion <= %s", [float(max_facturacion_filter)]))
+        except ValueError:
+            pass # Ignora si no es un número válido
+
+    # El mínimo de precio solo llega desde los enlaces de tramos de precio de las facetas
+    if min_precio_filter:
+        try:
+            conditions.append(('precio', "precio_venta >= %s", [float(min_precio_filter)]))
+        except ValueError:
+            pass # Ignora si no es un número válido
+    if max_precio_filter:
+        try:
+            conditions.append(('precio', "precio_venta <= %s", [float(max_precio_filter)]))
+        except ValueError:
+            pass # Ignora si no es un número válido
+
+    # BÚSQUEDA POR TEXTO: índice GIN de 'busqueda' o, para erratas, trigramas del tipo de negocio
+    if search:
+        if search.provincia:
+            conditions.append(('provincia', "ubicacion = %s", [search.provincia]))
+        if search.texto:
+            conditions.append(('busqueda',
+                               "(busqueda @@ websearch_to_tsquery('spanish', %s) OR lower(tipo_negocio) %% lower(%s))",
+                               [search.texto, search.texto]))
+
+    return conditions
+
+def build_empresas_filters(args, search=None):
+    """
+    Construye la cláusula WHERE del listado público a partir de los parámetros de la URL.
+    Devuelve (sql, params) listo para concatenar tras "FROM empresas".
+    """
+    query = " WHERE active = TRUE"
+    params = []
+    for _, condition_sql, condition_params in build_empresas_conditions(args, search):
+        query += " AND " + condition_sql
+        params.extend(condition_params)
+    return query, params
+
+def encode_listing_cursor(fecha_publicacion, empresa_id, rango=None):
+    """
+    Codifica la posición (fecha_publicacion, id) de una tarjeta en un token opaco para la URL.
+    En modo búsqueda la posición empieza por la relevancia: (rango, fecha_publicacion, id).
+    """
+    raw = f"{fecha_publicacion.isoformat()}|{empresa_id}"
+    if rango is not None:
+        raw = f"{rango!r}|{raw}"
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_listing_cursor(token):
+    """Devuelve (fecha_publicacion, id), (rango, fecha_publicacion, id) o None si el cursor no es válido."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        parts = raw.split('|')
+        if len(parts) == 3:
+            return float(parts[0]), datetime.fromisoformat(parts[1]), int(parts[2])
+        fecha_str, id_str = parts
+        return datetime.fromisoformat(fecha_str), int(id_str)
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return None
+
+def listing_row_cursor(row):
+    """Cursor que apunta a una fila de fetch_empresas_page (ListingCard o SearchCard)."""
+    return encode_listing_cursor(row.fecha_publicacion, row.id, getattr(row, 'rango', None))
+
+def get_listing_page_size(args, max_page_size=LISTING_MAX_PAGE_SIZE):
+    try:
+        page_size = int(args.get('per_page', LISTING_PAGE_SIZE))
+    except (TypeError, ValueError):
+        page_size = LISTING_PAGE_SIZE
+    return min(max(page_size, 1), max_page_size)
+
+def build_empresas_page_query(columns, where_sql, params, page_size, after=None, before=None, rank=None):
+    """
+    Consulta de una página del listado por cursor (keyset) con las columnas indicadas,
+    ordenada por (fecha_publicacion DESC, id DESC) o, con rank=(sql, params) (ver
+    listing_search_rank), por (rango DESC, fecha_publicacion DESC, id DESC) añadiendo 'rango'
+    como última columna. Pide page_size + 1 filas para saber si hay más.
+    Devuelve (sql, params, after, before) con los cursores que no encajan con el modo anulados.
+    """
+    if rank:
+        # La relevancia es una expresión: se calcula en una subconsulta para poder paginar sobre ella
+        rank_sql, rank_params = rank
+        query = (f"SELECT * FROM (SELECT {columns}, {rank_sql} AS rango FROM empresas{where_sql})"
+                 f" AS resultados WHERE TRUE")
+        params = list(rank_params) + list(params)
+        order_columns = ['rango', 'fecha_publicacion', 'id']
+    else:
+        query = f"SELECT {columns} FROM empresas" + where_sql
+        params = list(params)
+        order_columns = ['fecha_publicacion', 'id']
+    # Un cursor de otro modo (con o sin rango) no sirve: se empieza desde el principio
+    if after and len(after) != len(order_columns):
+        after = None
+    if before and len(before) != len(order_columns):
+        before = None
+
+    key_sql = f"({', '.join(order_columns)})"
+    placeholders = f"({', '.join(['%s'] * len(order_columns))})"
+    if before:
+        # Página anterior: recorremos hacia las más nuevas y hay que dar la vuelta al resultado
+        query += f" AND {key_sql} > {placeholders} ORDER BY {', '.join(c + ' ASC' for c in order_columns)} LIMIT %s"
+        params.extend(list(before) + [page_size + 1])
+    else:
+        if after:
+            query += f" AND {key_sql} < {placeholders}"
+            params.extend(after)
+        query += f" ORDER BY {', '.join(c + ' DESC' for c in order_columns)} LIMIT %s"
+        params.append(page_size + 1)
+    return query, params, after, before
+
+def fetch_empresas_page(cur, where_sql, params, page_size, after=None, before=None, rank=None):
+    """
+    Obtiene una página de ListingCard ordenada por (fecha_publicacion DESC, id DESC)
+    usando paginación por cursor: el coste no depende de lo lejos que esté la página.
+    Con rank (búsqueda por texto) devuelve SearchCard y los cursores deben incluir el rango.
+    El cursor debe devolver tuplas simples (no DictCursor).
+    Devuelve (filas, hay_más_nuevas, hay_más_antiguas).
+    """
+    card = SearchCard if rank else ListingCard
+    query, params, after, before = build_empresas_page_query(LISTING_CARD_COLUMNS, where_sql, params,
+                                                            page_size, after, before, rank)
+    cur.execute(query, params)
+    rows = cur.fetchall()
+    has_extra = len(rows) > page_size
+    rows = [card._make(row) for row in rows[:page_size]]
 
-    actividad_filter = request.args.get('actividad')
-    sector_filter = request.args.get('sector')
-    provincia_filter = request.args.get('provincia')
-    
-    # MODIFICACIÓN: Leer los nuevos valores del deslizador de facturación
-    min_facturacion_filter = request.args.get('min_facturacion_slider')
-    max_facturacion_filter = request.args.get('max_facturacion_slider')
+    if before:
+        rows.reverse()
+        return rows, has_extra, True
+    return rows, after is not None, has_extra
 
-    max_precio_filter = request.args.get('max_precio')
+def estimate_empresas_count(cur, where_sql, params):
+    """
+    Cuenta los anuncios que cumplen los filtros sin un COUNT(*) completo en cada visita:
+    el recuento se corta en LISTING_COUNT_CAP y se cachea LISTING_COUNT_TTL segundos.
+    Devuelve (total, es_mínimo) donde es_mínimo indica que hay al menos 'total'.
+    """
+    key = (where_sql, tuple(params))
+    now = time.monotonic()
+    with _listing_count_lock:
+        cached = _listing_count_cache.get(key)
+    if cached and now - cached[0] < LISTING_COUNT_TTL:
+        total = cached[1]
+    else:
+        cur.execute(f"SELECT count(*) FROM (SELECT 1 FROM empresas{where_sql} LIMIT %s) AS capped",
+                    list(params) + [LISTING_COUNT_CAP + 1])
+        total = cur.fetchone()[0]
+        with _listing_count_lock:
+            if len(_listing_count_cache) > 1000:
+                _listing_count_cache.clear()
+            _listing_count_cache[key] = (now, total)
+    if total > LISTING_COUNT_CAP:
+        return LISTING_COUNT_CAP, True
+    return total, False
 
-    query = "SELECT * FROM empresas WHERE active = TRUE"
-    params = []
+# ---------------------------------------------------------------
+# FACETAS DEL FORMULARIO DE FILTROS
+# ---------------------------------------------------------------
+# Recuentos por actividad, sector, provincia y tramos de precio y facturación para los
+# filtros actuales, en una sola consulta con GROUPING SETS. Cada faceta se cuenta con todos
+# los filtros menos el suyo (así el desplegable sigue mostrando las alternativas), usando
+# count(*) FILTER sobre columnas booleanas que indican qué filtros cumple cada fila.
+
+LISTING_FACETS_TTL = float(os.environ.get('LISTING_FACETS_TTL', 60))
+
+# Tramos [mínimo, máximo) en euros; el último no tiene máximo
+PRECIO_TRAMOS = [0, 50000, 100000, 250000, 500000, 1000000]
+FACTURACION_TRAMOS = [0, 100000, 250000, 500000, 1000000, 5000000]
+
+# Dimensiones de las facetas y filtros que se ignoran al contar cada una. La actividad
+# ignora también el sector, que depende de ella.
+FACET_IGNORED_FILTERS = {
+    'actividad': {'actividad', 'sector'},
+    'sector': {'sector'},
+    'provincia': {'provincia'},
+    'precio': {'precio'},
+    'facturacion': {'facturacion'},
+}
+FACET_FILTER_DIMENSIONS = ('actividad', 'sector', 'provincia', 'precio', 'facturacion')
 
-    # FILTROS DE TEXTO
-    if actividad_filter and actividad_filter != 'Todas las actividades':
-        query += " AND actividad = %s"
-        params.append(actividad_filter)
-    if sector_filter and sector_filter != 'Todos los sectores':
-        query += " AND sector = %s"
-        params.append(sector_filter)
-    if provincia_filter and provincia_filter != 'Todas':
-        query += " AND ubicacion = %s"
-        params.append(provincia_filter)
+_listing_facets_cache = {} # clave de filtros -> (instante, facetas)
+_listing_facets_lock = threading.Lock()
 
-    # FILTROS NUMÉRICOS (MODIFICADOS PARA EL DESLIZADOR DE FACTURACIÓN)
-    if min_facturacion_filter and min_facturacion_filter != '0': # Considerar 0 como el valor mínimo por defecto sin filtro
-        try:
-            min_facturacion_filter = float(min_facturacion_filter)
-            query += " AND facturacion >= %s"
-            params.append(min_facturacion_filter)
-        except ValueError:
-            pass # Ignora si no es un número válido
-            
-    # Asume que el valor de `max_facturacion_filter` puede ser un valor grande (e.g., 1000000)
-    # y que un valor como 'infinito' o 'max' se manejaría en el front-end
-    if max_facturacion_filter and max_facturacion_filter != '10000000': # Ejemplo de valor máximo por defecto sin filtro
-        try:
-            max_facturacion_filter = float(max_facturacion_filter)
-            query += " AND facturacion <= %s"
-            params.append(max_facturacion_filter)
-        except ValueError:
-            pass # Ignora si no es un número válido
-            
-    if max_precio_filter:
-        try:
-            max_precio_filter = float(max_precio_filter)
-            query += " AND precio_venta <= %s"
-            params.append(max_precio_filter)
-        except ValueError:
-            pass # Ignora si no es un número válido
+def tramo_case_sql(column, tramos):
+    """CASE que devuelve el índice del tramo [tramos[i], tramos[i+1]) de la columna (NULL si no hay valor)."""
+    whens = " ".join(f"WHEN {column} < {limite} THEN {i}" for i, limite in enumerate(tramos[1:]))
+    return f"CASE WHEN {column} IS NULL THEN NULL {whens} ELSE {len(tramos) - 1} END"
 
-    query += " ORDER BY fecha_publicacion DESC"
-   
-    cur.execute(query, params)
-    empresas = cur.fetchall()
+def fetch_listing_facets(cur, conditions):
+    """
+    Ejecuta la consulta de facetas para las condiciones de build_empresas_conditions.
+    El cursor debe devolver tuplas simples. Devuelve un diccionario:
+    {'actividad': {nombre: n}, 'sector': {actividad: {sector: n}}, 'provincia': {nombre: n},
+     'precio': {tramo: n}, 'facturacion': {tramo: n}}
+    """
+    select_params = []
+    flags = []
+    for dimension in FACET_FILTER_DIMENSIONS:
+        parts = [sql for dim, sql, _ in conditions if dim == dimension]
+        for dim, _, params in conditions:
+            if dim == dimension:
+                select_params.extend(params)
+        flags.append(f"({' AND '.join(parts) if parts else 'TRUE'}) AS cumple_{dimension}")
+
+    # La búsqueda por texto no es una faceta: se aplica siempre en el WHERE
+    where_sql = " WHERE active = TRUE"
+    where_params = []
+    for dim, sql, params in conditions:
+        if dim not in FACET_FILTER_DIMENSIONS:
+            where_sql += " AND " + sql
+            where_params.extend(params)
+
+    counts = []
+    for facet, ignored in FACET_IGNORED_FILTERS.items():
+        applied = [f"cumple_{dim}" for dim in FACET_FILTER_DIMENSIONS if dim not in ignored]
+        counts.append(f"count(*) FILTER (WHERE {' AND '.join(applied)}) AS total_{facet}")
+
+    cur.execute(f"""
+        SELECT actividad, sector, ubicacion, tramo_precio, tramo_facturacion,
+               GROUPING(sector, ubicacion, tramo_precio, tramo_facturacion) AS agrupacion,
+               {', '.join(counts)}
+        FROM (
+            SELECT actividad, sector, ubicacion,
+                   {tramo_case_sql('precio_venta', PRECIO_TRAMOS)} AS tramo_precio,
+                   {tramo_case_sql('facturacion', FACTURACION_TRAMOS)} AS tramo_facturacion,
+                   {', '.join(flags)}
+            FROM empresas{where_sql}
+        ) AS filas
+        GROUP BY GROUPING SETS ((actividad), (actividad, sector), (ubicacion), (tramo_precio), (tramo_facturacion))
+    """, select_params + where_params)
+
+    facets = {'actividad': {}, 'sector': {}, 'provincia': {}, 'precio': {}, 'facturacion': {}}
+    # GROUPING(sector, ubicacion, tramo_precio, tramo_facturacion): bit a 1 = columna no agrupada
+    for (actividad, sector, ubicacion, tramo_precio, tramo_facturacion, agrupacion,
+         total_actividad, total_sector, total_provincia, total_precio, total_facturacion) in cur.fetchall():
+        if agrupacion == 0b1111 and actividad is not None:
+            facets['actividad'][actividad] = total_actividad
+        elif agrupacion == 0b0111 and actividad is not None and sector is not None:
+            facets['sector'].setdefault(actividad, {})[sector] = total_sector
+        elif agrupacion == 0b1011 and ubicacion is not None:
+            facets['provincia'][ubicacion] = total_provincia
+        elif agrupacion == 0b1101 and tramo_precio is not None:
+            facets['precio'][tramo_precio] = total_precio
+        elif agrupacion == 0b1110 and tramo_facturacion is not None:
+            facets['facturacion'][tramo_facturacion] = total_facturacion
+    return facets
+
+def get_listing_facets(cur, conditions):
+    """Facetas de fetch_listing_facets, cacheadas LISTING_FACETS_TTL segundos por conjunto de filtros."""
+    key = tuple((dim, sql, tuple(params)) for dim, sql, params in conditions)
+    now = time.monotonic()
+    with _listing_facets_lock:
+        cached = _listing_facets_cache.get(key)
+    if cached and now - cached[0] < LISTING_FACETS_TTL:
+        return cached[1]
+    facets = fetch_listing_facets(cur, conditions)
+    with _listing_facets_lock:
+        if len(_listing_facets_cache) > 1000:
+            _listing_facets_cache.clear()
+        _listing_facets_cache[key] = (now, facets)
+    return facets
+
+def build_tramo_links(tramos, totals, min_arg, max_arg, filter_args, max_default=None):
+    """
+    Enlaces del listado para cada tramo de precio o facturación con su recuento.
+    Devuelve [{'desde', 'hasta', 'total', 'url', 'activo'}] (hasta=None en el último tramo).
+    """
+    base_args = {k: v for k, v in filter_args.items() if k not in (min_arg, max_arg)}
+    links = []
+    for i, desde in enumerate(tramos):
+        hasta = tramos[i + 1] if i + 1 < len(tramos) else None
+        tramo_args = dict(base_args)
+        tramo_args[min_arg] = desde
+        if hasta is not None:
+            tramo_args[max_arg] = f"{hasta - 0.01:.2f}" # Los filtros incluyen el máximo y el tramo no
+        elif max_default is not None:
+            tramo_args[max_arg] = max_default
+        if max_arg in tramo_args:
+            max_activo = filter_args.get(max_arg) == str(tramo_args[max_arg])
+        else:
+            max_activo = not filter_args.get(max_arg) # Tramo abierto: sin máximo (ausente o vacío)
+        activo = filter_args.get(min_arg) == str(desde) and max_activo
+        links.append({'desde': desde, 'hasta': hasta, 'total': totals.get(i, 0),
+                      'url': url_for('index', **tramo_args), 'activo': activo})
+    return links
+
+# Rutas de la aplicación
+@app.route('/')
+@cached_page('empresas')
+def index():
+    conn = get_db_connection()
+    # Cursor de tuplas simples: las filas se convierten directamente en ListingCard
+    cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+
+    search = parse_listing_search(cur, request.args)
+    where_sql, params = build_empresas_filters(request.args, search)
+    page_size = get_listing_page_size(request.args)
+    after = decode_listing_cursor(request.args.get('after'))
+    before = decode_listing_cursor(request.args.get('before')) if not after else None
+
+    empresas, has_prev, has_next = fetch_empresas_page(cur, where_sql, params, page_size, after, before,
+                                                       rank=listing_search_rank(search))
+    total_empresas, total_es_minimo = estimate_empresas_count(cur, where_sql, params)
+    try:
+        facetas = get_listing_facets(cur, build_empresas_conditions(request.args, search))
+    except psycopg2.Error as e:
+        # Sin recuentos el formulario sigue funcionando como antes
+        print(f"ERROR Facetas: No se pudieron calcular los recuentos del listado: {e}")
+        conn.rollback()
+        facetas = None
     cur.close()
-    conn.close()
 
-    actividades_list = list(ACTIVIDADES_Y_SECTORES.keys())
-    return render_template('index.html', empresas=empresas, actividades=actividades_list, sectores=[], actividades_dict=ACTIVIDADES_Y_SECTORES, provincias=PROVINCIAS_ESPANA)
+    # Los enlaces de paginación conservan todos los filtros actuales
+    filter_args = {k: v for k, v in request.args.items() if k not in LISTING_CURSOR_ARGS}
+    next_url = prev_url = None
+    if empresas and has_next:
+        next_url = url_for('index', **filter_args, after=listing_row_cursor(empresas[-1]))
+    if empresas and has_prev:
+        prev_url = url_for('index', **filter_args, before=listing_row_cursor(empresas[0]))
+
+    tramos_precio = tramos_facturacion = None
+    if facetas:
+        tramos_precio = build_tramo_links(PRECIO_TRAMOS, facetas['precio'], 'min_precio', 'max_precio', filter_args)
+        tramos_facturacion = build_tramo_links(FACTURACION_TRAMOS, facetas['facturacion'], 'min_facturacion_slider',
+                                               'max_facturacion_slider', filter_args, max_default='10000000')
+
+    return render_template('index.html', empresas=empresas, actividades=ACTIVIDADES, sectores=[], provincias=PROVINCIAS_ESPANA,
+                           next_url=next_url, prev_url=prev_url, total_empresas=total_empresas, total_es_minimo=total_es_minimo,
+                           busqueda=search, facetas=facetas, tramos_precio=tramos_precio, tramos_facturacion=tramos_facturacion,
+                           importes=format_listing_amounts(empresas))
 
 
 # Ruta para publicar una nueva empresa
 @app.route('/publicar', methods=['GET', 'POST'])
+@image_upload_limit
 def publicar():
-    actividades_list = list(ACTIVIDADES_Y_SECTORES.keys())
+    actividades_list = ACTIVIDADES
     provincias_list = PROVINCIAS_ESPANA
-    actividades_dict = ACTIVIDADES_Y_SECTORES
 
     if request.method == 'POST':
         nombre = request.form.get('nombre')
@@ -420,11 +2906,11 @@ def publicar():
             return render_template('vender_empresa.html',
                                    actividades=actividades_list,
                                    provincias=provincias_list,
-                                   actividades_dict=actividades_dict,
                                    form_data=request.form)
 
         acepto_condiciones = 'acepto_condiciones' in request.form
         imagen = request.files.get('imagen') # Usa .get() para que sea None si no se selecciona archivo
+        imagen_token = request.form.get('imagen_token') # Presente si la imagen se subió directamente a GCS
 
         errores = []
 
@@ -434,10 +2920,8 @@ def publicar():
         ##### MODIFICACIÓN: Validación del campo de teléfono #####
         if not telefono or len(telefono) != 9 or not telefono.isdigit(): errores.append('El teléfono de contacto es obligatorio y debe tener 9 dígitos numéricos.')
         
-        if not actividad or actividad not in actividades_list: errores.append('Por favor, selecciona una actividad válida.')
-        if not sector or (actividad and sector not in (actividades_dict.get(actividad, []))): errores.append('Por favor, selecciona un sector válido para la actividad elegida.')
+        errores.extend(validar_taxonomia(actividad, sector, ubicacion))
         if not pais: errores.append('El país es obligatorio.')
-        if not ubicacion or ubicacion not in provincias_list: errores.append('Por favor, selecciona una provincia válida.')
         if not tipo_negocio: errores.append('El tipo de negocio es obligatorio.')
         if not descripcion: errores.append('La descripción del negocio es obligatoria.')
         if facturacion is None or facturacion < 0: errores.append('La facturación anual es obligatoria y debe ser un número no negativo.')
@@ -448,13 +2932,10 @@ def publicar():
         if not acepto_condiciones: errores.append('Debes aceptar las condiciones de uso.')
 
         # **MODIFICADO: La validación de la imagen ahora es opcional**
-        if imagen and imagen.filename: # Solo valida si se subió una imagen
-            imagen.seek(0, os.SEEK_END)
-            file_size = imagen.tell()
-            imagen.seek(0)
-
+        if not imagen_token and imagen and imagen.filename: # Solo valida si se subió una imagen por el formulario
+            # El tipo se comprueba por su contenido; el tamaño se controla mientras se sube en streaming
             if not allowed_file(imagen.filename): errores.append('Tipo de archivo de imagen no permitido. Solo se aceptan JPG, JPEG, PNG, GIF.')
-            elif file_size > MAX_IMAGE_SIZE: errores.append(f'La imagen excede el tamaño máximo permitido de {MAX_IMAGE_SIZE / (1024 * 1024):.1f} MB.')
+            elif not sniff_image_type(imagen.stream): errores.append('El archivo no es una imagen JPG, PNG o GIF válida.')
         # REMOVIDO: ya no es obligatorio un error si no hay imagen
 
         if errores:
@@ -463,7 +2944,6 @@ def publicar():
             return render_template('vender_empresa.html',
                                    actividades=actividades_list,
                                    provincias=provincias_list,
-                                   actividades_dict=actividades_dict,
                                    form_data=request.form)
 
         conn = None # Inicializa conn a None
@@ -472,11 +2952,13 @@ def publicar():
             imagen_filename_gcs = None
 
             # **MODIFICADO: Lógica para la imagen opcional**
-            if imagen and imagen.filename and allowed_file(imagen.filename) and imagen.tell() <= MAX_IMAGE_SIZE:
-                # Si hay una imagen válida, súbela a GCS
-                filename = secure_filename(imagen.filename)
-                unique_filename = str(uuid.uuid4()) + os.path.splitext(filename)[1]
-                imagen_filename_gcs = upload_to_gcs(imagen, unique_filename)
+            if imagen_token or (imagen and imagen.filename):
+                # Si hay una imagen válida, súbela a GCS (o verifica la subida directa)
+                try:
+                    imagen_filename_gcs = receive_image(imagen, imagen_token)
+                except ImageUploadError as e:
+                    flash(str(e), 'danger')
+                    return render_template('vender_empresa.html', actividades=actividades_list, provincias=provincias_list, form_data=request.form)
                 if imagen_filename_gcs:
                     # AHORA USA get_public_image_url
                     imagen_url = get_public_image_url(imagen_filename_gcs)
@@ -513,8 +2995,9 @@ def publicar():
                 token_edicion, active_status 
             ))
             empresa_id = cur.fetchone()[0]
-            conn.commit()
-            
+
+            # Los correos se encolan en email_outbox dentro de la misma transacción que el anuncio:
+            # si el INSERT falla no se envía nada, y la petición no espera a Mailgun.
 
             # --- LÓGICA EXISTENTE: ENVIAR EMAIL AL ANUNCIANTE CON EL ENLACE DE EDICIÓN ---
             edit_link = url_for("editar", edit_token=token_edicion, _external=True)
@@ -528,13 +3011,11 @@ def publicar():
                 f"Gracias por usar Pyme Market."
             )
 
-            if send_email(email_contacto, email_subject_advertiser, email_body_advertiser):
-                flash('¡Tu negocio ha sido publicado con éxito y te hemos enviado el enlace de edición a tu correo!', 'success')
-            else:
-                flash('¡Tu negocio ha sido publicado con éxito! Sin embargo, no pudimos enviarte el enlace de edición por correo. Por favor, copia este enlace y guárdalo: ' + edit_link, 'warning')
+            enqueue_email(cur, email_contacto, email_subject_advertiser, email_body_advertiser)
             # --- FIN DE LA LÓGICA EXISTENTE ---
 
             # --- NUEVA LÓGICA: ENVIAR EMAIL DE NOTIFICACIÓN AL ADMINISTRADOR (Usando EMAIL_DESTINO) ---
+            # EMAIL_DESTINO admite varias direcciones separadas por comas (se envían en un único batch de Mailgun)
             admin_email_for_notifications = os.environ.get('EMAIL_DESTINO')
             if admin_email_for_notifications:
                 admin_subject = f"🔔 Nuevo Anuncio Publicado en Pyme Market: '{nombre}' (ID: {empresa_id})"
@@ -557,9 +3038,17 @@ def publicar():
                     f"Puedes revisar y gestionar todos los anuncios en el panel de administración:\n"
                     f"{url_for('admin', admin_token=ADMIN_TOKEN, _external=True) if ADMIN_TOKEN else 'Panel de administración'}\n"
                 )
-                if not send_email(admin_email_for_notifications, admin_subject, admin_body):
-                    print(f"WARNING Publicar: No se pudo enviar el correo de notificación al administrador ({admin_email_for_notifications}) para el anuncio '{nombre}'.")
+                enqueue_email(cur, admin_email_for_notifications, admin_subject, admin_body)
             # --- FIN DE LA NUEVA LÓGICA ---
+
+            conn.commit()
+            invalidate_pages('empresas')
+            notify_email_sender()
+            schedule_image_processing(empresa_id, imagen_filename_gcs)
+            # El correo sale en segundo plano desde la cola: el enlace de edición es la única forma
+            # de volver al anuncio, así que se muestra también en pantalla por si el envío se retrasa
+            flash('¡Tu negocio ha sido publicado con éxito! Te enviaremos el enlace de edición a tu correo. '
+                  'Por si tarda en llegar, copia este enlace y guárdalo: ' + edit_link, 'success')
             
             # CORRECCIÓN DE INDENTACIÓN (Antigua Línea 561)
             return redirect(url_for('publicar'))
@@ -569,18 +3058,19 @@ def publicar():
                 conn.rollback()
             flash(f'Error al publicar el negocio: {e}', 'danger')
             print(f"ERROR Publicar: Error al publicar el negocio: {e}") # Para depuración en los logs
-            return render_template('vender_empresa.html', actividades=actividades_list, provincias=provincias_list, actividades_dict=actividades_dict, form_data=request.form)
+            return render_template('vender_empresa.html', actividades=actividades_list, provincias=provincias_list, form_data=request.form)
 
         finally:
             if conn:
                 cur.close()
-                conn.close()
 
-    return render_template('vender_empresa.html', actividades=actividades_list, provincias=PROVINCIAS_ESPANA, actividades_dict=ACTIVIDADES_Y_SECTORES)
+    return render_template('vender_empresa.html', actividades=actividades_list, provincias=provincias_list)
 
 
 # Ruta para mostrar los detalles de una empresa Y procesar el formulario de contacto
 @app.route('/negocio/<int:empresa_id>', methods=['GET', 'POST'])
+@conditional_page(empresa_validators)
+@cached_page(lambda empresa_id: f'empresa:{empresa_id}')
 def detalle(empresa_id):
     conn = None # Inicializa conn a None
     cur = None # Inicializa cur a None
@@ -676,11 +3166,10 @@ def detalle(empresa_id):
     finally:
         if cur:
             cur.close()
-        if conn:
-            conn.close()
 
 # Ruta para editar un negocio (Acceso mediante token)
 @app.route('/editar/<string:edit_token>', methods=['GET', 'POST'])
+@image_upload_limit
 def editar(edit_token):
     conn = None
     cur = None
@@ -690,14 +3179,8 @@ def editar(edit_token):
     edit_token = edit_token.strip()
     
     # Definir las variables de listas de opciones
-    try:
-        actividades_list = list(ACTIVIDADES_Y_SECTORES.keys())
-        provincias_list = PROVINCIAS_ESPANA
-        actividades_dict = ACTIVIDADES_Y_SECTORES
-    except NameError:
-        actividades_list = []
-        provincias_list = []
-        actividades_dict = {}
+    actividades_list = ACTIVIDADES
+    provincias_list = PROVINCIAS_ESPANA
 
     try:
         conn = get_db_connection()
@@ -718,16 +3201,16 @@ def editar(edit_token):
         if request.method == 'POST':
             # Lógica de Eliminación
             if request.form.get('eliminar') == 'true':
-                imagen_filename_gcs = empresa.get('imagen_filename_gcs')
-                nombre_empresa = empresa['nombre']
-                
-                if imagen_filename_gcs and imagen_filename_gcs != app.config.get('DEFAULT_IMAGE_GCS_FILENAME'):
-                    delete_from_gcs(imagen_filename_gcs)
-                    
-                cur.execute("DELETE FROM empresas WHERE id = %s", (empresa_id,))
+                # Un solo DELETE ... RETURNING: la imagen que se encola es la que tenía la fila al borrarla
+                cur.execute("DELETE FROM empresas WHERE id = %s RETURNING nombre, imagen_filename_gcs, imagen_variantes", (empresa_id,))
+                eliminada = cur.fetchone()
+                if eliminada:
+                    enqueue_image_deletion(cur, [(eliminada['imagen_filename_gcs'], eliminada['imagen_variantes'])])
                 conn.commit()
+                invalidate_pages('empresas', f'empresa:{empresa_id}')
+                notify_gcs_cleanup()
 
-                flash(f'El anuncio "{nombre_empresa}" ha sido ELIMINADO permanentemente.', 'success')
+                flash(f'El anuncio "{empresa["nombre"]}" ha sido ELIMINADO permanentemente.', 'success')
                 return redirect(url_for('index'))
 
             # Lógica de Actualización
@@ -752,32 +3235,38 @@ def editar(edit_token):
                 
                 if not nombre or not ubicacion or not precio_limpio or not sector or not email_contacto:
                     flash('Por favor, completa todos los campos obligatorios para actualizar.', 'danger')
-                    return render_template('editar.html', empresa=empresa, actividades=actividades_list, provincias=provincias_list, actividades_dict=actividades_dict)
+                    return render_template('editar.html', empresa=empresa, actividades=actividades_list, provincias=provincias_list)
+                errores_taxonomia = validar_taxonomia(actividad_db, sector, ubicacion)
+                if errores_taxonomia:
+                    for error in errores_taxonomia:
+                        flash(error, 'danger')
+                    return render_template('editar.html', empresa=empresa, actividades=actividades_list, provincias=provincias_list)
 
                 # --- CORRECCIÓN DE IMAGEN ---
                 nueva_imagen = request.files.get('imagen')
+                imagen_token = request.form.get('imagen_token') # Presente si la imagen se subió directamente a GCS
                 imagen_filename_gcs = empresa['imagen_filename_gcs']
                 imagen_url = empresa['imagen_url']
 
-                if nueva_imagen and nueva_imagen.filename:
-                    # Validar archivo
-                    if allowed_file(nueva_imagen.filename):
-                        # 1. Borrar la anterior si no es la default
-                        if imagen_filename_gcs and imagen_filename_gcs != app.config.get('DEFAULT_IMAGE_GCS_FILENAME'):
-                            delete_from_gcs(imagen_filename_gcs)
-                        
-                        # 2. Subir la nueva con nombre único para evitar caché
-                        filename_secure = secure_filename(nueva_imagen.filename)
-                        unique_filename = str(uuid.uuid4()) + os.path.splitext(filename_secure)[1]
-                        
-                        nuevo_filename_gcs = upload_to_gcs(nueva_imagen, unique_filename)
-                        if nuevo_filename_gcs:
-                            imagen_filename_gcs = nuevo_filename_gcs
-                            imagen_url = get_public_image_url(nuevo_filename_gcs)
-                    else:
-                        flash('Tipo de imagen no permitido.', 'danger')
+                if imagen_token or (nueva_imagen and nueva_imagen.filename):
+                    # 1. Subir la nueva con nombre único para evitar caché (validando tipo real y tamaño)
+                    try:
+                        nuevo_filename_gcs = receive_image(nueva_imagen, imagen_token)
+                    except ImageUploadError as e:
+                        nuevo_filename_gcs = None
+                        flash(str(e), 'danger')
+                    if nuevo_filename_gcs:
+                        imagen_filename_gcs = nuevo_filename_gcs
+                        imagen_url = get_public_image_url(nuevo_filename_gcs)
                 # --- FIN CORRECCIÓN ---
 
+                imagen_cambiada = imagen_filename_gcs != empresa['imagen_filename_gcs']
+                if imagen_cambiada:
+                    # Bloquea la fila para leer las variantes vigentes de la imagen anterior: si el
+                    # pipeline termina ahora, su UPDATE espera, no encuentra la imagen y encola las suyas
+                    cur.execute("SELECT imagen_filename_gcs, imagen_variantes FROM empresas WHERE id = %s FOR UPDATE",
+                                (empresa_id,))
+                    anterior = cur.fetchone()
                 cur.execute("""
                     UPDATE empresas 
                     SET 
@@ -785,16 +3274,26 @@ def editar(edit_token):
                         actividad = %s, sector = %s,                                 
                         descripcion = %s, email_contacto = %s, telefono = %s,
                         imagen_filename_gcs = %s, imagen_url = %s,
+                        imagen_variantes = CASE WHEN imagen_filename_gcs IS NOT DISTINCT FROM %s THEN imagen_variantes ELSE NULL END,
                         tipo_negocio = %s, facturacion = %s, numero_empleados = %s, 
                         local_propiedad = %s, resultado_antes_impuestos = %s, deuda = %s,
                         fecha_modificacion = NOW()
                     WHERE id = %s
                 """, (nombre, ubicacion, precio_limpio, actividad_db, sector, 
                       descripcion, email_contacto, telefono, 
-                      imagen_filename_gcs, imagen_url, 
+                      imagen_filename_gcs, imagen_url, imagen_filename_gcs,
                       tipo_negocio, facturacion, numero_empleados, local_propiedad, resultado_antes_impuestos, deuda,
                       empresa_id))
+                if imagen_cambiada and anterior:
+                    # 2. La anterior (si no es la default) se borra de GCS solo si este UPDATE hace commit
+                    enqueue_image_deletion(cur, [(anterior['imagen_filename_gcs'], anterior['imagen_variantes'])])
                 conn.commit()
+                invalidate_pages('empresas', f'empresa:{empresa_id}')
+
+                # Si la imagen ha cambiado, generar sus variantes en segundo plano
+                if imagen_cambiada:
+                    schedule_image_processing(empresa_id, imagen_filename_gcs)
+                    notify_gcs_cleanup()
                 
                 flash('¡El anuncio ha sido actualizado con éxito!', 'success')
                 return redirect(url_for('editar', edit_token=edit_token))
@@ -808,7 +3307,7 @@ def editar(edit_token):
 
         empresa['display_imagen_url'] = imagen_url_display
         
-        return render_template('editar.html', empresa=empresa, actividades=actividades_list, provincias=provincias_list, actividades_dict=actividades_dict)
+        return render_template('editar.html', empresa=empresa, actividades=actividades_list, provincias=provincias_list)
 
     except Exception as e:
         if conn: conn.rollback()
@@ -816,84 +3315,215 @@ def editar(edit_token):
         return redirect(url_for('index'))
     finally:
         if cur: cur.close()
-        if conn: conn.close()
 
 # GENERACIÓN DE SITEMAP
-@app.route('/sitemap.xml', methods=['GET'])
-def sitemap():
-    """Genera un sitemap XML para la aplicación."""
-    
-    # 1. URL base para construir URLs absolutas
-    HOST_URL = request.url_root # E.g., https://pymemarket.com/
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DEL SITEMAP
+# ---------------------------------------------------------------
+# El XML se genera con un generador (sin concatenar cadenas) a partir de cursores de
+# servidor, así no hay que cargar todas las filas en memoria. Con más de SITEMAP_MAX_URLS
+# direcciones, /sitemap.xml pasa a ser un índice que apunta a /sitemap-<n>.xml.
+# El resultado se cachea por proceso con clave en max(fecha_modificacion) y los contadores
+# de filas, y cada documento tiene también su variante comprimida .xml.gz.
+
+SITEMAP_MAX_URLS = int(os.environ.get('SITEMAP_MAX_URLS', 50000)) # Límite del protocolo por fichero
+SITEMAP_CACHE_MAX_ENTRIES = int(os.environ.get('SITEMAP_CACHE_MAX_ENTRIES', 16))
+SITEMAP_FETCH_SIZE = 2000
+SITEMAP_NAMESPACE = 'http://www.sitemaps.org/schemas/sitemap/0.9'
 
-    # 2. URLs estáticas (las que no dependen de la BD)
-    urls = [
-        {'loc': HOST_URL, 'lastmod': datetime.now().strftime('%Y-%m-%d'), 'changefreq': 'daily', 'priority': '1.0'},
-        {'loc': url_for('publicar', _external=True), 'lastmod': datetime.now().strftime('%Y-%m-%d'), 'changefreq': 'weekly', 'priority': '0.8'},
+_sitemap_cache = collections.OrderedDict() # clave -> {'xml': bytes, 'gz': bytes | None}
+_sitemap_cache_lock = threading.Lock()
+
+def get_sitemap_state():
+    """
+    Fecha de modificación más reciente y número de filas publicadas de empresas y blog.
+    Se calcula una vez por petición (la comparten la validación condicional y la caché).
+    """
+    if 'sitemap_state' not in g:
+        g.sitemap_state = fetch_validator_row("""
+            SELECT
+                (SELECT max(fecha_modificacion) FROM empresas WHERE active = TRUE),
+                (SELECT count(*) FROM empresas WHERE active = TRUE),
+                (SELECT max(COALESCE(updated_at, created_at)) FROM blog_posts WHERE is_published = TRUE),
+                (SELECT count(*) FROM blog_posts WHERE is_published = TRUE)
+        """)
+    return g.sitemap_state
+
+def sitemap_static_urls():
+    """URLs que no dependen de la BD: (loc, lastmod, changefreq, priority)."""
+    today = datetime.now().strftime('%Y-%m-%d')
+    return [
+        (request.url_root, today, 'daily', '1.0'),
+        (url_for('publicar', _external=True), today, 'weekly', '0.8'),
+        (url_for('blog_list', _external=True), today, 'weekly', '0.7'),
         # Puedes añadir más rutas estáticas aquí (e.g., /contacto, /legal, etc.)
     ]
 
-    # 3. URLs dinámicas (las de los negocios)
-    conn = None
-    cur = None
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        # Selecciona solo ID y fecha de modificación (la más reciente) para la sitemap
-        cur.execute("SELECT id, fecha_modificacion FROM empresas WHERE active = TRUE ORDER BY id")
-        empresas = cur.fetchall()
-
-        for empresa in empresas:
-            # Crea la URL al detalle del negocio.
-            # Como aquí usas la ID, es directo:
-            loc = url_for('detalle', empresa_id=empresa['id'], _external=True)
-            
-            # Formatea la fecha al estándar W3C para sitemaps
-            lastmod = empresa['fecha_modificacion'].strftime('%Y-%m-%d')
-            
-            urls.append({
-                'loc': loc,
-                'lastmod': lastmod,
-                'changefreq': 'weekly',
-                'priority': '0.9' # Más alta prioridad que el resto de estáticas
-            })
+def sitemap_url_count(state):
+    return len(sitemap_static_urls()) + state[1] + state[3]
+
+def sitemap_shard_count(state):
+    return max(1, -(-sitemap_url_count(state) // SITEMAP_MAX_URLS))
+
+def iter_sitemap_urls(state, start=0, limit=None):
+    """
+    URLs del sitemap en orden estable: estáticas, negocios (por id) y artículos del blog.
+    start y limit seleccionan un fragmento: se traducen a OFFSET/LIMIT de cada consulta
+    (con los contadores de 'state'), así un fragmento no lee las filas de los anteriores.
+    """
+    static_urls = sitemap_static_urls()
+    if limit is None:
+        limit = sitemap_url_count(state)
+    selected = static_urls[start:start + limit]
+    yield from selected
+    limit -= len(selected)
+    start = max(0, start - len(static_urls))
+
+    # Prefijos calculados una sola vez en lugar de llamar a url_for por cada fila
+    detalle_prefix = url_for('detalle', empresa_id=0, _external=True)[:-1]
+    blog_prefix = url_for('blog_post', slug='x', _external=True)[:-1]
+    conn = get_db_connection()
 
+    if limit > 0 and start < state[1]:
+        cur = conn.cursor('sitemap_empresas', cursor_factory=psycopg2.extensions.cursor) # Cursor de servidor
+        cur.itersize = SITEMAP_FETCH_SIZE
+        try:
+            cur.execute("SELECT id, fecha_modificacion FROM empresas WHERE active = TRUE ORDER BY id OFFSET %s LIMIT %s",
+                        (start, limit))
+            for empresa_id, fecha_modificacion in cur:
+                limit -= 1
+                yield (f"{detalle_prefix}{empresa_id}", fecha_modificacion.strftime('%Y-%m-%d'), 'weekly', '0.9')
+        finally:
+            cur.close()
+    start = max(0, start - state[1])
+
+    if limit > 0:
+        cur = conn.cursor('sitemap_blog', cursor_factory=psycopg2.extensions.cursor)
+        cur.itersize = SITEMAP_FETCH_SIZE
+        try:
+            cur.execute("""
+                SELECT slug, COALESCE(updated_at, created_at) FROM blog_posts
+                WHERE is_published = TRUE ORDER BY id OFFSET %s LIMIT %s
+            """, (start, limit))
+            for slug, fecha in cur:
+                yield (f"{blog_prefix}{quote(slug)}", fecha.strftime('%Y-%m-%d'), 'monthly', '0.6')
+        finally:
+            cur.close()
+
+def render_sitemap_urlset(urls):
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield f'<urlset xmlns="{SITEMAP_NAMESPACE}">\n'
+    try:
+        for loc, lastmod, changefreq, priority in urls:
+            yield (f'    <url>\n        <loc>{xml_escape(loc)}</loc>\n        <lastmod>{lastmod}</lastmod>\n'
+                   f'        <changefreq>{changefreq}</changefreq>\n        <priority>{priority}</priority>\n    </url>\n')
     except Exception as e:
+        # La cabecera 200 ya se ha enviado: se cierra el documento con las URLs que haya y no se cachea
         print(f"ERROR Sitemap: Error al generar URLs dinámicas desde la BD: {e}")
-        # En caso de error de BD, el sitemap se genera solo con las URLs estáticas.
-    finally:
-        if cur:
-            cur.close()
-        if conn:
-            conn.close()
+        g.sitemap_incomplete = True
+    yield '</urlset>'
+
+def render_sitemap_index(state, gz):
+    lastmod = max((d for d in (state[0], state[2]) if d), default=datetime.now()).strftime('%Y-%m-%d')
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield f'<sitemapindex xmlns="{SITEMAP_NAMESPACE}">\n'
+    for shard in range(1, sitemap_shard_count(state) + 1):
+        loc = url_for('sitemap_shard', shard=shard, gz=gz, _external=True)
+        yield f'    <sitemap>\n        <loc>{xml_escape(loc)}</loc>\n        <lastmod>{lastmod}</lastmod>\n    </sitemap>\n'
+    yield '</sitemapindex>'
+
+def sitemap_cache_get(key):
+    with _sitemap_cache_lock:
+        entry = _sitemap_cache.get(key)
+        if entry is not None:
+            _sitemap_cache.move_to_end(key)
+        return entry
+
+def sitemap_cache_set(key, entry):
+    with _sitemap_cache_lock:
+        _sitemap_cache[key] = entry
+        _sitemap_cache.move_to_end(key)
+        while len(_sitemap_cache) > SITEMAP_CACHE_MAX_ENTRIES:
+            _sitemap_cache.popitem(last=False)
+
+def sitemap_response(key, chunks, gz):
+    """
+    Devuelve el documento desde la caché o lo genera en streaming, guardándolo en la
+    caché al terminar. La variante .gz se comprime sobre la marcha con el mismo flujo.
+    """
+    mimetype = 'application/gzip' if gz else 'application/xml'
+    entry = sitemap_cache_get(key)
+    if entry is not None:
+        # El .xml se sirve con Content-Encoding: gzip reutilizando los bytes del .xml.gz
+        encoded = gz or (is_compressible(mimetype) and negotiate_encoding(('gzip',)) == 'gzip')
+        if encoded and entry['gz'] is None:
+            entry['gz'] = gzip.compress(entry['xml'])
+        response = Response(entry['gz'] if encoded else entry['xml'], mimetype=mimetype)
+        if not gz:
+            add_vary_accept_encoding(response)
+            if encoded:
+                response.headers['Content-Encoding'] = 'gzip'
+        return response
+
+    def generate():
+        parts = []
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gz else None # wbits=31: formato gzip
+        for chunk in chunks:
+            data = chunk.encode('utf-8')
+            parts.append(data)
+            if compressor:
+                data = compressor.compress(data)
+            if data:
+                yield data
+        if compressor:
+            yield compressor.flush()
+        if not g.get('sitemap_incomplete'):
+            sitemap_cache_set(key, {'xml': b''.join(parts), 'gz': None})
+
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+def sitemap_cache_key(name):
+    return (name, request.url_root, get_sitemap_state(), datetime.now().date())
 
-    # Construcción del XML del sitemap
-    xml_content = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    xml_content += '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n'
-    for url_data in urls:
-        xml_content += '    <url>\n'
-        xml_content += f'        <loc>{url_data["loc"]}</loc>\n'
-        xml_content += f'        <lastmod>{url_data["lastmod"]}</lastmod>\n'
-        xml_content += f'        <changefreq>{url_data["changefreq"]}</changefreq>\n'
-        xml_content += f'        <priority>{url_data["priority"]}</priority>\n'
-        xml_content += '    </url>\n'
-    xml_content += '</urlset>'
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DEL SITEMAP
+# -------------------------------------------------------------
 
-    return Response(xml_content, mimetype='application/xml')
+@app.route('/sitemap.xml', methods=['GET'], defaults={'gz': False})
+@app.route('/sitemap.xml.gz', methods=['GET'], defaults={'gz': True})
+@conditional_page(sitemap_validators)
+def sitemap(gz):
+    """Sitemap completo o, si hay demasiadas URLs, índice de sitemaps por fragmentos."""
+    state = get_sitemap_state()
+    if sitemap_shard_count(state) > 1:
+        # El índice enlaza a los fragmentos .gz o .xml según la variante pedida
+        index_key = sitemap_cache_key('index-gz' if gz else 'index')
+        return sitemap_response(index_key, render_sitemap_index(state, gz), gz)
+    return sitemap_response(sitemap_cache_key('urlset'), render_sitemap_urlset(iter_sitemap_urls(state)), gz)
+
+@app.route('/sitemap-<int:shard>.xml', methods=['GET'], defaults={'gz': False})
+@app.route('/sitemap-<int:shard>.xml.gz', methods=['GET'], defaults={'gz': True})
+@conditional_page(sitemap_validators)
+def sitemap_shard(shard, gz):
+    """Fragmento n (desde 1) de SITEMAP_MAX_URLS direcciones."""
+    state = get_sitemap_state()
+    if shard < 1 or shard > sitemap_shard_count(state):
+        return Response(status=404)
+    urls = iter_sitemap_urls(state, (shard - 1) * SITEMAP_MAX_URLS, SITEMAP_MAX_URLS)
+    return sitemap_response(sitemap_cache_key(f'shard-{shard}'), render_sitemap_urlset(urls), gz)
 
 # --- RUTA DE VALORAR EMPRESA (Añadir si falta) ---
 @app.route('/valorar-empresa', methods=['GET'])
 def valorar_empresa():
-    actividades_list = list(ACTIVIDADES_Y_SECTORES.keys())
-    provincias_list = PROVINCIAS_ESPANA
-    actividades_dict = ACTIVIDADES_Y_SECTORES
-    return render_template('valorar_empresa.html', actividades=actividades_list, provincias=provincias_list, actividades_dict=actividades_dict)
+    return render_template('valorar_empresa.html', actividades=ACTIVIDADES, provincias=PROVINCIAS_ESPANA)
 
 
 # --- RUTAS PÚBLICAS DEL BLOG (Bloque para sustituir tus versiones) ---
 
 # 1. RUTA PÚBLICA PARA LA LISTA DEL BLOG (blog_list.html)
 @app.route('/blog')
+@conditional_page(blog_list_validators)
+@cached_page('blog')
 def blog_list():
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -901,12 +3531,13 @@ def blog_list():
     cur.execute("SELECT id, title, slug, created_at, extract(epoch from created_at) as timestamp, featured_image_url FROM blog_posts WHERE is_published = TRUE ORDER BY created_at DESC")
     posts = cur.fetchall()
     cur.close()
-    conn.close()
     return render_template('blog_list.html', posts=posts)
 
 
 # 2. RUTA PÚBLICA PARA EL DETALLE DEL POST DEL BLOG (blog_post.html)
 @app.route('/blog/<slug>')
+@conditional_page(blog_post_validators)
+@cached_page('blog')
 def blog_post(slug):
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
@@ -914,7 +3545,6 @@ def blog_post(slug):
     cur.execute("SELECT * FROM blog_posts WHERE slug = %s AND is_published = TRUE", (slug,))
     post = cur.fetchone()
     cur.close()
-    conn.close()
 
     if post is None:
         return render_template('404.html'), 404 
@@ -947,7 +3577,6 @@ def admin_blog_list():
     cur.execute("SELECT id, title, is_published, created_at FROM blog_posts ORDER BY created_at DESC")
     posts = cur.fetchall()
     cur.close()
-    conn.close()
     # Asegúrate de pasar el token si lo necesitas en el template
     token = request.args.get('admin_token') 
     return render_template('admin_blog_list.html', posts=posts, admin_token=token)
@@ -955,6 +3584,7 @@ def admin_blog_list():
 
 @app.route('/admin/blog/edit', defaults={'post_id': None}, methods=['GET', 'POST']) # Renombrada
 @app.route('/admin/blog/edit/<int:post_id>', methods=['GET', 'POST']) # Renombrada
+@image_upload_limit
 @admin_required
 def admin_blog_edit(post_id=None):
     admin_token = request.args.get('admin_token')
@@ -968,7 +3598,6 @@ def admin_blog_edit(post_id=None):
         post = cur.fetchone()
         if not post:
             cur.close()
-            conn.close()
             flash('Error: Post de blog no encontrado.', 'danger')
             return redirect(url_for('admin_blog_list', admin_token=admin_token))
 
@@ -996,24 +3625,21 @@ def admin_blog_edit(post_id=None):
         # Inicializar imagen_filename_gcs con el valor existente o por defecto
         featured_image_filename_gcs = post['featured_image_filename_gcs'] if post and post['featured_image_filename_gcs'] else app.config.get('DEFAULT_IMAGE_GCS_FILENAME')
         
+        previous_image_filename_gcs = featured_image_filename_gcs
+
         if remove_image:
-            if featured_image_filename_gcs and featured_image_filename_gcs != app.config.get('DEFAULT_IMAGE_GCS_FILENAME'):
-                delete_from_gcs(featured_image_filename_gcs)
             featured_image_filename_gcs = app.config.get('DEFAULT_IMAGE_GCS_FILENAME')
         elif imagen_subida and imagen_subida.filename: # Si se sube una nueva imagen
-            if featured_image_filename_gcs and featured_image_filename_gcs != app.config.get('DEFAULT_IMAGE_GCS_FILENAME'):
-                delete_from_gcs(featured_image_filename_gcs) # Eliminar la antigua si no es la por defecto
-
-            if allowed_file(imagen_subida.filename):
-                filename_secure = secure_filename(imagen_subida.filename)
-                unique_filename = str(uuid.uuid4()) + os.path.splitext(filename_secure)[1]
-                new_filename_gcs = upload_to_gcs(imagen_subida, unique_filename)
-                if new_filename_gcs:
-                    featured_image_filename_gcs = new_filename_gcs
-                else:
-                    flash('No se pudo subir la nueva imagen destacada a Google Cloud Storage. Se mantendrá la imagen anterior o por defecto.', 'warning')
+            try:
+                new_filename_gcs = upload_image(imagen_subida)
+            except ImageUploadError as e:
+                new_filename_gcs = None
+                flash(str(e), 'danger')
             else:
-                flash('Tipo de archivo de imagen no permitido.', 'danger')
+                if not new_filename_gcs:
+                    flash('No se pudo subir la nueva imagen destacada a Google Cloud Storage. Se mantendrá la imagen anterior o por defecto.', 'warning')
+            if new_filename_gcs:
+                featured_image_filename_gcs = new_filename_gcs
         
         featured_image_url = get_public_image_url(featured_image_filename_gcs)
         # ... (Fin de la lógica de imagen) ...
@@ -1026,7 +3652,6 @@ def admin_blog_edit(post_id=None):
             for error in errores:
                 flash(error, 'danger')
             cur.close()
-            conn.close()
             return render_template('admin_blog_edit.html', post=post, admin_token=admin_token, default_image=app.config.get('DEFAULT_IMAGE_GCS_FILENAME'))
 
         try:
@@ -1042,6 +3667,9 @@ def admin_blog_edit(post_id=None):
                     """,
                     (title, slug, content, author, is_published, seo_title, seo_description, featured_image_filename_gcs, featured_image_url, post_id)
                 )
+                # La imagen antigua (si no es la por defecto) se borra de GCS solo si este UPDATE hace commit
+                if previous_image_filename_gcs not in (featured_image_filename_gcs, app.config.get('DEFAULT_IMAGE_GCS_FILENAME')):
+                    enqueue_gcs_deletion(cur, [previous_image_filename_gcs])
                 flash('Post de blog actualizado con éxito.', 'success')
             else:
                 # INSERT FINAL: Usa 'content', 'is_published' y 'created_at'
@@ -1054,11 +3682,13 @@ def admin_blog_edit(post_id=None):
                 new_id = cur.fetchone()[0]
                 flash('Nuevo post de blog creado con éxito.', 'success')
                 conn.commit()
+                invalidate_pages('blog')
                 cur.close()
-                conn.close()
                 return redirect(url_for('admin_blog_edit', post_id=new_id, admin_token=admin_token))
                 
             conn.commit()
+            invalidate_pages('blog')
+            notify_gcs_cleanup()
             
         except psycopg2.IntegrityError as e:
             conn.rollback()
@@ -1068,13 +3698,11 @@ def admin_blog_edit(post_id=None):
             flash(f'Error al guardar el post: {e}', 'danger')
         finally:
             cur.close()
-            conn.close()
             
         return redirect(url_for('admin_blog_list', admin_token=admin_token)) # Redirige después de UPDATE
 
     # Si es una solicitud GET
     cur.close()
-    conn.close()
     return render_template('admin_blog_edit.html', post=post, admin_token=admin_token, default_image=app.config.get('DEFAULT_IMAGE_GCS_FILENAME'))
 
 
@@ -1086,25 +3714,23 @@ def admin_blog_delete(post_id):
     cur = None
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
-        # Recuperar el nombre del archivo de imagen antes de eliminar el post
-        cur.execute("SELECT title, featured_image_filename_gcs FROM blog_posts WHERE id = %s", (post_id,))
+        cur.execute("DELETE FROM blog_posts WHERE id = %s RETURNING title, featured_image_filename_gcs", (post_id,))
         post_data = cur.fetchone()
         
         if not post_data:
+            conn.rollback()
             flash('Error: Post de blog no encontrado.', 'danger')
             return redirect(url_for('admin_blog_list', admin_token=admin_token))
 
+        # Si el post tenía una imagen y no era la por defecto, se encola para borrarla de GCS
         post_image_filename = post_data['featured_image_filename_gcs']
-        titulo_post = post_data['title'] 
-        
-        cur.execute("DELETE FROM blog_posts WHERE id = %s", (post_id,))
+        if post_image_filename != app.config.get('DEFAULT_IMAGE_GCS_FILENAME'):
+            enqueue_gcs_deletion(cur, [post_image_filename])
         conn.commit()
+        invalidate_pages('blog')
+        notify_gcs_cleanup()
 
-        # Si el post tenía una imagen y no era la por defecto, la eliminamos de GCS
-        if post_image_filename and post_image_filename != app.config.get('DEFAULT_IMAGE_GCS_FILENAME'):
-            delete_from_gcs(post_image_filename)
-
-        flash(f'El post "{titulo_post}" ha sido ELIMINADO permanentemente.', 'success')
+        flash(f'El post "{post_data["title"]}" ha sido ELIMINADO permanentemente.', 'success')
 
     except Exception as e:
         if conn:
@@ -1113,8 +3739,6 @@ def admin_blog_delete(post_id):
     finally:
         if cur:
             cur.close()
-        if conn:
-            conn.close()
 
     return redirect(url_for('admin_blog_list', admin_token=admin_token))
 
@@ -1163,18 +3787,130 @@ def politica_privacidad():
     return render_template('politica_privacidad.html')
 
 
+# Panel de administración: paginado, ordenable por columna y con filtros, todo en el servidor
+ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 50))
+# Solo las columnas que muestra la tabla de admin.html (más token_edicion para el enlace de edición)
+ADMIN_LIST_COLUMNS = ('id', 'nombre', 'email_contacto', 'telefono', 'actividad', 'sector', 'ubicacion', 'pais',
+                      'precio_venta', 'fecha_publicacion', 'active', 'token_edicion')
+ADMIN_SORT_COLUMNS = ('id', 'nombre', 'email_contacto', 'telefono', 'actividad', 'sector', 'ubicacion',
+                      'precio_venta', 'fecha_publicacion', 'active')
+ADMIN_FILTER_ARGS = ('estado', 'actividad', 'desde', 'hasta', 'orden', 'dir')
+
+def build_admin_filters(args):
+    """WHERE del panel de administración (estado, actividad y rango de fechas de publicación)."""
+    query = " WHERE TRUE"
+    params = []
+    estado = args.get('estado')
+    if estado == 'activos':
+        query += " AND active = TRUE"
+    elif estado == 'inactivos':
+        query += " AND active = FALSE"
+    if args.get('actividad'):
+        query += " AND actividad = %s"
+        params.append(args.get('actividad'))
+    for arg, condition in (('desde', "fecha_publicacion >= %s"), ('hasta', "fecha_publicacion < %s")):
+        try:
+            fecha = datetime.strptime(args.get(arg, ''), '%Y-%m-%d')
+        except ValueError:
+            continue # Ignora fechas vacías o mal formadas
+        query += " AND " + condition
+        params.append(fecha + timedelta(days=1) if arg == 'hasta' else fecha) # 'hasta' incluye ese día
+    return query, params
+
 # Ruta de administración (necesita un token para ser accesible)
 @app.route('/admin')
 @admin_required # Protege la ruta con el decorador
 def admin():
     token = request.args.get('admin_token') # El token se pasa como argumento, pero Flask lo obtiene del request
+    orden = request.args.get('orden') if request.args.get('orden') in ADMIN_SORT_COLUMNS else 'id'
+    direccion = 'asc' if request.args.get('dir') == 'asc' else 'desc'
+    try:
+        pagina = max(int(request.args.get('pagina', 1)), 1)
+    except ValueError:
+        pagina = 1
+
+    where_sql, params = build_admin_filters(request.args)
     conn = get_db_connection()
     cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor) # Usar DictCursor
-    cur.execute("SELECT * FROM empresas ORDER BY id DESC") # Ordena por ID para ver los más recientes primero
+    cur.execute("SELECT count(*) FROM empresas" + where_sql, params)
+    total = cur.fetchone()[0]
+    paginas = max(-(-total // ADMIN_PAGE_SIZE), 1)
+    pagina = min(pagina, paginas)
+    # id como desempate para que el orden sea estable entre páginas; los NULL siempre al final
+    cur.execute(f"SELECT {', '.join(ADMIN_LIST_COLUMNS)} FROM empresas{where_sql}"
+                f" ORDER BY {orden} {direccion} NULLS LAST, id {direccion} LIMIT %s OFFSET %s",
+                params + [ADMIN_PAGE_SIZE, (pagina - 1) * ADMIN_PAGE_SIZE])
     empresas = cur.fetchall()
     cur.close()
-    conn.close()
-    return render_template('admin.html', empresas=empresas, admin_token=token)
+
+    filtros = {k: request.args[k] for k in ADMIN_FILTER_ARGS if request.args.get(k)}
+    return render_template('admin.html', empresas=empresas, admin_token=token, filtros=filtros,
+                           orden=orden, direccion=direccion, pagina=pagina, paginas=paginas, total=total,
+                           actividades=ACTIVIDADES)
+
+
+# Acciones en lote del panel: una sola sentencia para todos los anuncios seleccionados
+@app.route('/admin/empresas/lote', methods=['POST'])
+@admin_required
+def admin_bulk_action():
+    admin_token = request.args.get('admin_token')
+    accion = request.form.get('accion')
+    # Vuelve a la misma página del panel, con sus filtros y orden
+    volver = request.form.get('volver') or ''
+    if not volver.startswith(url_for('admin')):
+        volver = url_for('admin', admin_token=admin_token)
+    try:
+        ids = sorted({int(i) for i in request.form.getlist('ids')})
+    except ValueError:
+        ids = []
+    if not ids or accion not in ('activar', 'desactivar', 'eliminar'):
+        flash('Selecciona al menos un anuncio y una acción.', 'warning')
+        return redirect(volver)
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        if accion == 'eliminar':
+            cur.execute("DELETE FROM empresas WHERE id = ANY(%s) RETURNING id, imagen_filename_gcs, imagen_variantes", (ids,))
+        else:
+            nuevo_estado = accion == 'activar'
+            cur.execute("UPDATE empresas SET active = %s WHERE id = ANY(%s) AND active IS DISTINCT FROM %s RETURNING id, NULL, NULL",
+                        (nuevo_estado, ids, nuevo_estado))
+        afectadas = cur.fetchall()
+        if accion == 'eliminar':
+            enqueue_image_deletion(cur, [(filename, variantes) for _, filename, variantes in afectadas])
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        flash(f'Error al aplicar la acción en lote: {e}', 'danger')
+        print(f"ERROR Admin Lote: Error al {accion} {len(ids)} anuncios: {e}")
+        return redirect(volver)
+    finally:
+        cur.close()
+
+    invalidate_pages('empresas', *(f'empresa:{empresa_id}' for empresa_id, _, _ in afectadas))
+    if accion == 'eliminar':
+        notify_gcs_cleanup()
+    textos = {'activar': 'activados', 'desactivar': 'desactivados', 'eliminar': 'ELIMINADOS permanentemente'}
+    flash(f'{len(afectadas)} anuncio(s) {textos[accion]}.', 'success')
+    return redirect(volver)
+
+
+# Estadísticas del pool de conexiones del worker que atiende la petición
+@app.route('/admin/db-pool-stats')
+@admin_required
+def admin_db_pool_stats():
+    return jsonify(get_db_pool().stats())
+
+
+# Contadores de la caché de páginas del worker que atiende la petición
+@app.route('/admin/cache-stats')
+@admin_required
+def admin_cache_stats():
+    stats = page_cache_stats.snapshot()
+    stats['backend'] = PAGE_CACHE_BACKEND if page_cache is not None else 'none'
+    stats['pid'] = os.getpid()
+    return jsonify(stats)
 
 
 # Ruta para CAMBIAR EL ESTADO (Activar/Desactivar) de un anuncio desde el panel de administración
@@ -1189,21 +3925,18 @@ def admin_toggle_active(empresa_id):
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-        # 1. Obtener el estado actual
-        cur.execute("SELECT active, nombre FROM empresas WHERE id = %s", (empresa_id,))
+        # Cambiar el estado en una sola sentencia: dos administradores a la vez no pueden pisarse
+        cur.execute("UPDATE empresas SET active = NOT active WHERE id = %s RETURNING active, nombre", (empresa_id,))
         empresa = cur.fetchone()
+        conn.commit()
 
         if not empresa:
             flash('Error: Anuncio no encontrado.', 'danger')
             return redirect(url_for('admin', admin_token=admin_token))
 
-        new_status = not empresa['active'] # Cambiar el estado
-        
-        # 2. Actualizar el estado en la base de datos
-        cur.execute("UPDATE empresas SET active = %s WHERE id = %s", (new_status, empresa_id))
-        conn.commit()
+        invalidate_pages('empresas', f'empresa:{empresa_id}')
 
-        status_text = "activado" if new_status else "desactivado"
+        status_text = "activado" if empresa['active'] else "desactivado"
         flash(f'El anuncio "{empresa["nombre"]}" ha sido {status_text} con éxito.', 'success')
 
     except Exception as e:
@@ -1214,8 +3947,6 @@ def admin_toggle_active(empresa_id):
     finally:
         if cur:
             cur.close()
-        if conn:
-            conn.close()
 
     return redirect(url_for('admin', admin_token=admin_token))
 
@@ -1232,26 +3963,21 @@ def admin_delete_ad(empresa_id):
         conn = get_db_connection()
         cur = conn.cursor(cursor_factory=psycopg2.extras.DictCursor)
 
-        # 1. Obtener el nombre de la imagen para eliminarla
-        cur.execute("SELECT nombre, imagen_filename_gcs FROM empresas WHERE id = %s", (empresa_id,))
+        # Eliminar la fila y encolar su imagen (si no es la por defecto) en la misma transacción
+        cur.execute("DELETE FROM empresas WHERE id = %s RETURNING nombre, imagen_filename_gcs, imagen_variantes", (empresa_id,))
         empresa = cur.fetchone()
 
         if not empresa:
+            conn.rollback()
             flash('Error: Anuncio no encontrado.', 'danger')
             return redirect(url_for('admin', admin_token=admin_token))
-        
-        imagen_filename_gcs = empresa['imagen_filename_gcs']
-        nombre_empresa = empresa['nombre']
 
-        # 2. Eliminar la imagen de GCS (si no es la por defecto)
-        if imagen_filename_gcs and imagen_filename_gcs != app.config['DEFAULT_IMAGE_GCS_FILENAME']:
-            delete_from_gcs(imagen_filename_gcs)
-            
-        # 3. Eliminar la entrada de la base de datos
-        cur.execute("DELETE FROM empresas WHERE id = %s", (empresa_id,))
+        enqueue_image_deletion(cur, [(empresa['imagen_filename_gcs'], empresa['imagen_variantes'])])
         conn.commit()
+        invalidate_pages('empresas', f'empresa:{empresa_id}')
+        notify_gcs_cleanup()
 
-        flash(f'El anuncio "{nombre_empresa}" ha sido ELIMINADO permanentemente.', 'success')
+        flash(f'El anuncio "{empresa["nombre"]}" ha sido ELIMINADO permanentemente.', 'success')
 
     except Exception as e:
         if conn:
@@ -1261,12 +3987,848 @@ def admin_delete_ad(empresa_id):
     finally:
         if cur:
             cur.close()
-        if conn:
-            conn.close()
 
     return redirect(url_for('admin', admin_token=admin_token))
 
 
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE EXPORTACIÓN E IMPORTACIÓN MASIVA DE EMPRESAS
+# ---------------------------------------------------------------
+# Exportación con COPY ... TO STDOUT (CSV o NDJSON) enviada en streaming, e importación
+# con COPY ... FROM STDIN a una tabla temporal de staging: las filas se validan en bloque
+# contra ACTIVIDADES_Y_SECTORES y PROVINCIAS_ESPANA, las válidas se insertan o actualizan
+# (clave: token_edicion) y se devuelve un informe de errores por fila. Para ficheros más
+# grandes que IMPORT_MAX_SIZE están los comandos 'flask empresas-export' y 'empresas-import'.
+
+EMPRESA_EXPORT_COLUMNS = (
+    'id', 'token_edicion', 'nombre', 'email_contacto', 'telefono', 'actividad', 'sector', 'pais',
+    'ubicacion', 'tipo_negocio', 'descripcion', 'facturacion', 'numero_empleados', 'local_propiedad',
+    'resultado_antes_impuestos', 'deuda', 'precio_venta', 'imagen_url', 'active',
+    'fecha_publicacion', 'fecha_modificacion',
+)
+# Columnas de la exportación que se aceptan al importar pero no se usan (la BD las gestiona)
+EMPRESA_IMPORT_IGNORED_COLUMNS = ('id', 'fecha_publicacion', 'fecha_modificacion')
+EMPRESA_IMPORT_COLUMNS = tuple(c for c in EMPRESA_EXPORT_COLUMNS if c not in EMPRESA_IMPORT_IGNORED_COLUMNS)
+# Las mismas reglas que el formulario de publicar()
+EMPRESA_IMPORT_REQUIRED_COLUMNS = (
+    'nombre', 'email_contacto', 'telefono', 'actividad', 'sector', 'ubicacion', 'tipo_negocio',
+    'descripcion', 'facturacion', 'numero_empleados', 'resultado_antes_impuestos', 'precio_venta',
+)
+EMPRESA_IMPORT_NUMERIC_COLUMNS = {
+    'facturacion': 'numeric', 'numero_empleados': 'integer', 'resultado_antes_impuestos': 'numeric',
+    'deuda': 'numeric', 'precio_venta': 'numeric',
+}
+# Límites de las columnas: numeric(15, 2) admite 13 dígitos enteros y 2 decimales
+IMPORT_NUMERIC_MAX = '9999999999999.99'
+IMPORT_NUMERIC_SCALE = 2
+IMPORT_INTEGER_MAX = 2147483647
+# Valores por defecto de las columnas opcionales al insertar
+EMPRESA_IMPORT_DEFAULTS = {'pais': "'España'", 'deuda': '0', 'active': 'TRUE', 'token_edicion': 'gen_random_uuid()::text'}
+EMPRESA_BULK_FORMATS = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+# Tamaño máximo del fichero subido en /admin/empresas/importar
+IMPORT_MAX_SIZE = int(os.environ.get('IMPORT_MAX_SIZE', 50 * 1024 * 1024))
+IMPORT_TOO_LARGE_MESSAGE = (f'El fichero excede el tamaño máximo de importación ({IMPORT_MAX_SIZE / (1024 * 1024):.0f} MB). '
+                            f'Para ficheros más grandes usa el comando flask empresas-import.')
+EXPORT_QUEUE_SIZE = 64 # Bloques en espera entre el hilo de COPY y la respuesta
+# Segundos que el hilo de COPY espera con la cola llena antes de abandonar (cliente atascado)
+EXPORT_STALL_TIMEOUT = int(os.environ.get('EXPORT_STALL_TIMEOUT', 60))
+
+class EmpresasImportError(Exception):
+    """Error que impide procesar el fichero entero (cabecera o formato no válidos)."""
+    pass
+
+def guess_bulk_format(filename, formato=None):
+    if formato:
+        formato = formato.lower()
+    elif filename and '.' in filename:
+        formato = filename.rsplit('.', 1)[1].lower()
+        formato = 'ndjson' if formato in ('jsonl', 'json') else formato
+    if formato not in EMPRESA_BULK_FORMATS:
+        raise EmpresasImportError(f"Formato no soportado: {formato or 'desconocido'}. Usa csv o ndjson.")
+    return formato
+
+def export_copy_sql(formato):
+    select = f"SELECT {', '.join(EMPRESA_EXPORT_COLUMNS)} FROM empresas ORDER BY id"
+    if formato == 'csv':
+        return f"COPY ({select}) TO STDOUT WITH (FORMAT csv, HEADER)"
+    # NDJSON: un objeto JSON por línea. Se usa el modo csv con comillas y delimitador que nunca
+    # aparecen en el JSON (los caracteres de control van escapados) para que COPY no duplique las '\'
+    return (f"COPY (SELECT row_to_json(e) FROM ({select}) AS e) TO STDOUT"
+            f" WITH (FORMAT csv, QUOTE E'\\x01', DELIMITER E'\\x02')")
+
+def export_empresas(conn, formato, out):
+    """Escribe todas las empresas en 'out' (cualquier objeto con write()) con COPY ... TO STDOUT."""
+    cur = conn.cursor()
+    try:
+        cur.copy_expert(export_copy_sql(formato), out)
+    finally:
+        cur.close()
+    conn.rollback()
+
+class _QueueWriter:
+    """Fichero de solo escritura que pasa los bloques de COPY a una cola acotada."""
+
+    def __init__(self, chunks, cancelled):
+        self.chunks = chunks
+        self.cancelled = cancelled
+
+    def put(self, item):
+        """Encola sin bloquear para siempre: aborta si el cliente cancela o deja de leer."""
+        deadline = time.monotonic() + EXPORT_STALL_TIMEOUT
+        while True:
+            if self.cancelled.is_set():
+                raise IOError("Exportación cancelada por el cliente")
+            try:
+                self.chunks.put(item, timeout=1)
+                return
+            except queue.Full:
+                if time.monotonic() > deadline:
+                    self.cancelled.set()
+                    raise IOError(f"El cliente no ha leído la exportación en {EXPORT_STALL_TIMEOUT} s")
+
+    def write(self, data):
+        self.put(data)
+        return len(data)
+
+def export_error_marker(formato):
+    """Última línea de una exportación que falló a medias (la respuesta ya salió con 200)."""
+    mensaje = "EXPORTACION INCOMPLETA: se produjo un error en el servidor; el fichero no contiene todas las empresas."
+    if formato == 'csv':
+        return f"#{mensaje}\n"
+    return json.dumps({'error': mensaje}) + "\n"
+
+def stream_empresas_export(formato):
+    """
+    Generador con la exportación: COPY se ejecuta en un hilo con su propia conexión del pool y
+    escribe en una cola acotada, así la memoria no depende del tamaño de la tabla. Si el cliente
+    se desconecta, el hilo aborta el COPY y devuelve la conexión. Si el COPY falla a medias, el
+    fichero termina con export_error_marker() en lugar de cortarse sin aviso.
+    """
+    chunks = queue.Queue(maxsize=EXPORT_QUEUE_SIZE)
+    cancelled = threading.Event()
+    done = object()
+    failed = object()
+
+    def run():
+        writer = _QueueWriter(chunks, cancelled)
+        pool = get_db_pool()
+        conn = pool.getconn()
+        result = done
+        try:
+            export_empresas(conn, formato, writer)
+        except Exception as e:
+            result = failed
+            if not cancelled.is_set():
+                print(f"ERROR Exportación: Falló el COPY de empresas: {e}")
+        finally:
+            pool.putconn(conn)
+        try:
+            writer.put(result)
+        except IOError:
+            pass # El cliente ya no está leyendo
+
+    threading.Thread(target=run, name='empresas-export', daemon=True).start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            if chunk is failed:
+                yield export_error_marker(formato)
+                break
+            yield chunk
+    finally:
+        cancelled.set()
+
+class _GeneratorReader:
+    """Fichero de solo lectura sobre un generador de cadenas, para COPY ... FROM STDIN."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+def import_value_to_text(value):
+    """Valor de un registro NDJSON como texto para el staging ('' = NULL)."""
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    return str(value)
+
+def iter_import_records(text_stream, formato):
+    """
+    Lee el fichero registro a registro. Devuelve (columnas_de_la_cabecera, generador) donde el
+    generador produce (fila, {columna: texto}, errores). 'fila' es el número de línea en NDJSON
+    y el número de fila de hoja de cálculo en CSV (la cabecera es la fila 1).
+    """
+    if formato == 'csv':
+        reader = csv.reader(text_stream)
+        header = [h.strip() for h in next(reader, [])]
+        unknown = [h for h in header if h not in EMPRESA_IMPORT_COLUMNS and h not in EMPRESA_IMPORT_IGNORED_COLUMNS]
+        missing = [c for c in EMPRESA_IMPORT_REQUIRED_COLUMNS if c not in header]
+        if unknown or missing:
+            raise EmpresasImportError(
+                "Cabecera no válida." + (f" Columnas desconocidas: {', '.join(unknown)}." if unknown else "")
+                + (f" Faltan columnas: {', '.join(missing)}." if missing else ""))
+
+        def records():
+            for fila, values in enumerate(reader, start=2):
+                if not any(v.strip() for v in values):
+                    continue # Líneas vacías
+                if len(values) != len(header):
+                    yield fila, None, [f"Tiene {len(values)} columnas y la cabecera {len(header)}."]
+                    continue
+                yield fila, {h: v.strip() for h, v in zip(header, values) if h in EMPRESA_IMPORT_COLUMNS}, []
+        return [h for h in header if h in EMPRESA_IMPORT_COLUMNS], records()
+
+    def records():
+        for fila, line in enumerate(text_stream, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError as e:
+                yield fila, None, [f"JSON no válido: {e}"]
+                continue
+            if not isinstance(record, dict):
+                yield fila, None, ["Cada línea debe ser un objeto JSON."]
+                continue
+            unknown = [k for k in record if k not in EMPRESA_IMPORT_COLUMNS and k not in EMPRESA_IMPORT_IGNORED_COLUMNS]
+            if unknown:
+                yield fila, None, [f"Campos desconocidos: {', '.join(unknown)}."]
+                continue
+            yield fila, {k: import_value_to_text(v).strip() for k, v in record.items() if k in EMPRESA_IMPORT_COLUMNS}, []
+    return None, records()
+
+# Parámetros de la validación de taxonomía, calculados una sola vez
+_IMPORT_SECTOR_PAIRS = [(a, sector) for a, sectores in ACTIVIDADES_Y_SECTORES.items() for sector in sectores]
+IMPORT_TAXONOMIA_PARAMS = types.MappingProxyType({
+    'actividades': list(ACTIVIDADES),
+    'sector_actividades': [a for a, _ in _IMPORT_SECTOR_PAIRS],
+    'sectores': [sector for _, sector in _IMPORT_SECTOR_PAIRS],
+    'provincias': PROVINCIAS_ESPANA,
+})
+
+def import_validation_sql():
+    """INSERT que guarda en el staging de errores un mensaje por cada regla que incumple cada fila."""
+    checks = [
+        "CASE WHEN nombre IS NULL THEN 'El nombre de la empresa es obligatorio.' END",
+        "CASE WHEN email_contacto IS NULL OR position('@' in email_contacto) = 0 THEN 'El email de contacto es obligatorio y debe ser válido.' END",
+        "CASE WHEN telefono IS NULL OR telefono !~ '^[0-9]{9}$' THEN 'El teléfono de contacto es obligatorio y debe tener 9 dígitos numéricos.' END",
+        "CASE WHEN actividad IS NULL OR NOT (actividad = ANY(%(actividades)s)) THEN 'Actividad no válida: ' || coalesce(actividad, '(vacía)') END",
+        "CASE WHEN actividad = ANY(%(actividades)s) AND (sector IS NULL OR NOT EXISTS ("
+        " SELECT 1 FROM unnest(%(sector_actividades)s::text[], %(sectores)s::text[]) AS t(a, s)"
+        " WHERE t.a = i.actividad AND t.s = i.sector)) THEN 'Sector no válido para la actividad: ' || coalesce(sector, '(vacío)') END",
+        "CASE WHEN ubicacion IS NULL OR NOT (ubicacion = ANY(%(provincias)s)) THEN 'Provincia no válida: ' || coalesce(ubicacion, '(vacía)') END",
+        "CASE WHEN tipo_negocio IS NULL THEN 'El tipo de negocio es obligatorio.' END",
+        "CASE WHEN descripcion IS NULL THEN 'La descripción del negocio es obligatoria.' END",
+        "CASE WHEN active IS NOT NULL AND lower(active) NOT IN ('true', 'false', 't', 'f', '1', '0') THEN 'active debe ser true o false.' END",
+    ]
+    for column, sql_type in EMPRESA_IMPORT_NUMERIC_COLUMNS.items():
+        pattern = '^[0-9]+$' if sql_type == 'integer' else '^-?[0-9]+([.][0-9]+)?$'
+        if column in EMPRESA_IMPORT_REQUIRED_COLUMNS:
+            checks.append(f"CASE WHEN {column} IS NULL THEN '{column} es obligatorio.' END")
+        checks.append(f"CASE WHEN {column} !~ '{pattern}' THEN '{column} no es un número válido: ' || {column} END")
+        if column != 'resultado_antes_impuestos':
+            checks.append(f"CASE WHEN {column} ~ '^-' THEN '{column} no puede ser negativo.' END")
+        # Rango y decimales: el CASE anidado solo convierte los valores con formato válido
+        if sql_type == 'integer':
+            checks.append(f"CASE WHEN {column} ~ '{pattern}' THEN CASE WHEN {column}::numeric > {IMPORT_INTEGER_MAX}"
+                          f" THEN '{column} es demasiado grande (máximo {IMPORT_INTEGER_MAX}): ' || {column} END END")
+        else:
+            checks.append(f"CASE WHEN {column} ~ '[.][0-9]{{{IMPORT_NUMERIC_SCALE + 1},}}$'"
+                          f" THEN '{column} admite como máximo {IMPORT_NUMERIC_SCALE} decimales: ' || {column} END")
+            checks.append(f"CASE WHEN {column} ~ '{pattern}' THEN CASE WHEN abs({column}::numeric) > {IMPORT_NUMERIC_MAX}"
+                          f" THEN '{column} es demasiado grande (máximo {IMPORT_NUMERIC_MAX}): ' || {column} END END")
+    values = ", ".join(f"({check})" for check in checks)
+    return f"""
+        INSERT INTO empresas_importacion_errores (fila, mensaje)
+        SELECT i.fila, v.mensaje
+        FROM empresas_importacion AS i
+        CROSS JOIN LATERAL (VALUES {values}) AS v(mensaje)
+        WHERE v.mensaje IS NOT NULL
+    """
+
+def import_upsert_sql(provided_columns):
+    """
+    Inserta las filas sin errores y actualiza las existentes (mismo token_edicion). Al actualizar
+    solo se tocan las columnas que trae el fichero, para no pisar datos con valores por defecto.
+    """
+    def value(column):
+        expr = f"i.{column}"
+        if column in EMPRESA_IMPORT_NUMERIC_COLUMNS:
+            expr = f"{expr}::{EMPRESA_IMPORT_NUMERIC_COLUMNS[column]}"
+        elif column == 'active':
+            expr = f"{expr}::boolean"
+        if column in EMPRESA_IMPORT_DEFAULTS:
+            expr = f"COALESCE({expr}, {EMPRESA_IMPORT_DEFAULTS[column]})"
+        return expr
+
+    updates = [f"{c} = EXCLUDED.{c}" for c in EMPRESA_IMPORT_COLUMNS if c in provided_columns and c != 'token_edicion']
+    updates.append("fecha_modificacion = NOW()")
+    return f"""
+        INSERT INTO empresas ({', '.join(EMPRESA_IMPORT_COLUMNS)})
+        SELECT {', '.join(value(c) for c in EMPRESA_IMPORT_COLUMNS)}
+        FROM empresas_importacion AS i
+        WHERE NOT EXISTS (SELECT 1 FROM empresas_importacion_errores AS e WHERE e.fila = i.fila)
+        ORDER BY i.fila
+        ON CONFLICT (token_edicion) DO UPDATE SET {', '.join(updates)}
+        RETURNING id, (xmax = 0) AS insertada
+    """
+
+def import_empresas(conn, text_stream, formato, dry_run=False):
+    """
+    Importa un fichero CSV o NDJSON de empresas en una sola transacción (con dry_run se deshace).
+    Devuelve el informe: {'filas', 'insertadas', 'actualizadas', 'errores': [(fila, [mensajes])]}.
+    Lanza EmpresasImportError si el fichero no se puede procesar en absoluto.
+    """
+    header_columns, records = iter_import_records(text_stream, formato)
+    cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+    staging_columns = ", ".join(f"{c} text" for c in EMPRESA_IMPORT_COLUMNS)
+    cur.execute(f"CREATE TEMP TABLE empresas_importacion (fila integer PRIMARY KEY, {staging_columns}) ON COMMIT DROP")
+    cur.execute("CREATE TEMP TABLE empresas_importacion_errores (fila integer, mensaje text) ON COMMIT DROP")
+
+    errores = collections.defaultdict(list)
+    provided_columns = set(header_columns or ())
+    total = 0
+
+    def staging_lines():
+        nonlocal total
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        for fila, record, record_errors in records:
+            total += 1
+            if record_errors:
+                errores[fila].extend(record_errors)
+                continue
+            provided_columns.update(k for k, v in record.items() if v)
+            # '' se carga como NULL (valor sin comillas en el modo csv de COPY)
+            writer.writerow([fila] + [record.get(c) or None for c in EMPRESA_IMPORT_COLUMNS])
+            if buffer.tell() > 64 * 1024:
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue()
+
+    try:
+        cur.copy_expert(f"COPY empresas_importacion (fila, {', '.join(EMPRESA_IMPORT_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                        _GeneratorReader(staging_lines()))
+
+        # Reglas de validación en bloque: taxonomía, provincias, obligatorios y números
+        cur.execute(import_validation_sql(), IMPORT_TAXONOMIA_PARAMS)
+        cur.execute("""
+            INSERT INTO empresas_importacion_errores (fila, mensaje)
+            SELECT fila, 'token_edicion repetido en el fichero: ' || token_edicion
+            FROM (SELECT fila, token_edicion, row_number() OVER (PARTITION BY token_edicion ORDER BY fila) AS n
+                  FROM empresas_importacion WHERE token_edicion IS NOT NULL) AS t
+            WHERE n > 1
+        """)
+        cur.execute("SELECT fila, mensaje FROM empresas_importacion_errores ORDER BY fila")
+        for fila, mensaje in cur.fetchall():
+            errores[fila].append(mensaje)
+
+        cur.execute(import_upsert_sql(provided_columns))
+        results = cur.fetchall()
+        if dry_run:
+            conn.rollback()
+        else:
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+    if results and not dry_run:
+        updated_ids = [empresa_id for empresa_id, insertada in results if not insertada]
+        invalidate_pages('empresas', *(f'empresa:{empresa_id}' for empresa_id in updated_ids))
+    insertadas = sum(1 for _, insertada in results if insertada)
+    return {
+        'filas': total,
+        'insertadas': insertadas,
+        'actualizadas': len(results) - insertadas,
+        'errores': sorted(errores.items()),
+        'simulacion': dry_run,
+    }
+
+@app.route('/admin/empresas/exportar')
+@admin_required
+def admin_export_empresas():
+    formato = request.args.get('formato', 'csv')
+    if formato not in EMPRESA_BULK_FORMATS:
+        flash('Formato de exportación no soportado.', 'danger')
+        return redirect(url_for('admin', admin_token=request.args.get('admin_token')))
+    filename = f"empresas-{datetime.now().strftime('%Y%m%d-%H%M')}.{formato}"
+    response = Response(stream_empresas_export(formato), mimetype=EMPRESA_BULK_FORMATS[formato])
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+@app.route('/admin/empresas/importar', methods=['POST'])
+@upload_limit(IMPORT_MAX_SIZE, IMPORT_TOO_LARGE_MESSAGE)
+@admin_required
+def admin_import_empresas():
+    token = request.args.get('admin_token')
+    archivo = request.files.get('archivo')
+    if not archivo or not archivo.filename:
+        flash('Selecciona un fichero CSV o NDJSON para importar.', 'danger')
+        return redirect(url_for('admin', admin_token=token))
+    try:
+        formato = guess_bulk_format(archivo.filename, request.form.get('formato'))
+        text_stream = io.TextIOWrapper(archivo.stream, encoding='utf-8-sig', newline='')
+        informe = import_empresas(get_db_connection(), text_stream, formato, dry_run='simulacion' in request.form)
+    except (EmpresasImportError, UnicodeDecodeError, csv.Error) as e:
+        flash(f'No se pudo importar el fichero: {e}', 'danger')
+        return redirect(url_for('admin', admin_token=token))
+    except psycopg2.Error as e:
+        # import_empresas() ya ha deshecho la transacción: no se ha guardado nada
+        print(f"ERROR Importación: Error de base de datos al importar {archivo.filename}: {e}")
+        flash('No se pudo importar el fichero por un error de la base de datos. No se ha guardado ninguna fila.', 'danger')
+        return redirect(url_for('admin', admin_token=token))
+    return render_template('admin_importacion.html', informe=informe, admin_token=token, archivo=archivo.filename)
+
+@app.cli.command('empresas-export')
+@click.option('--formato', type=click.Choice(list(EMPRESA_BULK_FORMATS)), default='csv', show_default=True)
+@click.option('--salida', default='-', help='Fichero de salida (por defecto, la salida estándar).')
+def empresas_export_command(formato, salida):
+    """Exporta todas las empresas con COPY ... TO STDOUT."""
+    with click.open_file(salida, 'w', encoding='utf-8') as out:
+        export_empresas(get_db_connection(), formato, out)
+
+@app.cli.command('empresas-import')
+@click.argument('fichero', type=click.Path(exists=True, dir_okay=False))
+@click.option('--formato', type=click.Choice(list(EMPRESA_BULK_FORMATS)), default=None,
+              help='Por defecto se deduce de la extensión del fichero.')
+@click.option('--dry-run', is_flag=True, help='Valida e informa sin guardar nada.')
+@click.option('--informe', type=click.Path(dir_okay=False), default=None,
+              help='Guarda los errores por fila en este CSV (fila, error).')
+def empresas_import_command(fichero, formato, dry_run, informe):
+    """Importa empresas desde CSV o NDJSON (inserta nuevas y actualiza por token_edicion)."""
+    try:
+        formato = guess_bulk_format(fichero, formato)
+        with open(fichero, encoding='utf-8-sig', newline='') as f:
+            resultado = import_empresas(get_db_connection(), f, formato, dry_run=dry_run)
+    except EmpresasImportError as e:
+        raise click.ClickException(str(e))
+    except psycopg2.Error as e:
+        raise click.ClickException(f"Error de base de datos (no se ha guardado nada): {e}")
+
+    prefijo = "(simulación) " if dry_run else ""
+    click.echo(f"{prefijo}{resultado['filas']} filas leídas: {resultado['insertadas']} insertadas, "
+               f"{resultado['actualizadas']} actualizadas, {len(resultado['errores'])} con errores.")
+    if informe:
+        with open(informe, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['fila', 'error'])
+            for fila, mensajes in resultado['errores']:
+                for mensaje in mensajes:
+                    writer.writerow([fila, mensaje])
+    else:
+        for fila, mensajes in resultado['errores'][:20]:
+            click.echo(f"  Fila {fila}: {' '.join(mensajes)}")
+        if len(resultado['errores']) > 20:
+            click.echo("  ... usa --informe para ver todos los errores.")
+    if resultado['errores']:
+        raise SystemExit(1)
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE EXPORTACIÓN E IMPORTACIÓN MASIVA DE EMPRESAS
+# -------------------------------------------------------------
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE API JSON DE SOLO LECTURA (v1)
+# ---------------------------------------------------------------
+# Para socios agregadores y el front-end: los mismos filtros y paginación por cursor que
+# index(), selección de campos con ?fields=a,b y respuestas generadas fila a fila desde un
+# cursor de servidor. Solo se exponen columnas públicas: nunca nombre (la empresa es
+# confidencial y detalle.html tampoco lo muestra), token_edicion, email_contacto ni telefono.
+
+API_MAX_PAGE_SIZE = int(os.environ.get('API_MAX_PAGE_SIZE', 200))
+API_FETCH_SIZE = 100 # Filas por viaje a la BD del cursor de servidor
+
+EMPRESA_API_FIELDS = (
+    'id', 'actividad', 'sector', 'pais', 'ubicacion', 'tipo_negocio', 'descripcion',
+    'facturacion', 'numero_empleados', 'local_propiedad', 'resultado_antes_impuestos', 'deuda',
+    'precio_venta', 'imagen_url', 'imagen_variantes', 'fecha_publicacion', 'fecha_modificacion',
+)
+EMPRESA_API_LIST_FIELDS = ListingCard._fields # Por defecto, lo mismo que muestra la tarjeta del listado
+BLOG_API_FIELDS = (
+    'id', 'title', 'slug', 'author', 'seo_title', 'seo_description', 'content',
+    'featured_image_url', 'created_at', 'updated_at',
+)
+BLOG_API_LIST_FIELDS = tuple(f for f in BLOG_API_FIELDS if f != 'content')
+
+class ApiError(Exception):
+    """Error de la API que se devuelve como {"error": mensaje} con el código indicado."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+@app.errorhandler(ApiError)
+def handle_api_error(error):
+    return jsonify({'error': error.message}), error.status
+
+def api_json_default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Tipo no serializable: {type(value).__name__}")
+
+def api_dumps(obj):
+    return json.dumps(obj, default=api_json_default, ensure_ascii=False, separators=(',', ':'))
+
+def parse_api_fields(args, allowed, default):
+    """Campos pedidos en ?fields= (en su orden), validados contra la lista de columnas públicas."""
+    raw = args.get('fields')
+    if not raw:
+        return tuple(default)
+    fields = tuple(dict.fromkeys(f.strip() for f in raw.split(',') if f.strip()))
+    invalid = [f for f in fields if f not in allowed]
+    if invalid or not fields:
+        raise ApiError(f"Campos no válidos: {', '.join(invalid) or raw}. Disponibles: {', '.join(allowed)}")
+    return fields
+
+def api_page_url(cursor_arg, cursor):
+    """URL absoluta de otra página del mismo endpoint, conservando filtros y campos."""
+    args = {k: v for k, v in request.args.items() if k not in LISTING_CURSOR_ARGS}
+    args[cursor_arg] = cursor
+    return url_for(request.endpoint, _external=True, **request.view_args, **args)
+
+def stream_api_page(rows, fields, cursor_of, page_size, has_prev, has_next=None):
+    """
+    Genera {"data": [...], "links": {"prev": ..., "next": ...}} fila a fila sin montar la lista
+    en memoria. 'rows' trae como mucho page_size + 1 diccionarios: si llega la fila extra,
+    hay página siguiente (salvo que has_next ya se conozca).
+    """
+    yield '{"data":['
+    first = last = None
+    count = 0
+    for row in rows:
+        if count == page_size:
+            has_next = True if has_next is None else has_next
+            break
+        yield (',' if count else '') + api_dumps({f: row[f] for f in fields})
+        first = first or row
+        last = row
+        count += 1
+    links = {
+        'prev': api_page_url('before', cursor_of(first)) if has_prev and first else None,
+        'next': api_page_url('after', cursor_of(last)) if has_next and last else None,
+    }
+    yield '],"links":' + api_dumps(links) + '}'
+
+def api_response(chunks):
+    return Response(stream_with_context(chunks), mimetype='application/json')
+
+def api_empresas_validators():
+    # count(imagen_variantes): las variantes de imagen cambian la respuesta sin tocar fecha_modificacion
+    row = fetch_validator_row(
+        "SELECT max(fecha_modificacion), count(*), count(imagen_variantes) FROM empresas WHERE active = TRUE")
+    return row[0], ('api_empresas', row[0].isoformat() if row[0] else '', row[1], row[2])
+
+@app.route('/api/v1/empresas')
+@conditional_page(api_empresas_validators)
+def api_empresas():
+    """Listado de anuncios activos con los filtros de index() (incluida la búsqueda ?q=)."""
+    fields = parse_api_fields(request.args, EMPRESA_API_FIELDS, EMPRESA_API_LIST_FIELDS)
+    page_size = get_listing_page_size(request.args, API_MAX_PAGE_SIZE)
+    after = decode_listing_cursor(request.args.get('after'))
+    before = decode_listing_cursor(request.args.get('before')) if not after else None
+
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+    search = parse_listing_search(cur, request.args)
+    cur.close()
+    where_sql, params = build_empresas_filters(request.args, search)
+    # Las columnas del cursor se seleccionan siempre aunque no se hayan pedido
+    columns = ", ".join(dict.fromkeys(fields + ('fecha_publicacion', 'id')))
+    query, params, after, before = build_empresas_page_query(columns, where_sql, params, page_size,
+                                                            after, before, listing_search_rank(search))
+
+    def cursor_of(row):
+        return encode_listing_cursor(row['fecha_publicacion'], row['id'], row.get('rango'))
+
+    if before:
+        # La página anterior se lee al revés: como mucho page_size + 1 filas en memoria
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        cur.close()
+        has_prev = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        return api_response(stream_api_page(rows, fields, cursor_of, page_size, has_prev, has_next=True))
+
+    def generate():
+        # El cursor de servidor se abre dentro del generador. api_response() usa
+        # stream_with_context, así que el contexto de la petición (y con él su conexión)
+        # sigue abierto hasta que se envía el último trozo; solo entonces vuelve al pool.
+        cur = get_db_connection().cursor('api_empresas', cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.itersize = API_FETCH_SIZE
+        try:
+            cur.execute(query, params)
+            yield from stream_api_page(cur, fields, cursor_of, page_size, has_prev=after is not None)
+        finally:
+            cur.close()
+    return api_response(generate())
+
+@app.route('/api/v1/empresas/<int:empresa_id>')
+@conditional_page(empresa_validators)
+def api_empresa(empresa_id):
+    """Un anuncio activo. Por defecto devuelve todos los campos públicos."""
+    fields = parse_api_fields(request.args, EMPRESA_API_FIELDS, EMPRESA_API_FIELDS)
+    conn = get_db_connection()
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+    cur.execute(f"SELECT {', '.join(fields)} FROM empresas WHERE id = %s AND active = TRUE", (empresa_id,))
+    row = cur.fetchone()
+    cur.close()
+    if row is None:
+        raise ApiError('Negocio no encontrado o no activo.', 404)
+    return Response(api_dumps({'data': dict(row)}), mimetype='application/json')
+
+@app.route('/api/v1/blog')
+@conditional_page(blog_list_validators)
+def api_blog():
+    """Artículos publicados, del más reciente al más antiguo. Paginación hacia delante con ?after=."""
+    fields = parse_api_fields(request.args, BLOG_API_FIELDS, BLOG_API_LIST_FIELDS)
+    page_size = get_listing_page_size(request.args, API_MAX_PAGE_SIZE)
+    after = decode_listing_cursor(request.args.get('after'))
+    if after and len(after) != 2:
+        after = None
+
+    query = f"SELECT {', '.join(dict.fromkeys(fields + ('created_at', 'id')))} FROM blog_posts WHERE is_published = TRUE"
+    params = []
+    if after:
+        query += " AND (created_at, id) < (%s, %s)"
+        params.extend(after)
+    query += " ORDER BY created_at DESC, id DESC LIMIT %s"
+    params.append(page_size + 1)
+
+    def cursor_of(row):
+        return encode_listing_cursor(row['created_at'], row['id'])
+
+    def generate():
+        cur = get_db_connection().cursor('api_blog', cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.itersize = API_FETCH_SIZE
+        try:
+            cur.execute(query, params)
+            # Sin enlace 'prev': el blog solo se recorre hacia delante
+            yield from stream_api_page(cur, fields, cursor_of, page_size, has_prev=False)
+        finally:
+            cur.close()
+    return api_response(generate())
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE API JSON DE SOLO LECTURA (v1)
+# -------------------------------------------------------------
+
+# -------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE MIGRACIONES DE ESQUEMA (CLI)
+# -------------------------------------------------------------
+
+# Ficheros NNNN_descripcion.sql que se aplican en orden y una sola vez
+MIGRATIONS_DIR = os.path.join(app.root_path, 'migrations')
+# Clave del advisory lock para que dos despliegues no migren a la vez
+MIGRATIONS_LOCK_KEY = 7201001
+
+def list_migrations():
+    """Devuelve [(versión, nombre_fichero)] ordenadas por versión."""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        if not filename.endswith('.sql'):
+            continue
+        version = filename.split('_', 1)[0]
+        if version.isdigit():
+            migrations.append((int(version), filename))
+    return migrations
+
+def apply_migrations(conn, dry_run=False):
+    """
+    Aplica las migraciones pendientes, cada una en su propia transacción.
+    Devuelve la lista de ficheros aplicados (o pendientes si dry_run).
+    """
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            filename TEXT NOT NULL,
+            applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+    """)
+    conn.commit()
+
+    cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+    applied = []
+    try:
+        cur.execute("SELECT version FROM schema_migrations")
+        done = {row[0] for row in cur.fetchall()}
+        for version, filename in list_migrations():
+            if version in done:
+                continue
+            if dry_run:
+                applied.append(filename)
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, filename), encoding='utf-8') as f:
+                sql = f.read()
+            try:
+                cur.execute(sql)
+                cur.execute("INSERT INTO schema_migrations (version, filename) VALUES (%s, %s)", (version, filename))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            applied.append(filename)
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+        conn.commit()
+        cur.close()
+    return applied
+
+@app.cli.command('db-migrate')
+@click.option('--dry-run', is_flag=True, help='Muestra las migraciones pendientes sin aplicarlas.')
+def db_migrate_command(dry_run):
+    """Aplica las migraciones pendientes de la carpeta migrations/."""
+    conn = get_db_connection()
+    applied = apply_migrations(conn, dry_run=dry_run)
+    if not applied:
+        click.echo("INFO Migraciones: El esquema ya está al día.")
+    for filename in applied:
+        click.echo(f"INFO Migraciones: {'Pendiente' if dry_run else 'Aplicada'} {filename}")
+
+
+# Consultas calientes que deben resolverse siempre con índice: (nombre, SQL, parámetros de ejemplo)
+HOT_QUERIES = [
+    ("index sin filtros",
+     f"SELECT {LISTING_CARD_COLUMNS} FROM empresas WHERE active = TRUE ORDER BY fecha_publicacion DESC, id DESC LIMIT 25", []),
+    ("index por actividad y sector",
+     f"SELECT {LISTING_CARD_COLUMNS} FROM empresas WHERE active = TRUE AND actividad = %s AND sector = %s ORDER BY fecha_publicacion DESC, id DESC LIMIT 25",
+     ["Hostelería y Restauración", "Restaurantes"]),
+    ("index por provincia",
+     f"SELECT {LISTING_CARD_COLUMNS} FROM empresas WHERE active = TRUE AND ubicacion = %s ORDER BY fecha_publicacion DESC, id DESC LIMIT 25",
+     ["Madrid"]),
+    ("index por precio máximo",
+     f"SELECT {LISTING_CARD_COLUMNS} FROM empresas WHERE active = TRUE AND precio_venta <= %s ORDER BY fecha_publicacion DESC, id DESC LIMIT 25",
+     [100000]),
+    ("index con búsqueda por texto",
+     f"SELECT {LISTING_CARD_COLUMNS} FROM empresas WHERE active = TRUE AND (busqueda @@ websearch_to_tsquery('spanish', %s)"
+     " OR lower(tipo_negocio) %% lower(%s)) LIMIT 25",
+     ["restaurante terraza", "restaurante terraza"]),
+    ("editar por token",
+     "SELECT * FROM empresas WHERE token_edicion = %s", ["00000000-0000-0000-0000-000000000000"]),
+    ("blog por slug",
+     "SELECT * FROM blog_posts WHERE slug = %s AND is_published = TRUE", ["slug-de-ejemplo"]),
+    ("listado del blog",
+     "SELECT id, title, slug, created_at, featured_image_url FROM blog_posts WHERE is_published = TRUE ORDER BY created_at DESC", []),
+]
+
+def find_seq_scans(plan):
+    """Recorre un plan de EXPLAIN (FORMAT JSON) y devuelve las tablas leídas con Seq Scan."""
+    found = []
+    if plan.get('Node Type') == 'Seq Scan':
+        found.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        found.extend(find_seq_scans(child))
+    return found
+
+@app.cli.command('db-check-indexes')
+def db_check_indexes_command():
+    """
+    Comprueba con EXPLAIN que ninguna consulta caliente hace un Seq Scan.
+    Se desactiva enable_seqscan para que, con tablas pequeñas, el planificador
+    solo elija Seq Scan cuando no existe un índice utilizable.
+    """
+    conn = get_db_connection()
+    cur = conn.cursor()
+    failures = []
+    try:
+        cur.execute("SET LOCAL enable_seqscan = off")
+        for name, sql, params in HOT_QUERIES:
+            cur.execute("EXPLAIN (FORMAT JSON) " + sql, params)
+            plan = cur.fetchone()[0][0]['Plan']
+            seq_scans = find_seq_scans(plan)
+            if seq_scans:
+                failures.append(name)
+                click.echo(f"ERROR Índices: '{name}' hace Seq Scan sobre {', '.join(seq_scans)}")
+            else:
+                click.echo(f"OK Índices: '{name}'")
+    finally:
+        conn.rollback()
+        cur.close()
+    if failures:
+        raise SystemExit(1)
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE MIGRACIONES DE ESQUEMA (CLI)
+# -------------------------------------------------------------
+
+
+# ---------------------------------------------------------------
+# INICIO DE LA SECCIÓN DE PRECOMPILACIÓN DE PLANTILLAS
+# ---------------------------------------------------------------
+# Cada worker compilaba las plantillas en su primera petición. Ahora el bytecode de
+# Jinja se guarda en disco (compartido por los workers de la máquina y entre reinicios)
+# y todas las plantillas se cargan al arrancar, después de registrar todos los filtros.
+
+# Por defecto Jinja usa una carpeta privada del usuario (_jinja2-cache-<uid>, modo 0700) y
+# comprueba su propietario: el bytecode se deserializa, nunca debe poder escribirlo otro usuario
+JINJA_BYTECODE_CACHE_DIR = os.environ.get('JINJA_BYTECODE_CACHE_DIR')
+# Desactivar (=0) para compilar cada plantilla en su primera petición, como antes
+JINJA_PRECOMPILE = os.environ.get('JINJA_PRECOMPILE', '1') != '0'
+
+try:
+    if JINJA_BYTECODE_CACHE_DIR:
+        os.makedirs(JINJA_BYTECODE_CACHE_DIR, mode=0o700, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_BYTECODE_CACHE_DIR, '%s.jinja.cache')
+except (OSError, RuntimeError) as e:
+    # RuntimeError: la carpeta por defecto existe pero no es segura (otro propietario o permisos)
+    print(f"ADVERTENCIA Plantillas: No se pudo usar la caché de bytecode: {e}")
+
+def precompile_templates():
+    """Carga (y compila si no están en la caché de bytecode) todas las plantillas. Devuelve cuántas."""
+    names = [name for name in app.jinja_env.list_templates() if name.endswith('.html')]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+if JINJA_PRECOMPILE:
+    _start = time.perf_counter()
+    try:
+        _count = precompile_templates()
+        print(f"INFO Plantillas: {_count} plantillas cargadas en {(time.perf_counter() - _start) * 1000:.0f} ms (pid {os.getpid()}).")
+    except Exception as e:
+        # Una plantilla rota no debe impedir que arranque el resto de la web
+        print(f"ERROR Plantillas: Error al precompilar las plantillas: {e}")
+
+@app.cli.command('templates-compile')
+def templates_compile_command():
+    """Compila todas las plantillas y rellena la caché de bytecode."""
+    bytecode_cache = app.jinja_env.bytecode_cache
+    if bytecode_cache is None:
+        raise click.ClickException("La caché de bytecode no está disponible (ver la advertencia al arrancar).")
+    bytecode_cache.clear()
+    app.jinja_env.cache.clear()
+    start = time.perf_counter()
+    count = precompile_templates()
+    click.echo(f"INFO Plantillas: {count} plantillas compiladas en {(time.perf_counter() - start) * 1000:.0f} ms en {bytecode_cache.directory}.")
+
+# -------------------------------------------------------------
+# FIN DE LA SECCIÓN DE PRECOMPILACIÓN DE PLANTILLAS
+# -------------------------------------------------------------
+
+
 if __name__ == '__main__':
     # Usar el puerto proporcionado por Render o el 5000 por defecto
     port = int(os.environ.get('PORT', 5000))
@@ -0,0 +1,116 @@
+# Servidor falso de la API de Mailgun para desarrollo y pruebas.
+# Acepta POST /v3/<dominio>/messages como Mailgun y guarda los mensajes en memoria.
+#
+# Uso desde la línea de comandos:
+#   python fake_mailgun.py --port 8025
+#   MAILGUN_API_BASE=http://127.0.0.1:8025/v3 MAILGUN_API_KEY=test MAILGUN_DOMAIN=test.local flask run
+#
+# Uso desde una prueba: app.mail_client se crea al importar app.py, así que cambiar
+# MAILGUN_API_BASE después no tiene efecto. Crea un cliente que apunte al servidor
+# (o sustituye app.mail_client por él):
+#   with FakeMailgunServer() as server:
+#       client = MailgunClient('key', 'test.local', 'info@example.com', server.base_url, timeout=5)
+#       client.send('destino@example.com', 'Asunto', '<p>Hola</p>')
+#       assert server.messages[0]['to'] == ['destino@example.com']
+# Ver tests/test_mailgun.py.
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class FakeMailgunServer:
+    """Servidor HTTP local que imita el endpoint de envío de Mailgun."""
+
+    def __init__(self, host='127.0.0.1', port=0, fail_status=None):
+        self.messages = []
+        self.requests = 0 # Peticiones POST recibidas, incluidas las fallidas y los reintentos
+        # Si se define (p. ej. 503), todas las peticiones responden con ese código
+        self.fail_status = fail_status
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v3"
+
+    def _make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1' # Mantiene la conexión abierta como Mailgun (keep-alive)
+
+            def _reply(self, status, payload):
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_POST(self):
+                with server._lock:
+                    server.requests += 1
+                length = int(self.headers.get('Content-Length', 0))
+                fields = parse_qs(self.rfile.read(length).decode('utf-8'))
+                parts = self.path.strip('/').split('/')
+                if len(parts) != 3 or parts[0] != 'v3' or parts[2] != 'messages':
+                    return self._reply(404, {'message': 'Not found'})
+                if not self.headers.get('Authorization', '').startswith('Basic '):
+                    return self._reply(401, {'message': 'Forbidden'})
+                if server.fail_status:
+                    return self._reply(server.fail_status, {'message': 'Fallo simulado'})
+                message = {
+                    'domain': parts[1],
+                    'from': fields.get('from', [''])[0],
+                    'to': fields.get('to', []),
+                    'subject': fields.get('subject', [''])[0],
+                    'html': fields.get('html', [''])[0],
+                    'recipient_variables': json.loads(fields.get('recipient-variables', ['{}'])[0]),
+                }
+                with server._lock:
+                    server.messages.append(message)
+                    message_id = len(server.messages)
+                self._reply(200, {'id': f'<{message_id}@fake-mailgun>', 'message': 'Queued. Thank you.'})
+
+            def do_GET(self):
+                # GET /messages devuelve lo recibido, útil para inspeccionar a mano
+                with server._lock:
+                    self._reply(200, server.messages)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Servidor falso de la API de Mailgun.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8025)
+    args = parser.parse_args()
+    server = FakeMailgunServer(args.host, args.port)
+    print(f"Fake Mailgun escuchando en {server.base_url}")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
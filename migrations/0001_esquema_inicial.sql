@@ -0,0 +1,42 @@
+-- Esquema base de la aplicación. Usa IF NOT EXISTS para poder aplicarse
+-- sobre la base de datos de producción, donde las tablas ya existen.
+
+CREATE TABLE IF NOT EXISTS empresas (
+    id SERIAL PRIMARY KEY,
+    nombre TEXT NOT NULL,
+    email_contacto TEXT NOT NULL,
+    telefono TEXT,
+    actividad TEXT,
+    sector TEXT,
+    pais TEXT,
+    ubicacion TEXT,
+    tipo_negocio TEXT,
+    descripcion TEXT,
+    facturacion NUMERIC(15, 2),
+    numero_empleados INTEGER,
+    local_propiedad TEXT,
+    resultado_antes_impuestos NUMERIC(15, 2),
+    deuda NUMERIC(15, 2) DEFAULT 0,
+    precio_venta NUMERIC(15, 2),
+    imagen_filename_gcs TEXT,
+    imagen_url TEXT,
+    token_edicion TEXT NOT NULL,
+    active BOOLEAN NOT NULL DEFAULT TRUE,
+    fecha_publicacion TIMESTAMP NOT NULL DEFAULT NOW(),
+    fecha_modificacion TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS blog_posts (
+    id SERIAL PRIMARY KEY,
+    title TEXT NOT NULL,
+    slug TEXT NOT NULL,
+    content TEXT NOT NULL,
+    author TEXT,
+    is_published BOOLEAN NOT NULL DEFAULT FALSE,
+    seo_title TEXT,
+    seo_description TEXT,
+    featured_image_filename_gcs TEXT,
+    featured_image_url TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    updated_at TIMESTAMP
+);
@@ -0,0 +1,40 @@
+-- Índices para las rutas calientes de index(), editar() y el blog.
+-- Los índices parciales (WHERE active = TRUE) solo contienen anuncios visibles,
+-- y todos terminan en (fecha_publicacion DESC, id DESC) para servir la
+-- paginación por cursor de index() sin ordenar en memoria.
+
+-- Listado sin filtros
+CREATE INDEX IF NOT EXISTS idx_empresas_activas_fecha
+    ON empresas (fecha_publicacion DESC, id DESC)
+    WHERE active = TRUE;
+
+-- Filtro por actividad (y actividad + sector)
+CREATE INDEX IF NOT EXISTS idx_empresas_activas_actividad_sector_fecha
+    ON empresas (actividad, sector, fecha_publicacion DESC, id DESC)
+    WHERE active = TRUE;
+
+-- Filtro por provincia
+CREATE INDEX IF NOT EXISTS idx_empresas_activas_ubicacion_fecha
+    ON empresas (ubicacion, fecha_publicacion DESC, id DESC)
+    WHERE active = TRUE;
+
+-- Rangos numéricos del formulario de filtros
+CREATE INDEX IF NOT EXISTS idx_empresas_activas_precio
+    ON empresas (precio_venta)
+    WHERE active = TRUE;
+
+CREATE INDEX IF NOT EXISTS idx_empresas_activas_facturacion
+    ON empresas (facturacion)
+    WHERE active = TRUE;
+
+-- Acceso del anunciante por enlace de edición
+CREATE UNIQUE INDEX IF NOT EXISTS uq_empresas_token_edicion
+    ON empresas (token_edicion);
+
+-- Blog: detalle por slug y listado de publicados
+CREATE UNIQUE INDEX IF NOT EXISTS uq_blog_posts_slug
+    ON blog_posts (slug);
+
+CREATE INDEX IF NOT EXISTS idx_blog_posts_publicados_fecha
+    ON blog_posts (created_at DESC)
+    WHERE is_published = TRUE;
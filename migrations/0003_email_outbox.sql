@@ -0,0 +1,20 @@
+-- Bandeja de salida de correos. publicar() inserta aquí en la misma transacción
+-- que el anuncio y un proceso en segundo plano envía los mensajes vía Mailgun.
+-- status: 'pending' (por enviar o reintentando), 'sent' o 'dead' (agotó los reintentos).
+
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    to_email TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    body TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    sent_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_email_outbox_pendientes
+    ON email_outbox (next_attempt_at, id)
+    WHERE status = 'pending';
@@ -0,0 +1,5 @@
+-- Variantes redimensionadas de la imagen de cada anuncio (tarjeta, detalle, og:image).
+-- Las rellena el pipeline de imágenes en segundo plano; NULL mientras no existan,
+-- en cuyo caso las plantillas usan imagen_url (el original).
+
+ALTER TABLE empresas ADD COLUMN IF NOT EXISTS imagen_variantes JSONB;
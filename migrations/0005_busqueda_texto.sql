@@ -0,0 +1,22 @@
+-- Búsqueda por palabras clave en el listado público.
+-- 'busqueda' es una columna generada con la configuración de idioma español: el nombre y
+-- el tipo de negocio pesan más (A) que la actividad y el sector (B) y que la descripción (C).
+-- Añadir una columna STORED reescribe la tabla una vez; después se mantiene sola.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE empresas ADD COLUMN IF NOT EXISTS busqueda tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('spanish', coalesce(nombre, '') || ' ' || coalesce(tipo_negocio, '')), 'A') ||
+        setweight(to_tsvector('spanish', coalesce(actividad, '') || ' ' || coalesce(sector, '')), 'B') ||
+        setweight(to_tsvector('spanish', coalesce(descripcion, '')), 'C')
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_empresas_activas_busqueda
+    ON empresas USING GIN (busqueda)
+    WHERE active = TRUE;
+
+-- Tolerancia a erratas en el tipo de negocio ("restaurnte" -> "Restaurante")
+CREATE INDEX IF NOT EXISTS idx_empresas_activas_tipo_negocio_trgm
+    ON empresas USING GIN (lower(tipo_negocio) gin_trgm_ops)
+    WHERE active = TRUE;
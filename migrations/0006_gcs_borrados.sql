@@ -0,0 +1,18 @@
+-- Cola de objetos de GCS pendientes de borrar. Las rutas que eliminan un anuncio o
+-- reemplazan su imagen insertan aquí los nombres en la misma transacción, y un
+-- proceso en segundo plano los borra en lotes ('flask gcs-cleanup').
+-- status: 'pending' (por borrar o reintentando) o 'dead' (agotó los reintentos).
+-- Las filas borradas con éxito desaparecen de la tabla.
+
+CREATE TABLE IF NOT EXISTS gcs_deletions (
+    filename TEXT PRIMARY KEY,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at TIMESTAMP NOT NULL DEFAULT NOW(),
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_gcs_deletions_pendientes
+    ON gcs_deletions (next_attempt_at)
+    WHERE status = 'pending';
@@ -0,0 +1,8 @@
+-- Subidas directas a GCS ya usadas en un formulario. finalize_signed_upload() inserta
+-- aquí el nombre del objeto al aceptarlo, así un mismo token no puede adjuntar la
+-- imagen a varios anuncios. Las filas más antiguas que la caducidad del token se borran.
+
+CREATE TABLE IF NOT EXISTS signed_uploads_used (
+    object_name TEXT PRIMARY KEY,
+    used_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
@@ -0,0 +1,17 @@
+-- El nombre de la empresa es confidencial (las páginas públicas no lo muestran), así que
+-- no puede servir para encontrar anuncios en la búsqueda pública. Se regenera 'busqueda'
+-- sin él: el tipo de negocio queda solo con peso A.
+
+DROP INDEX IF EXISTS idx_empresas_activas_busqueda;
+ALTER TABLE empresas DROP COLUMN IF EXISTS busqueda;
+
+ALTER TABLE empresas ADD COLUMN busqueda tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('spanish', coalesce(tipo_negocio, '')), 'A') ||
+        setweight(to_tsvector('spanish', coalesce(actividad, '') || ' ' || coalesce(sector, '')), 'B') ||
+        setweight(to_tsvector('spanish', coalesce(descripcion, '')), 'C')
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_empresas_activas_busqueda
+    ON empresas USING GIN (busqueda)
+    WHERE active = TRUE;
@@ -0,0 +1,52 @@
+// Subida directa de imágenes a Google Cloud Storage mediante URLs firmadas.
+// Al enviar el formulario, si hay una imagen seleccionada, se pide una URL firmada,
+// se sube la imagen con un PUT directo a GCS y el formulario solo envía el token.
+// Si algo falla (p. ej. GCS no configurado), el formulario se envía con la imagen como siempre.
+(function () {
+    document.querySelectorAll('input[type="file"][data-firmar-url]').forEach(function (input) {
+        const form = input.form;
+        const tokenInput = form.querySelector('input[name="imagen_token"]');
+        let enviando = false;
+
+        form.addEventListener('submit', function (event) {
+            const archivo = input.files && input.files[0];
+            if (enviando || !archivo || !tokenInput || !window.fetch) {
+                return;
+            }
+            event.preventDefault();
+            enviando = true;
+            const boton = form.querySelector('button[type="submit"]');
+            if (boton) boton.disabled = true;
+
+            function enviarFormulario() {
+                if (boton) boton.disabled = false;
+                // form.submit() no vuelve a lanzar el evento 'submit'
+                HTMLFormElement.prototype.submit.call(form);
+            }
+
+            fetch(input.dataset.firmarUrl, {
+                method: 'POST',
+                // Token de la sesión: solo quien ha abierto el formulario puede pedir firmas
+                headers: {'Content-Type': 'application/json', 'X-Upload-Token': input.dataset.firmarToken || ''},
+                body: JSON.stringify({content_type: archivo.type, size: archivo.size})
+            })
+                .then(function (respuesta) {
+                    if (!respuesta.ok) throw new Error('firma');
+                    return respuesta.json();
+                })
+                .then(function (firma) {
+                    return fetch(firma.upload_url, {method: 'PUT', headers: firma.headers, body: archivo})
+                        .then(function (subida) {
+                            if (!subida.ok) throw new Error('subida');
+                            tokenInput.value = firma.upload_token;
+                            // La imagen ya está en GCS: no volver a enviarla al servidor
+                            input.disabled = true;
+                        });
+                })
+                .catch(function () {
+                    tokenInput.value = '';
+                })
+                .then(enviarFormulario);
+        });
+    });
+})();
@@ -0,0 +1,41 @@
+# Pruebas de la aplicación. Ejecutar desde la raíz del repositorio con: python -m pytest
+#
+# Las pruebas que tocan la base de datos usan TEST_DATABASE_URL (una BD de PostgreSQL
+# desechable: se le aplican las migraciones y se crean y borran filas de prueba). Si no
+# está definida, esas pruebas se saltan y el resto se ejecuta igual.
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# La configuración se lee al importar app.py: tiene que estar puesta antes del import
+TEST_DATABASE_URL = os.environ.get('TEST_DATABASE_URL')
+os.environ['DATABASE_URL'] = TEST_DATABASE_URL or 'postgresql://pymemarket-tests@/sin-base-de-datos'
+os.environ['EMAIL_OUTBOX_THREAD'] = '0'
+os.environ['GCS_CLEANUP_THREAD'] = '0'
+os.environ['PAGE_CACHE_BACKEND'] = 'none'
+os.environ['ADMIN_TOKEN'] = 'token-de-pruebas'
+for name in ('MAILGUN_API_KEY', 'MAILGUN_DOMAIN', 'CLOUD_STORAGE_BUCKET', 'EMAIL_DESTINO'):
+    os.environ.pop(name, None)
+
+import app as app_module  # noqa: E402
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+@pytest.fixture
+def db():
+    """Conexión a la BD de pruebas con las migraciones aplicadas."""
+    if not TEST_DATABASE_URL:
+        pytest.skip("TEST_DATABASE_URL no está definida")
+    with app_module.app.app_context():
+        conn = app_module.get_db_connection()
+        app_module.apply_migrations(conn)
+        yield conn
+        conn.rollback()
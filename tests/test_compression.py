@@ -0,0 +1,125 @@
+import gzip
+
+import pytest
+from flask import Response
+
+import app as app_module
+from app import compress_response
+
+BODY = '<html><body>' + '<p>Negocio en venta</p>' * 100 + '</body></html>'
+
+
+@pytest.fixture
+def accept(request):
+    """Contexto de petición con el Accept-Encoding indicado (por defecto gzip)."""
+    def enter(encoding='gzip'):
+        headers = {'Accept-Encoding': encoding} if encoding else {}
+        ctx = app_module.app.test_request_context('/', headers=headers)
+        ctx.push()
+        request.addfinalizer(ctx.pop)
+    return enter
+
+
+def test_large_text_is_gzipped(accept):
+    accept('gzip')
+    response = compress_response(Response(BODY, mimetype='text/html'))
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert int(response.headers['Content-Length']) == len(response.get_data())
+    assert gzip.decompress(response.get_data()).decode('utf-8') == BODY
+
+
+def test_client_without_gzip_gets_identity(accept):
+    accept(None)
+    response = compress_response(Response(BODY, mimetype='text/html'))
+    assert 'Content-Encoding' not in response.headers
+    # La respuesta depende igualmente de Accept-Encoding para las cachés intermedias
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert response.get_data(as_text=True) == BODY
+
+
+def test_small_body_is_not_compressed(accept):
+    accept('gzip')
+    response = compress_response(Response('<p>Hola</p>', mimetype='text/html'))
+    assert 'Content-Encoding' not in response.headers
+    assert response.get_data(as_text=True) == '<p>Hola</p>'
+
+
+def test_binary_mimetype_is_not_compressed(accept):
+    accept('gzip')
+    response = compress_response(Response(b'\x89PNG' * 500, mimetype='image/png'))
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_already_encoded_response_is_untouched(accept):
+    accept('gzip')
+    body = gzip.compress(BODY.encode('utf-8'))
+    response = Response(body, mimetype='text/html')
+    response.headers['Content-Encoding'] = 'gzip'
+    assert compress_response(response).get_data() == body
+
+
+@pytest.mark.parametrize('status', [204, 304])
+def test_bodyless_statuses_are_skipped(accept, status):
+    accept('gzip')
+    response = compress_response(Response(BODY, status=status, mimetype='text/html'))
+    assert 'Content-Encoding' not in response.headers
+
+
+def test_strong_etag_gets_encoding_suffix(accept):
+    accept('gzip')
+    response = Response(BODY, mimetype='text/html')
+    response.set_etag('abc123')
+    compress_response(response)
+    assert response.get_etag() == ('abc123-gzip', False)
+
+
+def test_weak_etag_is_kept(accept):
+    # Los ETag débiles de conditional_page valen para cualquier codificación
+    accept('gzip')
+    response = Response(BODY, mimetype='text/html')
+    response.set_etag('abc123', weak=True)
+    compress_response(response)
+    assert response.get_etag() == ('abc123', True)
+
+
+def test_streamed_response_is_compressed_per_chunk(accept):
+    accept('gzip')
+    closed = []
+
+    def rows():
+        try:
+            for i in range(50):
+                yield f'{i},Negocio {i}\n'
+        finally:
+            closed.append(True)
+
+    response = Response(rows(), mimetype='text/csv')
+    response.headers['Content-Length'] = '999'
+    compress_response(response)
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Content-Length' not in response.headers
+    assert 'Accept-Encoding' in response.headers['Vary']
+    chunks = list(response.response)
+    # Z_SYNC_FLUSH: cada fila sale en su propio trozo, sin esperar al final
+    assert len(chunks) > 50
+    assert gzip.decompress(b''.join(chunks)).decode('utf-8') == ''.join(f'{i},Negocio {i}\n' for i in range(50))
+    assert closed == [True]
+
+
+def test_streamed_response_close_reaches_generator(accept):
+    accept('gzip')
+    closed = []
+
+    def rows():
+        try:
+            while True:
+                yield 'fila\n'
+        finally:
+            closed.append(True)
+
+    response = compress_response(Response(rows(), mimetype='text/csv'))
+    stream = response.response
+    next(stream)
+    stream.close() # Cliente desconectado
+    assert closed == [True]
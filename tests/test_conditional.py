@@ -0,0 +1,117 @@
+import json
+from datetime import datetime
+
+import pytest
+from flask import Flask
+
+import app as app_module
+from app import conditional_page
+
+MODIFIED = datetime(2024, 5, 1, 10, 30, 15, 123456)
+
+
+@pytest.fixture
+def state():
+    return {'validators': (MODIFIED, ('empresa', 1, MODIFIED.isoformat())), 'renders': 0}
+
+
+@pytest.fixture
+def client(state):
+    mini = Flask(__name__)
+    mini.secret_key = 'clave-de-pruebas'
+
+    def validator(empresa_id):
+        if isinstance(state['validators'], Exception):
+            raise state['validators']
+        return state['validators']
+
+    @mini.route('/negocio/<int:empresa_id>')
+    @conditional_page(validator)
+    def detalle(empresa_id):
+        state['renders'] += 1
+        return f'<p>Negocio {empresa_id}</p>'
+
+    return mini.test_client()
+
+
+def test_sets_weak_etag_and_last_modified(client):
+    response = client.get('/negocio/1')
+    assert response.status_code == 200
+    etag, weak = response.get_etag()
+    assert etag and weak
+    # Last-Modified sin microsegundos, en UTC
+    assert response.headers['Last-Modified'] == 'Wed, 01 May 2024 10:30:15 GMT'
+    assert response.headers['Cache-Control'] == app_module.PUBLIC_PAGE_CACHE_CONTROL
+
+
+def test_if_none_match_returns_304_without_rendering(client, state):
+    etag = client.get('/negocio/1').headers['ETag']
+    response = client.get('/negocio/1', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.get_data() == b''
+    assert response.headers['ETag'] == etag
+    assert state['renders'] == 1
+
+
+def test_if_modified_since_returns_304(client, state):
+    last_modified = client.get('/negocio/1').headers['Last-Modified']
+    response = client.get('/negocio/1', headers={'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+    assert state['renders'] == 1
+
+
+def test_if_none_match_takes_precedence_over_if_modified_since(client):
+    last_modified = client.get('/negocio/1').headers['Last-Modified']
+    response = client.get('/negocio/1', headers={'If-None-Match': 'W/"otro"', 'If-Modified-Since': last_modified})
+    assert response.status_code == 200
+
+
+def test_changed_content_gets_new_etag(client, state):
+    etag = client.get('/negocio/1').headers['ETag']
+    state['validators'] = (MODIFIED, ('empresa', 1, 'otra-fecha'))
+    response = client.get('/negocio/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_query_args_are_part_of_the_etag(client):
+    etag = client.get('/negocio/1').headers['ETag']
+    assert client.get('/negocio/1?pagina=2').headers['ETag'] != etag
+    # Los argumentos de seguimiento no cambian el contenido
+    assert client.get('/negocio/1?utm_source=boletin').headers['ETag'] == etag
+
+
+def test_missing_validators_run_the_view(client, state):
+    state['validators'] = None
+    response = client.get('/negocio/1')
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+
+
+def test_validator_error_runs_the_view(client, state):
+    state['validators'] = RuntimeError('sin base de datos')
+    response = client.get('/negocio/1', headers={'If-None-Match': '*'})
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+
+
+def test_pending_flash_skips_validators(client, state):
+    etag = client.get('/negocio/1').headers['ETag']
+    with client.session_transaction() as sess:
+        sess['_flashes'] = [('success', 'Mensaje enviado')]
+    response = client.get('/negocio/1', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert 'ETag' not in response.headers
+
+
+def test_api_empresas_revalidation(db):
+    client = app_module.app.test_client()
+    first = client.get('/api/v1/empresas')
+    assert first.status_code == 200
+    # La respuesta va en streaming: leerla entera cierra el cursor con nombre
+    json.loads(first.get_data())
+    etag = first.headers['ETag']
+    assert client.get('/api/v1/empresas', headers={'If-None-Match': etag}).status_code == 304
+    other = client.get('/api/v1/empresas?fields=id', headers={'If-None-Match': etag})
+    assert other.status_code == 200
+    assert all(set(item) == {'id'} for item in json.loads(other.get_data())['data'])
@@ -0,0 +1,154 @@
+import csv
+import io
+import json
+import uuid
+
+import pytest
+
+from app import EMPRESA_IMPORT_REQUIRED_COLUMNS, EmpresasImportError, import_empresas
+
+VALID = {
+    'nombre': 'Cafetería de Pruebas SL',
+    'email_contacto': 'vendedor@example.com',
+    'telefono': '600123456',
+    'actividad': 'Hostelería y Restauración',
+    'sector': 'Bares y Cafeterías',
+    'ubicacion': 'Madrid',
+    'tipo_negocio': 'Cafetería',
+    'descripcion': 'Cafetería con clientela fija.',
+    'facturacion': '250000.50',
+    'numero_empleados': '4',
+    'resultado_antes_impuestos': '-1500',
+    'precio_venta': '90000',
+}
+
+
+def row(**changes):
+    return dict(VALID, token_edicion=f'prueba-{uuid.uuid4()}', **changes)
+
+
+def as_csv(rows):
+    header = list(rows[0])
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for r in rows:
+        writer.writerow([r[h] for h in header])
+    buffer.seek(0)
+    return buffer
+
+
+def as_ndjson(rows):
+    return io.StringIO(''.join(json.dumps(r) + '\n' for r in rows))
+
+
+def errors_by_row(informe):
+    return dict(informe['errores'])
+
+
+def test_dry_run_reports_without_saving(db):
+    rows = [row(), row()]
+    informe = import_empresas(db, as_csv(rows), 'csv', dry_run=True)
+    assert informe == {'filas': 2, 'insertadas': 2, 'actualizadas': 0, 'errores': [], 'simulacion': True}
+    cur = db.cursor()
+    cur.execute("SELECT count(*) FROM empresas WHERE token_edicion = ANY(%s)", ([r['token_edicion'] for r in rows],))
+    assert cur.fetchone()[0] == 0
+
+
+def test_import_inserts_and_updates_by_token(db):
+    first = row()
+    cur = db.cursor()
+    try:
+        assert import_empresas(db, as_ndjson([first]), 'ndjson')['insertadas'] == 1
+        # Mismo token_edicion: se actualiza solo lo que trae el fichero
+        informe = import_empresas(db, as_ndjson([{'token_edicion': first['token_edicion'], **VALID,
+                                                  'precio_venta': 85000}]), 'ndjson')
+        assert (informe['insertadas'], informe['actualizadas']) == (0, 1)
+        cur.execute("SELECT precio_venta, pais, active FROM empresas WHERE token_edicion = %s", (first['token_edicion'],))
+        precio, pais, active = cur.fetchone()
+        assert (int(precio), pais, active) == (85000, 'España', True)
+    finally:
+        cur.execute("DELETE FROM empresas WHERE token_edicion = %s", (first['token_edicion'],))
+        db.commit()
+
+
+def test_invalid_rows_are_reported_and_valid_rows_kept(db):
+    rows = [
+        row(),
+        row(actividad='Minería espacial'),
+        row(sector='Ciberseguridad'), # Existe, pero en otra actividad
+        row(ubicacion='Lisboa'),
+        row(telefono='12345'),
+    ]
+    informe = import_empresas(db, as_csv(rows), 'csv', dry_run=True)
+    errores = errors_by_row(informe)
+    assert informe['insertadas'] == 1
+    # La cabecera es la fila 1
+    assert sorted(errores) == [3, 4, 5, 6]
+    assert errores[3] == ['Actividad no válida: Minería espacial']
+    assert errores[4] == ['Sector no válido para la actividad: Ciberseguridad']
+    assert errores[5] == ['Provincia no válida: Lisboa']
+    assert 'teléfono' in errores[6][0]
+
+
+@pytest.mark.parametrize('column, value, message', [
+    ('facturacion', '10000000000000', 'facturacion es demasiado grande'),
+    ('resultado_antes_impuestos', '-10000000000000', 'resultado_antes_impuestos es demasiado grande'),
+    ('precio_venta', '1000.125', 'precio_venta admite como máximo 2 decimales'),
+    ('numero_empleados', '2147483648', 'numero_empleados es demasiado grande'),
+    ('numero_empleados', '3.5', 'numero_empleados no es un número válido'),
+    ('precio_venta', '-5', 'precio_venta no puede ser negativo'),
+    ('facturacion', 'mucho', 'facturacion no es un número válido'),
+])
+def test_numeric_limits(db, column, value, message):
+    informe = import_empresas(db, as_csv([row(**{column: value})]), 'csv', dry_run=True)
+    (fila, mensajes), = informe['errores']
+    assert fila == 2
+    assert any(m.startswith(message) for m in mensajes), mensajes
+    assert informe['insertadas'] == 0
+
+
+def test_numeric_limits_accept_boundaries(db):
+    informe = import_empresas(db, as_csv([row(facturacion='9999999999999.99', numero_empleados='2147483647',
+                                              resultado_antes_impuestos='-9999999999999.99')]), 'csv', dry_run=True)
+    assert informe['errores'] == []
+    assert informe['insertadas'] == 1
+
+
+def test_duplicate_token_in_file(db):
+    first = row()
+    informe = import_empresas(db, as_csv([first, dict(first)]), 'csv', dry_run=True)
+    assert errors_by_row(informe) == {3: [f"token_edicion repetido en el fichero: {first['token_edicion']}"]}
+    assert informe['insertadas'] == 1
+
+
+def test_missing_required_values(db):
+    informe = import_empresas(db, as_ndjson([row(nombre='', precio_venta=None)]), 'ndjson', dry_run=True)
+    mensajes = errors_by_row(informe)[1]
+    assert 'El nombre de la empresa es obligatorio.' in mensajes
+    assert 'precio_venta es obligatorio.' in mensajes
+
+
+def test_malformed_ndjson_lines(db):
+    stream = io.StringIO('{"nombre": \n[1, 2]\n{"color": "azul"}\n')
+    informe = import_empresas(db, stream, 'ndjson', dry_run=True)
+    errores = errors_by_row(informe)
+    assert errores[1][0].startswith('JSON no válido')
+    assert errores[2] == ['Cada línea debe ser un objeto JSON.']
+    assert errores[3] == ['Campos desconocidos: color.']
+    assert informe['filas'] == 3
+
+
+def test_csv_row_with_wrong_column_count(db):
+    stream = as_csv([row()])
+    stream = io.StringIO(stream.getvalue() + 'solo,tres,columnas\n')
+    informe = import_empresas(db, stream, 'csv', dry_run=True)
+    assert errors_by_row(informe)[3][0].startswith('Tiene 3 columnas')
+
+
+def test_invalid_csv_header(db):
+    header = [c for c in EMPRESA_IMPORT_REQUIRED_COLUMNS if c != 'telefono'] + ['color']
+    with pytest.raises(EmpresasImportError) as error:
+        import_empresas(db, io.StringIO(','.join(header) + '\n'), 'csv', dry_run=True)
+    assert 'Columnas desconocidas: color.' in str(error.value)
+    assert 'Faltan columnas: telefono.' in str(error.value)
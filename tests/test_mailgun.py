@@ -0,0 +1,48 @@
+import pytest
+
+from app import MailgunClient, send_email_result
+import app as app_module
+from fake_mailgun import FakeMailgunServer
+
+
+@pytest.fixture
+def server():
+    with FakeMailgunServer() as server:
+        yield server
+
+
+def make_client(server):
+    return MailgunClient('key-de-pruebas', 'test.local', 'info@example.com', server.base_url, timeout=5)
+
+
+def test_send_posts_message(server):
+    ok, error = make_client(server).send('destino@example.com', 'Asunto', '<p>Hola</p>')
+    assert (ok, error) == (True, None)
+    assert server.messages[0]['to'] == ['destino@example.com']
+    assert server.messages[0]['subject'] == 'Asunto'
+
+
+def test_server_error_is_not_retried(server):
+    # Un 5xx puede llegar con el mensaje ya aceptado: reintentarlo duplicaría el correo
+    server.fail_status = 503
+    ok, error = make_client(server).send('destino@example.com', 'Asunto', '<p>Hola</p>')
+    assert not ok
+    assert error.startswith('HTTP 503')
+    assert server.requests == 1
+
+
+def test_rate_limit_is_retried(server):
+    server.fail_status = 429
+    ok, error = make_client(server).send('destino@example.com', 'Asunto', '<p>Hola</p>')
+    assert not ok
+    assert error.startswith('HTTP 429')
+    assert server.requests == 3 # El envío y los dos reintentos
+
+
+def test_batch_uses_recipient_variables(server, monkeypatch):
+    monkeypatch.setattr(app_module, 'mail_client', make_client(server))
+    ok, _ = send_email_result('a@example.com, b@example.com', 'Asunto', '<p>Hola</p>')
+    assert ok
+    assert len(server.messages) == 1
+    assert server.messages[0]['to'] == ['a@example.com', 'b@example.com']
+    assert set(server.messages[0]['recipient_variables']) == {'a@example.com', 'b@example.com'}
@@ -0,0 +1,223 @@
+import gzip
+
+import pytest
+from flask import Flask, make_response, session
+
+import app as app_module
+from app import LRUPageCache, FileTagVersions, PageCacheStats, cached_page, invalidate_pages
+
+# Por encima de COMPRESSION_MIN_SIZE para que la página se pueda comprimir
+PAGE_HTML = '<html><body>' + '<p>Negocio en venta</p>' * 100 + '</body></html>'
+
+
+@pytest.fixture
+def page_cache(tmp_path, monkeypatch):
+    cache = LRUPageCache(10, 300, FileTagVersions(str(tmp_path / 'etiquetas')))
+    monkeypatch.setattr(app_module, 'page_cache', cache)
+    monkeypatch.setattr(app_module, 'page_cache_stats', PageCacheStats())
+    return cache
+
+
+@pytest.fixture
+def renders():
+    return []
+
+
+@pytest.fixture
+def client(page_cache, renders):
+    """Aplicación mínima con vistas cacheadas y el mismo after_request de compresión que app.py."""
+    mini = Flask(__name__)
+    mini.secret_key = 'clave-de-pruebas'
+    mini.after_request(app_module.compress_response)
+
+    @mini.route('/listado')
+    @cached_page('empresas')
+    def listado():
+        renders.append('listado')
+        return PAGE_HTML
+
+    @mini.route('/negocio/<int:empresa_id>')
+    @cached_page(lambda empresa_id: f'empresa:{empresa_id}')
+    def detalle(empresa_id):
+        renders.append(f'detalle:{empresa_id}')
+        return PAGE_HTML
+
+    @mini.route('/blog')
+    @cached_page('blog')
+    def blog():
+        renders.append('blog')
+        return PAGE_HTML
+
+    @mini.route('/con-cabeceras')
+    @cached_page('blog')
+    def con_cabeceras():
+        renders.append('con-cabeceras')
+        response = make_response(PAGE_HTML)
+        response.headers['Cache-Control'] = 'public, max-age=60'
+        response.headers['Link'] = '</static/app.css>; rel=preload; as=style'
+        response.headers['X-Robots-Tag'] = 'noindex'
+        response.set_cookie('preferencia', 'lista')
+        return response
+
+    @mini.route('/personal')
+    @cached_page('empresas')
+    def personal():
+        session['visto'] = True
+        renders.append('personal')
+        return PAGE_HTML
+
+    @mini.route('/no-encontrado')
+    @cached_page('empresas')
+    def no_encontrado():
+        renders.append('no-encontrado')
+        return PAGE_HTML, 404
+
+    return mini.test_client()
+
+
+def stats():
+    return app_module.page_cache_stats.snapshot()
+
+
+def test_second_request_is_served_from_cache(client, renders):
+    first = client.get('/listado')
+    second = client.get('/listado')
+    assert first.headers['X-Page-Cache'] == 'MISS'
+    assert second.headers['X-Page-Cache'] == 'HIT'
+    assert second.get_data(as_text=True) == PAGE_HTML
+    assert renders == ['listado']
+    assert stats()['hits'] == 1 and stats()['misses'] == 1 and stats()['stores'] == 1
+
+
+def test_key_ignores_tracking_args_and_arg_order(client, renders):
+    client.get('/listado?actividad=Comercio&ubicacion=Madrid')
+    assert client.get('/listado?ubicacion=Madrid&actividad=Comercio&utm_source=x').headers['X-Page-Cache'] == 'HIT'
+    assert client.get('/listado?ubicacion=Barcelona').headers['X-Page-Cache'] == 'MISS'
+    assert len(renders) == 2
+
+
+def test_each_encoding_is_compressed_once(client):
+    client.get('/listado') # Se guarda solo la versión sin comprimir
+    assert stats().get('compressions', 0) == 0
+
+    for _ in range(3):
+        response = client.get('/listado', headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['X-Page-Cache'] == 'HIT'
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.get_data()).decode('utf-8') == PAGE_HTML
+    assert stats()['compressions'] == 1
+
+    plain = client.get('/listado')
+    assert 'Content-Encoding' not in plain.headers
+    assert plain.get_data(as_text=True) == PAGE_HTML
+
+
+def test_miss_is_not_compressed_twice(client):
+    # La vista ya sale comprimida de cached_page: compress_response no debe volver a comprimirla
+    response = client.get('/listado', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['X-Page-Cache'] == 'MISS'
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(response.get_data()).decode('utf-8') == PAGE_HTML
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert stats()['compressions'] == 1
+
+
+def test_cached_encodings_are_kept_per_entry(client, page_cache):
+    client.get('/listado', headers={'Accept-Encoding': 'gzip'})
+    client.get('/listado')
+    (expires_at, entry), = page_cache._entries.values()
+    assert set(entry['bodies']) == {'identity', 'gzip'}
+    assert entry['bodies']['identity'] == PAGE_HTML.encode('utf-8')
+
+
+def test_invalidation_only_affects_tagged_pages(client, renders):
+    client.get('/listado')
+    client.get('/blog')
+    invalidate_pages('empresas')
+    assert client.get('/listado').headers['X-Page-Cache'] == 'MISS'
+    assert client.get('/blog').headers['X-Page-Cache'] == 'HIT'
+    assert renders == ['listado', 'blog', 'listado']
+    assert stats()['invalidations'] == 1
+
+
+def test_invalidation_by_callable_tag(client, renders):
+    client.get('/negocio/1')
+    client.get('/negocio/2')
+    invalidate_pages('empresa:1')
+    assert client.get('/negocio/1').headers['X-Page-Cache'] == 'MISS'
+    assert client.get('/negocio/2').headers['X-Page-Cache'] == 'HIT'
+    assert renders == ['detalle:1', 'detalle:2', 'detalle:1']
+
+
+def test_invalidation_reaches_other_workers(client, page_cache, tmp_path):
+    # Otro worker de la misma máquina: su propia memoria, la misma carpeta de versiones
+    client.get('/listado')
+    other_worker = FileTagVersions(str(tmp_path / 'etiquetas'))
+    other_worker.bump(['empresas'])
+    assert client.get('/listado').headers['X-Page-Cache'] == 'MISS'
+
+
+def test_hit_replays_view_headers(client):
+    miss = client.get('/con-cabeceras', headers={'Accept-Encoding': 'gzip'})
+    hit = client.get('/con-cabeceras', headers={'Accept-Encoding': 'gzip'})
+    assert hit.headers['X-Page-Cache'] == 'HIT'
+    for name in ('Cache-Control', 'Link', 'X-Robots-Tag', 'Content-Type', 'Vary'):
+        assert hit.headers[name] == miss.headers[name]
+    assert hit.headers['Content-Encoding'] == 'gzip'
+    assert int(hit.headers['Content-Length']) == len(hit.get_data())
+    # Las cookies son de quien generó la página: no se repiten a otros visitantes
+    assert 'Set-Cookie' in miss.headers
+    assert 'Set-Cookie' not in hit.headers
+
+
+def test_personal_and_error_pages_are_not_stored(client, renders):
+    client.get('/personal')
+    client.get('/personal')
+    client.get('/no-encontrado')
+    client.get('/no-encontrado')
+    assert renders == ['personal', 'personal', 'no-encontrado', 'no-encontrado']
+    assert stats().get('stores', 0) == 0
+
+
+def test_pending_flash_bypasses_cache(client, renders):
+    client.get('/listado')
+    with client.session_transaction() as sess:
+        sess['_flashes'] = [('success', 'Anuncio publicado')]
+    response = client.get('/listado')
+    assert 'X-Page-Cache' not in response.headers
+    assert renders == ['listado', 'listado']
+
+
+def test_lru_evicts_least_recently_used(tmp_path):
+    cache = LRUPageCache(2, 300, FileTagVersions(str(tmp_path)))
+    for key in ('a', 'b'):
+        cache.set(key, {'bodies': {'identity': key.encode()}})
+    cache.get('a')
+    cache.set('c', {'bodies': {'identity': b'c'}})
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+
+def test_lru_entries_expire(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(app_module.time, 'monotonic', lambda: now[0])
+    cache = LRUPageCache(10, 300, FileTagVersions(str(tmp_path)))
+    entry = {'bodies': {'identity': b'x'}}
+    cache.set('a', entry)
+    now[0] += 200
+    # Añadir una codificación no renueva el TTL de la entrada
+    cache.add_body('a', entry, 'gzip', b'gz')
+    assert cache.get('a')['bodies']['gzip'] == b'gz'
+    now[0] += 101
+    assert cache.get('a') is None
+
+
+def test_add_body_ignores_replaced_entry(tmp_path):
+    cache = LRUPageCache(10, 300, FileTagVersions(str(tmp_path)))
+    old = {'bodies': {'identity': b'antigua'}}
+    new = {'bodies': {'identity': b'nueva'}}
+    cache.set('a', old)
+    cache.set('a', new)
+    # Un worker que leyó la entrada antigua no debe mezclar su versión comprimida con la nueva
+    cache.add_body('a', old, 'gzip', b'gz-antigua')
+    assert 'gzip' not in cache.get('a')['bodies']